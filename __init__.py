@@ -23,8 +23,5 @@
 # DEALINGS IN THE SOFTWARE.
 # ***** END LICENSE BLOCK *****
 
-try:
-    from ctff import *
-except ImportError:
-    from tff import *
+from tff import *
 
@@ -0,0 +1,1694 @@
+/*
+ * ***** BEGIN LICENSE BLOCK *****
+ * Copyright (C) 2012-2014, Hayaki Saito
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a
+ * copy of this software and associated documentation files (the "Software"),
+ * to deal in the Software without restriction, including without limitation
+ * the rights to use, copy, modify, merge, publish, distribute, sublicense,
+ * and/or sell copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be included in
+ * all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ * IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ * FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+ * THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ * LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ * DEALINGS IN THE SOFTWARE.
+ * ***** END LICENSE BLOCK *****
+ */
+
+/*
+ * _tff - C implementation of tff.DefaultScanner and tff.DefaultParser
+ *
+ * The parser keeps its state and the parameter/intermediate bytes in C,
+ * and walks the decoded buffer of its own scanner directly. Python is
+ * called only to dispatch events, printable runs in the ground state are
+ * dispatched as one dispatch_text() call.
+ *
+ * tff.py derives its DefaultScanner and DefaultParser from the types
+ * defined here if this module is available.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <structmember.h>
+
+#define STATE_GROUND 0
+#define STATE_ESC 1
+#define STATE_ESC_INTERMEDIATE 2
+#define STATE_CSI_PARAMETER 3
+#define STATE_CSI_INTERMEDIATE 4
+#define STATE_CSI_IGNORE 5
+#define STATE_SS2 6
+#define STATE_SS3 7
+#define STATE_OSC 8
+#define STATE_OSC_ESC 9
+#define STATE_STR 10
+#define STATE_STR_ESC 11
+#define STATE_ESC_IGNORE 12
+
+/* printable characters which the ground state passes through as they are */
+#define IS_TEXT(c) (((c) > 0x1f && (c) < 0x7f) || (c) > 0x9f)
+
+/* characters which make up the value of OSC/DCS/SOS/PM/APC control strings */
+#define IS_PAYLOAD(c) ((c) > 0x1f || ((c) > 0x07 && (c) < 0x0e))
+
+/* at most this many parameter bytes and this many intermediate bytes are
+ * kept for a sequence; a longer one is ignored (dropped as a whole), as
+ * xterm does, the parser goes to STATE_CSI_IGNORE or STATE_ESC_IGNORE */
+#define SEQUENCE_LIMIT 256
+
+/* streamed control string values are dispatched in chunks of at most this
+ * many code points (and the rest at the end of each parse() call) */
+#define STRING_CHUNK 4096
+
+
+/***************************************************************************
+ *
+ * growable array of code points
+ *
+ */
+typedef struct {
+    Py_UCS4 *items;
+    Py_ssize_t length;
+    Py_ssize_t capacity;
+} codebuf;
+
+static int
+codebuf_append(codebuf *buf, Py_UCS4 c)
+{
+    if (buf->length == buf->capacity) {
+        Py_ssize_t capacity = buf->capacity ? buf->capacity * 2 : 64;
+        Py_UCS4 *items;
+
+        items = PyMem_Realloc(buf->items, capacity * sizeof(Py_UCS4));
+        if (items == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        buf->items = items;
+        buf->capacity = capacity;
+    }
+    buf->items[buf->length++] = c;
+    return 0;
+}
+
+static void
+codebuf_free(codebuf *buf)
+{
+    PyMem_Free(buf->items);
+    buf->items = NULL;
+    buf->length = buf->capacity = 0;
+}
+
+typedef struct {
+    const Py_UCS4 *items;
+    Py_ssize_t length;
+} segment;
+
+/* make a list of ints from the concatenation of the segments */
+static PyObject *
+make_list(const segment *segments, int count)
+{
+    PyObject *list;
+    PyObject *item;
+    Py_ssize_t length = 0;
+    Py_ssize_t n = 0;
+    Py_ssize_t i;
+    int k;
+
+    for (k = 0; k < count; ++k)
+        length += segments[k].length;
+    list = PyList_New(length);
+    if (list == NULL)
+        return NULL;
+    for (k = 0; k < count; ++k) {
+        for (i = 0; i < segments[k].length; ++i) {
+            item = PyInt_FromLong(segments[k].items[i]);
+            if (item == NULL) {
+                Py_DECREF(list);
+                return NULL;
+            }
+            PyList_SET_ITEM(list, n++, item);
+        }
+    }
+    return list;
+}
+
+static PyObject *
+codebuf_to_list(const codebuf *buf)
+{
+    segment s;
+
+    s.items = buf->items;
+    s.length = buf->length;
+    return make_list(&s, 1);
+}
+
+static PyObject *
+codebuf_to_unicode(const codebuf *buf)
+{
+#if Py_UNICODE_SIZE == 4
+    return PyUnicode_FromUnicode((const Py_UNICODE *)buf->items, buf->length);
+#else
+    PyObject *result;
+    Py_UNICODE *u;
+    Py_ssize_t length = buf->length;
+    Py_ssize_t i;
+    Py_UCS4 c;
+
+    for (i = 0; i < buf->length; ++i)
+        if (buf->items[i] > 0xffff)
+            ++length;
+    result = PyUnicode_FromUnicode(NULL, length);
+    if (result == NULL)
+        return NULL;
+    u = PyUnicode_AS_UNICODE(result);
+    for (i = 0; i < buf->length; ++i) {
+        c = buf->items[i];
+        if (c > 0xffff) {
+            c -= 0x10000;
+            *u++ = (Py_UNICODE)(0xd800 | (c >> 10));
+            *u++ = (Py_UNICODE)(0xdc00 | (c & 0x3ff));
+        } else {
+            *u++ = (Py_UNICODE)c;
+        }
+    }
+    return result;
+#endif
+}
+
+
+/***************************************************************************
+ *
+ * DefaultScanner
+ *
+ */
+typedef struct {
+    PyObject_HEAD
+    PyObject *data;         /* unicode decoded by the last assign */
+    PyObject *termenc;
+    PyObject *decoder;      /* incremental decoder, NULL for native UTF-8 */
+    PyObject *pending;      /* incomplete UTF-8 sequence of the last input */
+    char ucs4;
+    char byruns;            /* EUCScanner, decode the non-ASCII runs only */
+    char held;              /* the decoder may keep an incomplete character */
+} ScannerObject;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *data;
+    Py_ssize_t pos;         /* index of the next character */
+    Py_ssize_t start;       /* index of the last yielded code point */
+    Py_UCS4 c1;             /* pending high surrogate */
+    int ucs4;
+} ScannerIterObject;
+
+static PyTypeObject ScannerType;
+static PyTypeObject EUCScannerType;
+static PyTypeObject ScannerIterType;
+
+/* ASCII transparent encodings whose decoders replace an incomplete character
+   together with the byte which follows it, see tff.EUCScanner */
+static const char *run_decoded_encodings[] = {
+    "euc_jp", "euc_jis_2004", "euc_jisx0213", "euc_kr", "gb2312", NULL
+};
+
+static int
+is_run_decoded(const char *name)
+{
+    const char **p;
+
+    for (p = run_decoded_encodings; *p != NULL; ++p)
+        if (strcmp(name, *p) == 0)
+            return 1;
+    return 0;
+}
+
+static int
+scanner_setencoding(ScannerObject *self, PyObject *termenc)
+{
+    PyObject *codecs;
+    PyObject *info = NULL;
+    PyObject *name = NULL;
+    PyObject *factory = NULL;
+    PyObject *decoder = NULL;
+    int result = -1;
+
+    codecs = PyImport_ImportModule("codecs");
+    if (codecs == NULL)
+        return -1;
+    info = PyObject_CallMethod(codecs, "lookup", "O", termenc);
+    if (info == NULL)
+        goto finally;
+    name = PyObject_GetAttrString(info, "name");
+    if (name == NULL)
+        goto finally;
+    if (!PyString_Check(name) || strcmp(PyString_AS_STRING(name), "utf-8")) {
+        factory = PyObject_CallMethod(codecs, "getincrementaldecoder",
+                                      "O", termenc);
+        if (factory == NULL)
+            goto finally;
+        decoder = PyObject_CallFunction(factory, "s", "replace");
+        if (decoder == NULL)
+            goto finally;
+    }
+    Py_XDECREF(self->decoder);
+    self->decoder = decoder;
+    Py_CLEAR(self->pending);
+    self->byruns = decoder != NULL
+        && PyObject_TypeCheck(self, &EUCScannerType)
+        && is_run_decoded(PyString_AS_STRING(name));
+    self->held = 0;
+    Py_INCREF(termenc);
+    Py_XDECREF(self->termenc);
+    self->termenc = termenc;
+    result = 0;
+
+finally:
+    Py_DECREF(codecs);
+    Py_XDECREF(info);
+    Py_XDECREF(name);
+    Py_XDECREF(factory);
+    return result;
+}
+
+static PyObject *
+scanner_decode_utf8(ScannerObject *self, PyObject *value)
+{
+    Py_buffer view;
+    PyObject *joined = NULL;
+    PyObject *result;
+    const char *s;
+    Py_ssize_t length;
+    Py_ssize_t consumed = 0;
+
+    if (PyObject_GetBuffer(value, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    s = view.buf;
+    length = view.len;
+    if (self->pending != NULL) {
+        joined = PyString_FromStringAndSize(NULL,
+                                            PyString_GET_SIZE(self->pending)
+                                            + length);
+        if (joined == NULL) {
+            PyBuffer_Release(&view);
+            return NULL;
+        }
+        memcpy(PyString_AS_STRING(joined),
+               PyString_AS_STRING(self->pending),
+               PyString_GET_SIZE(self->pending));
+        memcpy(PyString_AS_STRING(joined) + PyString_GET_SIZE(self->pending),
+               s, length);
+        s = PyString_AS_STRING(joined);
+        length = PyString_GET_SIZE(joined);
+        Py_CLEAR(self->pending);
+    }
+    result = PyUnicode_DecodeUTF8Stateful(s, length, "replace", &consumed);
+    if (result != NULL && consumed < length) {
+        self->pending = PyString_FromStringAndSize(s + consumed,
+                                                   length - consumed);
+        if (self->pending == NULL)
+            Py_CLEAR(result);
+    }
+    Py_XDECREF(joined);
+    PyBuffer_Release(&view);
+    return result;
+}
+
+/* the incremental decoders of Python 2 take str only, copy the bytes of
+   other buffer objects (e.g. a memoryview of the PTY buffer) */
+static PyObject *
+scanner_decode_buffer(ScannerObject *self, PyObject *value)
+{
+    Py_buffer view;
+    PyObject *bytes;
+    PyObject *result;
+
+    if (PyString_Check(value) || !PyObject_CheckBuffer(value))
+        return PyObject_CallMethod(self->decoder, "decode", "O", value);
+    if (PyObject_GetBuffer(value, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    bytes = PyString_FromStringAndSize(view.buf, view.len);
+    PyBuffer_Release(&view);
+    if (bytes == NULL)
+        return NULL;
+    result = PyObject_CallMethod(self->decoder, "decode", "O", bytes);
+    Py_DECREF(bytes);
+    return result;
+}
+
+/* copy the runs of ASCII bytes as they are, and decode the runs of
+   non-ASCII bytes. An incomplete character left in the decoder in front
+   of an ASCII byte is replaced by flushing the decoder */
+static PyObject *
+scanner_decode_runs(ScannerObject *self, PyObject *value)
+{
+    Py_buffer view;
+    PyObject *pieces;
+    PyObject *piece;
+    PyObject *result = NULL;
+    const unsigned char *s;
+    Py_ssize_t length;
+    Py_ssize_t pos = 0;
+    Py_ssize_t end;
+
+    if (PyObject_GetBuffer(value, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    s = view.buf;
+    length = view.len;
+    pieces = PyList_New(0);
+    if (pieces == NULL)
+        goto finally;
+    while (pos < length) {
+        end = pos;
+        if (s[pos] < 0x80) {
+            if (self->held) {
+                piece = PyObject_CallMethod(self->decoder, "decode", "si",
+                                            "", 1);
+                if (piece == NULL || PyList_Append(pieces, piece) < 0)
+                    goto error;
+                Py_DECREF(piece);
+                self->held = 0;
+            }
+            while (end < length && s[end] < 0x80)
+                ++end;
+            piece = PyUnicode_DecodeASCII((const char *)s + pos, end - pos,
+                                          NULL);
+        } else {
+            while (end < length && s[end] >= 0x80)
+                ++end;
+            piece = PyObject_CallMethod(self->decoder, "decode", "s#",
+                                        (const char *)s + pos, end - pos);
+            self->held = 1;
+        }
+        if (piece == NULL || PyList_Append(pieces, piece) < 0)
+            goto error;
+        Py_DECREF(piece);
+        pos = end;
+    }
+    if (PyList_GET_SIZE(pieces) == 1) {
+        result = PyList_GET_ITEM(pieces, 0);
+        Py_INCREF(result);
+    } else {
+        piece = PyUnicode_FromUnicode(NULL, 0);
+        if (piece != NULL) {
+            result = PyUnicode_Join(piece, pieces);
+            Py_DECREF(piece);
+        }
+    }
+    goto finally;
+
+error:
+    Py_XDECREF(piece);
+
+finally:
+    Py_XDECREF(pieces);
+    PyBuffer_Release(&view);
+    return result;
+}
+
+static int
+scanner_decode(ScannerObject *self, PyObject *value)
+{
+    PyObject *data;
+
+    if (self->byruns)
+        data = scanner_decode_runs(self, value);
+    else if (self->decoder != NULL)
+        data = scanner_decode_buffer(self, value);
+    else
+        data = scanner_decode_utf8(self, value);
+    if (data == NULL)
+        return -1;
+    if (!PyUnicode_Check(data)) {
+        PyErr_SetString(PyExc_TypeError, "decoder must return unicode");
+        Py_DECREF(data);
+        return -1;
+    }
+    Py_XDECREF(self->data);
+    self->data = data;
+    return 0;
+}
+
+static int
+scanner_init(ScannerObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"ucs4", "termenc", NULL};
+    PyObject *ucs4 = Py_True;
+    PyObject *termenc = Py_None;
+    int flag;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|OO:DefaultScanner",
+                                     kwlist, &ucs4, &termenc))
+        return -1;
+    flag = PyObject_IsTrue(ucs4);
+    if (flag < 0)
+        return -1;
+    self->ucs4 = (char)flag;
+    Py_CLEAR(self->data);
+    if (termenc != Py_None && PyObject_IsTrue(termenc))
+        return scanner_setencoding(self, termenc);
+    return 0;
+}
+
+static int
+scanner_traverse(ScannerObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->data);
+    Py_VISIT(self->termenc);
+    Py_VISIT(self->decoder);
+    Py_VISIT(self->pending);
+    return 0;
+}
+
+static int
+scanner_clear(ScannerObject *self)
+{
+    Py_CLEAR(self->data);
+    Py_CLEAR(self->termenc);
+    Py_CLEAR(self->decoder);
+    Py_CLEAR(self->pending);
+    return 0;
+}
+
+static void
+scanner_dealloc(ScannerObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    scanner_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+PyDoc_STRVAR(scanner_assign_doc,
+"assign(value, termenc)\n\ndecode value and prepare to iterate it");
+
+static PyObject *
+scanner_assign(ScannerObject *self, PyObject *args)
+{
+    PyObject *value;
+    PyObject *termenc;
+    int same = 0;
+
+    if (!PyArg_ParseTuple(args, "OO:assign", &value, &termenc))
+        return NULL;
+    if (self->termenc != NULL) {
+        same = PyObject_RichCompareBool(self->termenc, termenc, Py_EQ);
+        if (same < 0)
+            return NULL;
+    }
+    if (!same && scanner_setencoding(self, termenc) < 0)
+        return NULL;
+    if (scanner_decode(self, value) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(scanner_continuous_assign_doc,
+"continuous_assign(value)\n\ndecode value with the current encoding");
+
+static PyObject *
+scanner_continuous_assign(ScannerObject *self, PyObject *value)
+{
+    if (self->termenc == NULL) {
+        PyErr_SetString(PyExc_ValueError, "termenc is not specified");
+        return NULL;
+    }
+    if (scanner_decode(self, value) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+scanner_iter(ScannerObject *self)
+{
+    ScannerIterObject *it;
+
+    if (self->data == NULL) {
+        PyErr_SetString(PyExc_TypeError, "no data is assigned");
+        return NULL;
+    }
+    it = PyObject_New(ScannerIterObject, &ScannerIterType);
+    if (it == NULL)
+        return NULL;
+    Py_INCREF(self->data);
+    it->data = self->data;
+    it->pos = 0;
+    it->start = 0;
+    it->c1 = 0;
+    it->ucs4 = self->ucs4;
+    return (PyObject *)it;
+}
+
+static PyMethodDef scanner_methods[] = {
+    {"assign", (PyCFunction)scanner_assign,
+     METH_VARARGS, scanner_assign_doc},
+    {"continuous_assign", (PyCFunction)scanner_continuous_assign,
+     METH_O, scanner_continuous_assign_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyMemberDef scanner_members[] = {
+    {"_data", T_OBJECT, offsetof(ScannerObject, data), READONLY, NULL},
+    {"_termenc", T_OBJECT, offsetof(ScannerObject, termenc), READONLY, NULL},
+    {"_ucs4", T_BOOL, offsetof(ScannerObject, ucs4), READONLY, NULL},
+    {NULL, 0, 0, 0, NULL}
+};
+
+PyDoc_STRVAR(scanner_doc,
+"DefaultScanner(ucs4=True, termenc=None)\n\n"
+"scan input stream and iterate UCS code points");
+
+static PyTypeObject ScannerType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_tff.DefaultScanner",                      /* tp_name */
+    sizeof(ScannerObject),                      /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor)scanner_dealloc,                /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+    scanner_doc,                                /* tp_doc */
+    (traverseproc)scanner_traverse,             /* tp_traverse */
+    (inquiry)scanner_clear,                     /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    (getiterfunc)scanner_iter,                  /* tp_iter */
+    0,                                          /* tp_iternext */
+    scanner_methods,                            /* tp_methods */
+    scanner_members,                            /* tp_members */
+    0,                                          /* tp_getset */
+    0,                                          /* tp_base */
+    0,                                          /* tp_dict */
+    0,                                          /* tp_descr_get */
+    0,                                          /* tp_descr_set */
+    0,                                          /* tp_dictoffset */
+    (initproc)scanner_init,                     /* tp_init */
+    0,                                          /* tp_alloc */
+    PyType_GenericNew,                          /* tp_new */
+    0,                                          /* tp_free */
+    0,                                          /* tp_is_gc */
+    0,                                          /* tp_bases */
+    0,                                          /* tp_mro */
+    0,                                          /* tp_cache */
+    0,                                          /* tp_subclasses */
+    0,                                          /* tp_weaklist */
+    0,                                          /* tp_del */
+    0,                                          /* tp_version_tag */
+};
+
+PyDoc_STRVAR(eucscanner_doc,
+"EUCScanner(ucs4=True, termenc=None)\n\n"
+"scan input stream and iterate UCS code points as DefaultScanner,\n"
+"but with the EUC encodings, never let a broken multibyte character\n"
+"take the ASCII byte which follows it (e.g. ESC)");
+
+static PyTypeObject EUCScannerType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_tff.EUCScanner",                          /* tp_name */
+    sizeof(ScannerObject),                      /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    0,                                          /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+    eucscanner_doc,                            /* tp_doc */
+    0,                                          /* tp_traverse */
+    0,                                          /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    0,                                          /* tp_iter */
+    0,                                          /* tp_iternext */
+    0,                                          /* tp_methods */
+    0,                                          /* tp_members */
+    0,                                          /* tp_getset */
+    0,                                          /* tp_base */
+    0,                                          /* tp_dict */
+    0,                                          /* tp_descr_get */
+    0,                                          /* tp_descr_set */
+    0,                                          /* tp_dictoffset */
+    0,                                          /* tp_init */
+    0,                                          /* tp_alloc */
+    0,                                          /* tp_new */
+    0,                                          /* tp_free */
+    0,                                          /* tp_is_gc */
+    0,                                          /* tp_bases */
+    0,                                          /* tp_mro */
+    0,                                          /* tp_cache */
+    0,                                          /* tp_subclasses */
+    0,                                          /* tp_weaklist */
+    0,                                          /* tp_del */
+    0,                                          /* tp_version_tag */
+};
+
+/* fetch the next code point, combining surrogate pairs as
+ * tff.DefaultScanner does. returns 0 at the end of the data. */
+static int
+scanneriter_fetch(ScannerIterObject *it, Py_UCS4 *pc)
+{
+    const Py_UNICODE *u = PyUnicode_AS_UNICODE(it->data);
+    Py_ssize_t length = PyUnicode_GET_SIZE(it->data);
+    Py_ssize_t start;
+    Py_UCS4 c;
+
+    while (it->pos < length) {
+        start = it->pos;
+        c = u[it->pos++];
+        if (it->ucs4 && c >= 0xd800 && c <= 0xdfff) {
+            if (c <= 0xdbff) {
+                it->c1 = c - 0xd800;
+                continue;
+            } else if (it->c1 != 0) {
+                c = 0x10000 + ((it->c1 << 10) | (c - 0xdc00));
+                it->c1 = 0;
+                start -= 1;
+            }
+        }
+        it->start = start;
+        *pc = c;
+        return 1;
+    }
+    return 0;
+}
+
+static PyObject *
+scanneriter_next(ScannerIterObject *it)
+{
+    Py_UCS4 c;
+
+    if (!scanneriter_fetch(it, &c))
+        return NULL;
+    return PyInt_FromLong(c);
+}
+
+PyDoc_STRVAR(scanneriter_send_doc,
+"send(pattern)\n\n"
+"answer the run which starts with the last yielded code point and\n"
+"continues as long as pattern matches, and skip over it");
+
+static PyObject *
+scanneriter_send(ScannerIterObject *it, PyObject *pattern)
+{
+    PyObject *match;
+    PyObject *end;
+    PyObject *run;
+    Py_ssize_t pos;
+
+    if (pattern == Py_None) {
+        run = scanneriter_next(it);
+        if (run == NULL && !PyErr_Occurred())
+            PyErr_SetNone(PyExc_StopIteration);
+        return run;
+    }
+    match = PyObject_CallMethod(pattern, "match", "On", it->data, it->pos);
+    if (match == NULL)
+        return NULL;
+    end = PyObject_CallMethod(match, "end", NULL);
+    Py_DECREF(match);
+    if (end == NULL)
+        return NULL;
+    pos = PyInt_AsSsize_t(end);
+    Py_DECREF(end);
+    if (pos == -1 && PyErr_Occurred())
+        return NULL;
+    run = PyUnicode_FromUnicode(PyUnicode_AS_UNICODE(it->data) + it->start,
+                                pos - it->start);
+    if (run != NULL)
+        it->pos = pos;
+    return run;
+}
+
+static void
+scanneriter_dealloc(ScannerIterObject *it)
+{
+    Py_XDECREF(it->data);
+    PyObject_Del(it);
+}
+
+static PyMethodDef scanneriter_methods[] = {
+    {"send", (PyCFunction)scanneriter_send, METH_O, scanneriter_send_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject ScannerIterType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_tff.scanneriterator",                     /* tp_name */
+    sizeof(ScannerIterObject),                  /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor)scanneriter_dealloc,            /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                         /* tp_flags */
+    0,                                          /* tp_doc */
+    0,                                          /* tp_traverse */
+    0,                                          /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    PyObject_SelfIter,                          /* tp_iter */
+    (iternextfunc)scanneriter_next,             /* tp_iternext */
+    scanneriter_methods,                        /* tp_methods */
+    0,                                          /* tp_members */
+    0,                                          /* tp_getset */
+    0,                                          /* tp_base */
+    0,                                          /* tp_dict */
+    0,                                          /* tp_descr_get */
+    0,                                          /* tp_descr_set */
+    0,                                          /* tp_dictoffset */
+    0,                                          /* tp_init */
+    0,                                          /* tp_alloc */
+    0,                                          /* tp_new */
+    0,                                          /* tp_free */
+    0,                                          /* tp_is_gc */
+    0,                                          /* tp_bases */
+    0,                                          /* tp_mro */
+    0,                                          /* tp_cache */
+    0,                                          /* tp_subclasses */
+    0,                                          /* tp_weaklist */
+    0,                                          /* tp_del */
+    0,                                          /* tp_version_tag */
+};
+
+
+/***************************************************************************
+ *
+ * DefaultParser
+ *
+ */
+enum {
+    DISPATCH_CHAR,
+    DISPATCH_TEXT,
+    DISPATCH_ESC,
+    DISPATCH_CSI,
+    DISPATCH_SS2,
+    DISPATCH_SS3,
+    DISPATCH_CONTROL_STRING,
+    DISPATCH_CONTROL_STRING_START,
+    DISPATCH_CONTROL_STRING_DATA,
+    DISPATCH_CONTROL_STRING_END,
+    DISPATCH_INVALID,
+    DISPATCH_COUNT
+};
+
+static const char *dispatch_names[DISPATCH_COUNT] = {
+    "dispatch_char",
+    "dispatch_text",
+    "dispatch_esc",
+    "dispatch_csi",
+    "dispatch_ss2",
+    "dispatch_ss3",
+    "dispatch_control_string",
+    "dispatch_control_string_start",
+    "dispatch_control_string_data",
+    "dispatch_control_string_end",
+    "dispatch_invalid",
+};
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *context;
+    PyObject *methods[DISPATCH_COUNT];  /* bound dispatch_* of context */
+    int state;
+    int streaming;  /* context.streams_control_string() */
+    codebuf pbytes;
+    codebuf ibytes;
+    /* the buffer being walked by parser_parse_buffer (or NULL), the span of
+     * the current code point in it, and where the current sequence starts
+     * (or -1 if it did not start with ESC in this buffer) */
+    const Py_UNICODE *buffer;
+    Py_ssize_t start;
+    Py_ssize_t end;
+    Py_ssize_t seqstart;
+} ParserObject;
+
+static const Py_UCS4 seq_esc[] = {0x1b};
+static const Py_UCS4 seq_csi[] = {0x1b, 0x5b};
+static const Py_UCS4 seq_ss2[] = {0x1b, 0x4e};
+static const Py_UCS4 seq_ss3[] = {0x1b, 0x4f};
+
+static void
+parser_clear_methods(ParserObject *self)
+{
+    int i;
+
+    for (i = 0; i < DISPATCH_COUNT; ++i)
+        Py_CLEAR(self->methods[i]);
+}
+
+/* call context.dispatch_xxx with nargs arguments, steals the arguments */
+static int
+parser_dispatch4(ParserObject *self, int which, int nargs,
+                 PyObject *arg1, PyObject *arg2, PyObject *arg3,
+                 PyObject *arg4)
+{
+    PyObject *args[4];
+    PyObject *method = self->methods[which];
+    PyObject *result = NULL;
+    int i;
+
+    args[0] = arg1;
+    args[1] = arg2;
+    args[2] = arg3;
+    args[3] = arg4;
+    for (i = 0; i < nargs; ++i) {
+        if (args[i] == NULL)
+            goto finally;
+    }
+    if (method == NULL) {
+        if (self->context == NULL) {
+            PyErr_SetString(PyExc_AttributeError,
+                            "parser is not initialized");
+            goto finally;
+        }
+        method = PyObject_GetAttrString(self->context, dispatch_names[which]);
+        if (method == NULL)
+            goto finally;
+        self->methods[which] = method;
+    }
+    result = PyObject_CallFunctionObjArgs(method, arg1, arg2, arg3, arg4,
+                                          NULL);
+
+finally:
+    for (i = 0; i < nargs; ++i)
+        Py_XDECREF(args[i]);
+    if (result == NULL)
+        return -1;
+    Py_DECREF(result);
+    return 0;
+}
+
+static int
+parser_dispatch(ParserObject *self, int which, int nargs,
+                PyObject *arg1, PyObject *arg2, PyObject *arg3)
+{
+    return parser_dispatch4(self, which, nargs, arg1, arg2, arg3, NULL);
+}
+
+/* the source text of the sequence which ends with the current code point,
+ * if it is in the current buffer and consists of exactly the given number
+ * of characters (the sequence was not interrupted by control characters).
+ * otherwise None. */
+static PyObject *
+parser_source(ParserObject *self, Py_ssize_t length, Py_UNICODE last)
+{
+    const Py_UNICODE *u;
+
+    if (self->buffer == NULL || self->seqstart < 0
+        || self->end - self->seqstart != length)
+        goto none;
+    u = self->buffer + self->seqstart;
+    if (u[0] != 0x1b || u[length - 1] != last)
+        goto none;
+    return PyUnicode_FromUnicode(u, length);
+
+none:
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static int
+parser_dispatch_char(ParserObject *self, Py_UCS4 c)
+{
+    return parser_dispatch(self, DISPATCH_CHAR, 1,
+                           PyInt_FromLong(c), NULL, NULL);
+}
+
+/* dispatch_invalid(head + pbytes? + ibytes? + tail) */
+static int
+parser_dispatch_invalid(ParserObject *self,
+                        const Py_UCS4 *head, Py_ssize_t headlen,
+                        int with_pbytes, int with_ibytes,
+                        const Py_UCS4 *tail, Py_ssize_t taillen)
+{
+    segment segments[4];
+    int count = 0;
+
+    segments[count].items = head;
+    segments[count++].length = headlen;
+    if (with_pbytes) {
+        segments[count].items = self->pbytes.items;
+        segments[count++].length = self->pbytes.length;
+    }
+    if (with_ibytes) {
+        segments[count].items = self->ibytes.items;
+        segments[count++].length = self->ibytes.length;
+    }
+    segments[count].items = tail;
+    segments[count++].length = taillen;
+    return parser_dispatch(self, DISPATCH_INVALID, 1,
+                           make_list(segments, count), NULL, NULL);
+}
+
+static int
+parser_dispatch_esc(ParserObject *self, Py_UCS4 c)
+{
+    return parser_dispatch(self, DISPATCH_ESC, 3,
+                           codebuf_to_list(&self->ibytes),
+                           PyInt_FromLong(c),
+                           parser_source(self, self->ibytes.length + 2, c));
+}
+
+static int
+parser_dispatch_csi(ParserObject *self, Py_UCS4 c)
+{
+    Py_ssize_t length = self->pbytes.length + self->ibytes.length + 3;
+
+    return parser_dispatch4(self, DISPATCH_CSI, 4,
+                            codebuf_to_list(&self->pbytes),
+                            codebuf_to_list(&self->ibytes),
+                            PyInt_FromLong(c),
+                            parser_source(self, length, c));
+}
+
+static int
+parser_dispatch_single_shift(ParserObject *self, int which, Py_UCS4 c)
+{
+    return parser_dispatch(self, which, 2, PyInt_FromLong(c),
+                           parser_source(self, 3, c), NULL);
+}
+
+/* the source is given only if the string is terminated by ESC \ */
+static int
+parser_dispatch_control_string(ParserObject *self)
+{
+    return parser_dispatch(self, DISPATCH_CONTROL_STRING, 3,
+                           PyInt_FromLong(self->pbytes.items[0]),
+                           codebuf_to_list(&self->ibytes),
+                           parser_source(self, self->ibytes.length + 4,
+                                         0x5c));
+}
+
+/* entering STATE_OSC or STATE_STR */
+static int
+parser_enter_string(ParserObject *self, int state, Py_UCS4 c)
+{
+    self->pbytes.length = 0;
+    self->state = state;
+    if (codebuf_append(&self->pbytes, c) < 0)
+        return -1;
+    if (!self->streaming)
+        return 0;
+    return parser_dispatch(self, DISPATCH_CONTROL_STRING_START, 1,
+                           PyInt_FromLong(c), NULL, NULL);
+}
+
+/* dispatch the value of the streamed control string read so far */
+static int
+parser_dispatch_string_data(ParserObject *self)
+{
+    if (self->ibytes.length == 0)
+        return 0;
+    if (parser_dispatch(self, DISPATCH_CONTROL_STRING_DATA, 1,
+                        codebuf_to_unicode(&self->ibytes), NULL, NULL) < 0)
+        return -1;
+    self->ibytes.length = 0;
+    return 0;
+}
+
+/* append a code point to the value of the control string */
+static int
+parser_append_string(ParserObject *self, Py_UCS4 c)
+{
+    if (codebuf_append(&self->ibytes, c) < 0)
+        return -1;
+    if (self->streaming && self->ibytes.length >= STRING_CHUNK)
+        return parser_dispatch_string_data(self);
+    return 0;
+}
+
+/* the control string is terminated by ST (abort == NULL) or cut off by
+ * the code points of abort */
+static int
+parser_end_string(ParserObject *self, const Py_UCS4 *abort,
+                  Py_ssize_t abortlen)
+{
+    segment s;
+
+    if (!self->streaming) {
+        if (abort == NULL)
+            return parser_dispatch_control_string(self);
+        return parser_dispatch_invalid(self, seq_esc, 1, 1, 1,
+                                       abort, abortlen);
+    }
+    if (parser_dispatch_string_data(self) < 0)
+        return -1;
+    if (abort == NULL) {
+        Py_INCREF(Py_None);
+        return parser_dispatch(self, DISPATCH_CONTROL_STRING_END, 1,
+                               Py_None, NULL, NULL);
+    }
+    s.items = abort;
+    s.length = abortlen;
+    return parser_dispatch(self, DISPATCH_CONTROL_STRING_END, 1,
+                           make_list(&s, 1), NULL, NULL);
+}
+
+/* append a parameter or intermediate byte of a sequence, or ignore the
+ * sequence (enter the state ignore) if it gets too long */
+static int
+parser_collect(ParserObject *self, codebuf *buf, Py_UCS4 c, int ignore)
+{
+    if (buf->length >= SEQUENCE_LIMIT) {
+        self->state = ignore;
+        return 0;
+    }
+    return codebuf_append(buf, c);
+}
+
+/* entering STATE_ESC, a new sequence may start here */
+static void
+parser_enter_esc(ParserObject *self)
+{
+    self->ibytes.length = 0;
+    self->state = STATE_ESC;
+    self->seqstart = self->buffer == NULL ? -1 : self->start;
+}
+
+/* feed one code point to the state machine, same as the body of the loop
+ * in tff.DefaultParser.parse */
+static int
+parser_feed(ParserObject *self, Py_UCS4 c)
+{
+    Py_UCS4 tail[2];
+
+    switch (self->state) {
+
+    case STATE_GROUND:
+        if (c == 0x1b) {  /* ESC */
+            parser_enter_esc(self);
+            return 0;
+        }
+        return parser_dispatch_char(self, c);
+
+    case STATE_ESC:
+        if (c == 0x5b) {  /* [ */
+            self->pbytes.length = 0;
+            self->state = STATE_CSI_PARAMETER;
+        } else if (c == 0x5d) {  /* ] */
+            return parser_enter_string(self, STATE_OSC, c);
+        } else if (c == 0x4e) {  /* N */
+            self->state = STATE_SS2;
+        } else if (c == 0x4f) {  /* O */
+            self->state = STATE_SS3;
+        } else if (c == 0x50 || c == 0x58 || c == 0x5e || c == 0x5f) {
+            /* P(DCS) or X(SOS) or ^(PM) or _(APC) */
+            return parser_enter_string(self, STATE_STR, c);
+        } else if (c < 0x20) {  /* control character */
+            if (c == 0x1b) {
+                parser_enter_esc(self);
+                return parser_dispatch_invalid(self, seq_esc, 1,
+                                               0, 0, NULL, 0);
+            } else if (c == 0x18 || c == 0x1a) {
+                self->state = STATE_GROUND;
+                if (parser_dispatch_invalid(self, seq_esc, 1,
+                                            0, 0, NULL, 0) < 0)
+                    return -1;
+            }
+            return parser_dispatch_char(self, c);
+        } else if (c <= 0x2f) {  /* SP to / */
+            self->state = STATE_ESC_INTERMEDIATE;
+            return parser_collect(self, &self->ibytes, c, STATE_ESC_IGNORE);
+        } else if (c <= 0x7e) {  /* ~ */
+            self->state = STATE_GROUND;
+            return parser_dispatch_esc(self, c);
+        } else if (c == 0x7f) {  /* control character */
+            return parser_dispatch_char(self, c);
+        } else {
+            self->state = STATE_GROUND;
+            tail[0] = c;
+            return parser_dispatch_invalid(self, seq_esc, 1, 0, 0, tail, 1);
+        }
+        return 0;
+
+    case STATE_CSI_PARAMETER:
+        /* CSI P ... P I ... I F
+         *     ^
+         */
+        if (c > 0x7e) {
+            if (c == 0x7f)  /* control character */
+                return parser_dispatch_char(self, c);
+            self->state = STATE_GROUND;
+            return parser_dispatch_invalid(self, seq_csi, 2, 1, 0, NULL, 0);
+        } else if (c > 0x3f) {  /* Final byte, @ to ~ */
+            self->state = STATE_GROUND;
+            return parser_dispatch_csi(self, c);
+        } else if (c > 0x2f) {  /* parameter, 0 to ? */
+            return parser_collect(self, &self->pbytes, c, STATE_CSI_IGNORE);
+        } else if (c > 0x1f) {  /* intermediate, SP to / */
+            self->state = STATE_CSI_INTERMEDIATE;
+            return parser_collect(self, &self->ibytes, c, STATE_CSI_IGNORE);
+        } else if (c == 0x1b) {  /* ESC */
+            if (parser_dispatch_invalid(self, seq_csi, 2, 1, 0, NULL, 0) < 0)
+                return -1;
+            parser_enter_esc(self);
+            return 0;
+        } else if (c == 0x18 || c == 0x1a) {  /* CAN, SUB */
+            self->state = STATE_GROUND;
+            if (parser_dispatch_invalid(self, seq_csi, 2, 1, 0, NULL, 0) < 0)
+                return -1;
+        }
+        return parser_dispatch_char(self, c);
+
+    case STATE_CSI_INTERMEDIATE:
+        /* CSI P ... P I ... I F
+         *             ^
+         */
+        if (c > 0x7e) {
+            if (c == 0x7f)  /* control character */
+                return parser_dispatch_char(self, c);
+            self->state = STATE_GROUND;
+            return parser_dispatch_invalid(self, seq_csi, 2, 1, 1, NULL, 0);
+        } else if (c > 0x3f) {  /* Final byte, @ to ~ */
+            self->state = STATE_GROUND;
+            return parser_dispatch_csi(self, c);
+        } else if (c > 0x2f) {
+            self->state = STATE_GROUND;
+            tail[0] = c;
+            return parser_dispatch_invalid(self, seq_csi, 2, 1, 1, tail, 1);
+        } else if (c > 0x1f) {  /* intermediate, SP to / */
+            return parser_collect(self, &self->ibytes, c, STATE_CSI_IGNORE);
+        } else if (c == 0x1b) {  /* ESC */
+            if (parser_dispatch_invalid(self, seq_csi, 2, 1, 1, NULL, 0) < 0)
+                return -1;
+            parser_enter_esc(self);
+            return 0;
+        } else if (c == 0x18 || c == 0x1a) {  /* CAN, SUB */
+            self->state = STATE_GROUND;
+            if (parser_dispatch_invalid(self, seq_csi, 2, 1, 1, NULL, 0) < 0)
+                return -1;
+        }
+        return parser_dispatch_char(self, c);
+
+    case STATE_ESC_INTERMEDIATE:
+        if (c > 0x7e) {
+            if (c == 0x7f)  /* control character */
+                return parser_dispatch_char(self, c);
+            self->state = STATE_GROUND;
+            tail[0] = c;
+            return parser_dispatch_invalid(self, seq_esc, 1, 0, 1, tail, 1);
+        } else if (c > 0x2f) {  /* 0 to ~, Final byte */
+            self->state = STATE_GROUND;
+            return parser_dispatch_esc(self, c);
+        } else if (c > 0x1f) {  /* SP to / */
+            return parser_collect(self, &self->ibytes, c, STATE_ESC_IGNORE);
+        } else if (c == 0x1b) {  /* ESC */
+            if (parser_dispatch_invalid(self, seq_esc, 1, 0, 1, NULL, 0) < 0)
+                return -1;
+            parser_enter_esc(self);
+            return 0;
+        } else if (c == 0x18 || c == 0x1a) {  /* CAN, SUB */
+            self->state = STATE_GROUND;
+            if (parser_dispatch_invalid(self, seq_esc, 1, 0, 1, NULL, 0) < 0)
+                return -1;
+        }
+        return parser_dispatch_char(self, c);
+
+    case STATE_CSI_IGNORE:
+    case STATE_ESC_IGNORE:
+        /* skip the rest of a too long sequence */
+        if (c > 0x7e) {
+            if (c == 0x7f)  /* control character */
+                return parser_dispatch_char(self, c);
+            self->state = STATE_GROUND;
+        } else if (c > 0x3f
+                   || (c > 0x2f && self->state == STATE_ESC_IGNORE)) {
+            self->state = STATE_GROUND;  /* Final byte */
+        } else if (c > 0x1f) {
+            /* parameter or intermediate byte, skipped */
+        } else if (c == 0x1b) {  /* ESC */
+            parser_enter_esc(self);
+        } else {
+            if (c == 0x18 || c == 0x1a)  /* CAN, SUB */
+                self->state = STATE_GROUND;
+            return parser_dispatch_char(self, c);
+        }
+        return 0;
+
+    case STATE_OSC:
+    case STATE_STR:
+        /* 00/08 - 00/13, 02/00 - 07/14 */
+        if (c == 0x07 && self->state == STATE_OSC) {
+            self->state = STATE_GROUND;
+            return parser_end_string(self, NULL, 0);
+        } else if (c < 0x08 || (c > 0x0d && c < 0x20 && c != 0x1b)) {
+            self->state = STATE_GROUND;
+            tail[0] = c;
+            return parser_end_string(self, tail, 1);
+        } else if (c == 0x1b) {
+            self->state = self->state == STATE_OSC ? STATE_OSC_ESC
+                                                   : STATE_STR_ESC;
+            return 0;
+        }
+        return parser_append_string(self, c);
+
+    case STATE_OSC_ESC:
+    case STATE_STR_ESC:
+        self->state = STATE_GROUND;
+        if (c == 0x5c)  /* \ */
+            return parser_end_string(self, NULL, 0);
+        tail[0] = 0x1b;
+        tail[1] = c;
+        return parser_end_string(self, tail, 2);
+
+    case STATE_SS2:
+    case STATE_SS3:
+        if (c < 0x20) {  /* control character */
+            const Py_UCS4 *seq = self->state == STATE_SS2 ? seq_ss2 : seq_ss3;
+            if (c == 0x1b) {  /* ESC */
+                if (parser_dispatch_invalid(self, seq, 2, 0, 0, NULL, 0) < 0)
+                    return -1;
+                parser_enter_esc(self);
+                return 0;
+            } else if (c == 0x18 || c == 0x1a) {
+                self->state = STATE_GROUND;
+                if (parser_dispatch_invalid(self, seq, 2, 0, 0, NULL, 0) < 0)
+                    return -1;
+            }
+            return parser_dispatch_char(self, c);
+        } else if (c < 0x7f) {
+            int which = self->state == STATE_SS2 ? DISPATCH_SS2
+                                                 : DISPATCH_SS3;
+            self->state = STATE_GROUND;
+            return parser_dispatch_single_shift(self, which, c);
+        }
+        /* tff.DefaultParser reports "ESC O" for both SS2 and SS3 here */
+        if (parser_dispatch_invalid(self, seq_ss3, 2, 0, 0, NULL, 0) < 0)
+            return -1;
+        return parser_dispatch_char(self, c);
+    }
+    return 0;
+}
+
+static int
+parser_init(ParserObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, ":DefaultParser", kwlist))
+        return -1;
+    self->state = STATE_GROUND;
+    self->streaming = 0;
+    self->pbytes.length = 0;
+    self->ibytes.length = 0;
+    self->buffer = NULL;
+    self->seqstart = -1;
+    return 0;
+}
+
+static int
+parser_traverse(ParserObject *self, visitproc visit, void *arg)
+{
+    int i;
+
+    Py_VISIT(self->context);
+    for (i = 0; i < DISPATCH_COUNT; ++i)
+        Py_VISIT(self->methods[i]);
+    return 0;
+}
+
+static int
+parser_clear(ParserObject *self)
+{
+    Py_CLEAR(self->context);
+    parser_clear_methods(self);
+    return 0;
+}
+
+static void
+parser_dealloc(ParserObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    parser_clear(self);
+    codebuf_free(&self->pbytes);
+    codebuf_free(&self->ibytes);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+PyDoc_STRVAR(parser_init_context_doc,
+"init(context)\n\nset the context to which events are dispatched");
+
+static PyObject *
+parser_init_context(ParserObject *self, PyObject *context)
+{
+    parser_clear_methods(self);
+    Py_INCREF(context);
+    Py_XDECREF(self->context);
+    self->context = context;
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(parser_state_is_esc_doc,
+"state_is_esc()\n\ntest whether the parser is in the middle of a sequence");
+
+static PyObject *
+parser_state_is_esc(ParserObject *self)
+{
+    return PyBool_FromLong(self->state != STATE_GROUND);
+}
+
+PyDoc_STRVAR(parser_flush_doc,
+"flush()\n\ndispatch the pending sequence");
+
+static PyObject *
+parser_flush(ParserObject *self)
+{
+    int result = 0;
+
+    switch (self->state) {
+    case STATE_ESC:
+        result = parser_dispatch_char(self, 0x1b);
+        break;
+    case STATE_ESC_INTERMEDIATE:
+        result = parser_dispatch_invalid(self, seq_esc, 1, 0, 1, NULL, 0);
+        break;
+    case STATE_CSI_INTERMEDIATE:
+        result = parser_dispatch_invalid(self, seq_csi, 2, 0, 1, NULL, 0);
+        break;
+    case STATE_CSI_PARAMETER: {
+        /* tff.DefaultParser puts the intermediate bytes first here */
+        segment segments[3];
+        segments[0].items = seq_csi;
+        segments[0].length = 2;
+        segments[1].items = self->ibytes.items;
+        segments[1].length = self->ibytes.length;
+        segments[2].items = self->pbytes.items;
+        segments[2].length = self->pbytes.length;
+        result = parser_dispatch(self, DISPATCH_INVALID, 1,
+                                 make_list(segments, 3), NULL, NULL);
+        break;
+    }
+    }
+    if (result < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(parser_reset_doc, "reset()\n\nreturn to the ground state");
+
+static PyObject *
+parser_reset(ParserObject *self)
+{
+    self->state = STATE_GROUND;
+    self->pbytes.length = 0;
+    self->ibytes.length = 0;
+    Py_RETURN_NONE;
+}
+
+/* walk the buffer of our own scanner without creating int objects */
+static int
+parser_parse_buffer(ParserObject *self, ScannerIterObject *it, int textrun)
+{
+    const Py_UNICODE *u = PyUnicode_AS_UNICODE(it->data);
+    Py_ssize_t length = PyUnicode_GET_SIZE(it->data);
+    Py_ssize_t end;
+    Py_UCS4 c;
+    int status = 0;
+
+    /* a sequence continued from the previous buffer has no source */
+    self->buffer = u;
+    self->seqstart = -1;
+    while (scanneriter_fetch(it, &c)) {
+        if (textrun && self->state == STATE_GROUND && IS_TEXT(c)) {
+            for (end = it->pos; end < length && IS_TEXT(u[end]); ++end)
+                ;
+            if (parser_dispatch(self, DISPATCH_TEXT, 1,
+                                PyUnicode_FromUnicode(u + it->start,
+                                                      end - it->start),
+                                NULL, NULL) < 0) {
+                status = -1;
+                break;
+            }
+            it->pos = end;
+            continue;
+        }
+        if (textrun && self->streaming && IS_PAYLOAD(c)
+            && (self->state == STATE_OSC || self->state == STATE_STR)) {
+            /* pass the run of the value through without copying it */
+            for (end = it->pos; end < length && IS_PAYLOAD(u[end]); ++end)
+                ;
+            if (parser_dispatch_string_data(self) < 0
+                || parser_dispatch(self, DISPATCH_CONTROL_STRING_DATA, 1,
+                                   PyUnicode_FromUnicode(u + it->start,
+                                                         end - it->start),
+                                   NULL, NULL) < 0) {
+                status = -1;
+                break;
+            }
+            it->pos = end;
+            continue;
+        }
+        self->start = it->start;
+        self->end = it->pos;
+        if (parser_feed(self, c) < 0) {
+            status = -1;
+            break;
+        }
+    }
+    self->buffer = NULL;
+    return status;
+}
+
+/* generic path for foreign scanners, one code point at a time.
+   printable code points in the ground state are gathered into text runs */
+static int
+parser_parse_iter(ParserObject *self, PyObject *it, int textrun)
+{
+    PyObject *item;
+    codebuf text = { NULL, 0, 0 };
+    long c;
+    int status = -1;
+
+    while ((item = PyIter_Next(it)) != NULL) {
+        c = PyInt_AsLong(item);
+        Py_DECREF(item);
+        if (c == -1 && PyErr_Occurred())
+            goto error;
+        if (textrun && self->state == STATE_GROUND && IS_TEXT(c)) {
+            if (codebuf_append(&text, (Py_UCS4)c) < 0)
+                goto error;
+            continue;
+        }
+        if (text.length > 0) {
+            if (parser_dispatch(self, DISPATCH_TEXT, 1,
+                                codebuf_to_unicode(&text), NULL, NULL) < 0)
+                goto error;
+            text.length = 0;
+        }
+        if (parser_feed(self, (Py_UCS4)c) < 0)
+            goto error;
+    }
+    if (PyErr_Occurred())
+        goto error;
+    if (text.length > 0
+        && parser_dispatch(self, DISPATCH_TEXT, 1,
+                           codebuf_to_unicode(&text), NULL, NULL) < 0)
+        goto error;
+    status = 0;
+error:
+    codebuf_free(&text);
+    return status;
+}
+
+PyDoc_STRVAR(parser_parse_doc,
+"parse(data)\n\nassign data to the context and dispatch the events");
+
+static PyObject *
+parser_parse(ParserObject *self, PyObject *data)
+{
+    PyObject *result;
+    PyObject *it;
+    int textrun;
+    int status;
+
+    if (self->context == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "parser is not initialized");
+        return NULL;
+    }
+    result = PyObject_CallMethod(self->context, "assign", "O", data);
+    if (result == NULL)
+        return NULL;
+    Py_DECREF(result);
+
+    it = PyObject_GetIter(self->context);
+    if (it == NULL)
+        return NULL;
+    result = PyObject_CallMethod(self->context, "has_textrun", NULL);
+    if (result == NULL) {
+        Py_DECREF(it);
+        return NULL;
+    }
+    textrun = PyObject_IsTrue(result);
+    Py_DECREF(result);
+    if (textrun < 0) {
+        Py_DECREF(it);
+        return NULL;
+    }
+    result = PyObject_CallMethod(self->context, "streams_control_string",
+                                 NULL);
+    if (result == NULL) {
+        Py_DECREF(it);
+        return NULL;
+    }
+    self->streaming = PyObject_IsTrue(result);
+    Py_DECREF(result);
+    if (self->streaming < 0)
+        status = -1;
+    else if (Py_TYPE(it) == &ScannerIterType)
+        status = parser_parse_buffer(self, (ScannerIterObject *)it, textrun);
+    else
+        status = parser_parse_iter(self, it, textrun);
+    /* hand over the value of the control string read so far */
+    if (status == 0 && self->streaming
+        && self->state >= STATE_OSC && self->state <= STATE_STR_ESC)
+        status = parser_dispatch_string_data(self);
+    Py_DECREF(it);
+    if (status < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef parser_methods[] = {
+    {"init", (PyCFunction)parser_init_context, METH_O,
+     parser_init_context_doc},
+    {"state_is_esc", (PyCFunction)(void(*)(void))parser_state_is_esc,
+     METH_NOARGS, parser_state_is_esc_doc},
+    {"flush", (PyCFunction)(void(*)(void))parser_flush, METH_NOARGS,
+     parser_flush_doc},
+    {"reset", (PyCFunction)(void(*)(void))parser_reset, METH_NOARGS,
+     parser_reset_doc},
+    {"parse", (PyCFunction)parser_parse, METH_O, parser_parse_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+PyDoc_STRVAR(parser_doc,
+"DefaultParser()\n\nparse ESC/CSI/string seqneces");
+
+static PyTypeObject ParserType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_tff.DefaultParser",                       /* tp_name */
+    sizeof(ParserObject),                       /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor)parser_dealloc,                 /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    0,                                          /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    0,                                          /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+    parser_doc,                                 /* tp_doc */
+    (traverseproc)parser_traverse,              /* tp_traverse */
+    (inquiry)parser_clear,                      /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    0,                                          /* tp_iter */
+    0,                                          /* tp_iternext */
+    parser_methods,                             /* tp_methods */
+    0,                                          /* tp_members */
+    0,                                          /* tp_getset */
+    0,                                          /* tp_base */
+    0,                                          /* tp_dict */
+    0,                                          /* tp_descr_get */
+    0,                                          /* tp_descr_set */
+    0,                                          /* tp_dictoffset */
+    (initproc)parser_init,                      /* tp_init */
+    0,                                          /* tp_alloc */
+    PyType_GenericNew,                          /* tp_new */
+    0,                                          /* tp_free */
+    0,                                          /* tp_is_gc */
+    0,                                          /* tp_bases */
+    0,                                          /* tp_mro */
+    0,                                          /* tp_cache */
+    0,                                          /* tp_subclasses */
+    0,                                          /* tp_weaklist */
+    0,                                          /* tp_del */
+    0,                                          /* tp_version_tag */
+};
+
+
+/***************************************************************************
+ *
+ * module
+ *
+ */
+PyDoc_STRVAR(module_doc,
+"C implementation of tff.DefaultScanner and tff.DefaultParser");
+
+static PyMethodDef module_methods[] = {
+    {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+init_tff(void)
+{
+    PyObject *m;
+
+    if (PyType_Ready(&ScannerType) < 0)
+        return;
+    EUCScannerType.tp_base = &ScannerType;
+    if (PyType_Ready(&EUCScannerType) < 0)
+        return;
+    if (PyType_Ready(&ScannerIterType) < 0)
+        return;
+    if (PyType_Ready(&ParserType) < 0)
+        return;
+
+    m = Py_InitModule3("_tff", module_methods, module_doc);
+    if (m == NULL)
+        return;
+
+    Py_INCREF(&ScannerType);
+    PyModule_AddObject(m, "DefaultScanner", (PyObject *)&ScannerType);
+    Py_INCREF(&EUCScannerType);
+    PyModule_AddObject(m, "EUCScanner", (PyObject *)&EUCScannerType);
+    Py_INCREF(&ParserType);
+    PyModule_AddObject(m, "DefaultParser", (PyObject *)&ParserType);
+}
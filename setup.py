@@ -20,7 +20,7 @@ setup(name                  = 'tff',
       description           = 'Terminal Filter Framework',
       long_description      = open(dirpath + "/README.rst").read(),
       py_modules            = ['tff'],
-      ext_modules           = [Extension('ctff', sources = ['ctff.c'], extra_compile_args = extra_args)],
+      ext_modules           = [Extension('_tff', sources = ['_tff.c'], extra_compile_args = extra_args)],
       eager_resources       = [],
       classifiers           = ['Development Status :: 4 - Beta',
                                'Topic :: Terminals',
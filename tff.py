@@ -40,8 +40,20 @@ import errno
 import codecs
 import threading
 import logging
+import re
+import io
+import time
+import heapq
+import json
+import stat
+import socket
+import unicodedata
+from array import array
+from itertools import islice
 
 _BUFFER_SIZE = 8192
+_READ_LIMIT = 262144  # max size of a batch read from the PTY
+_OUTPUT_HIGHWATER = 65536
 _ESC_TIMEOUT = 0.5  # sec
 
 
@@ -126,9 +138,24 @@ class EventObserver:
     def handle_control_string(self, context, prefix, value):
         raise NotImplementedError("EventObserver::handle_control_string")
 
+    # optional, handlers with handle_control_string_data receive the values
+    # of control strings in chunks instead of handle_control_string
+    def handle_control_string_start(self, context, prefix):
+        raise NotImplementedError("EventObserver::handle_control_string_start")
+
+    def handle_control_string_data(self, context, chunk):
+        raise NotImplementedError("EventObserver::handle_control_string_data")
+
+    def handle_control_string_end(self, context, valid):
+        raise NotImplementedError("EventObserver::handle_control_string_end")
+
     def handle_char(self, context, c):
         raise NotImplementedError("EventObserver::handle_char")
 
+    # optional, handlers without it receive text runs via handle_char
+    def handle_text(self, context, text):
+        raise NotImplementedError("EventObserver::handle_text")
+
     def handle_invalid(self, context, seq):
         raise NotImplementedError("EventObserver::handle_invalid")
 
@@ -167,20 +194,43 @@ class OutputStream:
 
 class EventDispatcher:
 
-    ''' Dispatch interface of terminal sequence event oriented parser '''
+    ''' Dispatch interface of terminal sequence event oriented parser
 
-    def dispatch_esc(self, prefix, final):
+        Parsers may give the source text of a sequence (its exact span in
+        the input) to dispatch_esc/csi/ss2/ss3/control_string, so that it
+        can be passed through as it is. TableParser (for the sequences it
+        takes at once) and the C DefaultParser do, the pure Python
+        DefaultParser does not: it reads the input one code point at a
+        time, and the sequences are put together again from their
+        parameters. '''
+
+    def dispatch_esc(self, prefix, final, source=None):
         raise NotImplementedError("EventDispatcher::dispatch_esc")
 
-    def dispatch_csi(self, prefix, params, final):
+    def dispatch_csi(self, prefix, params, final, source=None):
         raise NotImplementedError("EventDispatcher::dispatch_csi")
 
-    def dispatch_control_string(self, prefix, value):
+    def dispatch_control_string(self, prefix, value, source=None):
         raise NotImplementedError("EventDispatcher::dispatch_control_string")
 
+    def dispatch_control_string_start(self, prefix):
+        raise NotImplementedError(
+            "EventDispatcher::dispatch_control_string_start")
+
+    def dispatch_control_string_data(self, chunk):
+        raise NotImplementedError(
+            "EventDispatcher::dispatch_control_string_data")
+
+    def dispatch_control_string_end(self, abort=None):
+        raise NotImplementedError(
+            "EventDispatcher::dispatch_control_string_end")
+
     def dispatch_char(self, c):
         raise NotImplementedError("EventDispatcher::dispatch_char")
 
+    def dispatch_text(self, text):
+        raise NotImplementedError("EventDispatcher::dispatch_text")
+
 
 class Parser:
 
@@ -216,6 +266,29 @@ class PTY:
         raise NotImplementedError("PTY::drive")
 
 
+class Poller:
+
+    ''' abstruct I/O event notifier '''
+
+    def register(self, fd):
+        raise NotImplementedError("Poller::register")
+
+    def unregister(self, fd):
+        raise NotImplementedError("Poller::unregister")
+
+    def register_writer(self, fd):
+        raise NotImplementedError("Poller::register_writer")
+
+    def unregister_writer(self, fd):
+        raise NotImplementedError("Poller::unregister_writer")
+
+    def poll(self, timeout=None):
+        raise NotImplementedError("Poller::poll")
+
+    def close(self):
+        raise NotImplementedError("Poller::close")
+
+
 ###############################################################################
 #
 # Simple Parser implementation
@@ -257,12 +330,29 @@ _STATE_ESC = 1
 _STATE_ESC_INTERMEDIATE = 2
 _STATE_CSI_PARAMETER = 3
 _STATE_CSI_INTERMEDIATE = 4
+_STATE_CSI_IGNORE = 5
 _STATE_SS2 = 6
 _STATE_SS3 = 7
 _STATE_OSC = 8
 _STATE_OSC_ESC = 9
 _STATE_STR = 10
 _STATE_STR_ESC = 11
+_STATE_ESC_IGNORE = 12
+
+# printable characters which the ground state passes through as they are
+_TEXTRUN_PATTERN = re.compile(u'[^\x00-\x1f\x7f-\x9f]*')
+
+# characters which make up the value of OSC/DCS/SOS/PM/APC control strings
+_PAYLOAD_PATTERN = re.compile(u'[^\x00-\x07\x0e-\x1f]*')
+
+# at most this many parameter bytes and this many intermediate bytes are
+# kept for a sequence; a longer one is ignored (dropped as a whole), as
+# xterm does, the parsers go to _STATE_CSI_IGNORE or _STATE_ESC_IGNORE
+_SEQUENCE_LIMIT = 256
+
+# the parsers dispatch streamed control string values in chunks of at most
+# this many code points (and the rest at the end of each parse() call)
+_STRING_CHUNK = 4096
 
 
 class _MockHandler:
@@ -280,9 +370,20 @@ class _MockHandler:
         print (c)
 
 
+def _end_control_string(context, ibytes, abort=None):
+    ''' dispatch the rest of the value and the end of a streamed control
+        string '''
+    if ibytes:
+        context.dispatch_control_string_data(_fromcodepoints(ibytes))
+    context.dispatch_control_string_end(abort)
+
+
 class DefaultParser(Parser):
 
-    ''' parse ESC/CSI/string seqneces '''
+    ''' parse ESC/CSI/string seqneces
+
+        It does not give the source text of the sequences to the context
+        (see EventDispatcher), the C implementation in _tff does. '''
 
     def __init__(self):
         self.reset()
@@ -313,19 +414,45 @@ class DefaultParser(Parser):
         self.__ibytes = []
 
     def parse(self, data):
+        """
+        >>> from StringIO import StringIO
+        >>> class LengthHandler(DefaultHandler):
+        ...     def handle_csi(self, context, parameter, intermediate, final):
+        ...         print len(parameter), len(intermediate), final
+        ...         return True
+        >>> output = StringIO()
+        >>> context = ParseContext(output, handler=LengthHandler())
+        >>> parser = DefaultParser()
+        >>> parser.init(context)
+        >>> parser.parse("\\x1b[" + "1" * 256 + "$" * 256 + "p")
+        256 256 112
+
+        A longer sequence is ignored, not dispatched cut short
+
+        >>> parser.parse("\\x1b[" + "1" * 257 + "pA\\x1b[" + "$" * 257 + "p")
+        >>> output.getvalue()
+        'A'
+        """
 
         context = self.__context
         context.assign(data)
         pbytes = self.__pbytes
         ibytes = self.__ibytes
         state = self.__state
-        for c in context:
+        scanner = iter(context)
+        textrun = context.has_textrun()
+        streaming = context.streams_control_string()
+        for c in scanner:
 
             if state == _STATE_GROUND:
                 if c == 0x1b:  # ESC
                     ibytes = []
                     state = _STATE_ESC
 
+                elif textrun and (0x1f < c < 0x7f or c > 0x9f):
+                    # let the scanner cut out the whole printable run
+                    context.dispatch_text(scanner.send(_TEXTRUN_PATTERN))
+
                 else:  # control character
                     context.dispatch_char(c)
 
@@ -345,6 +472,8 @@ class DefaultParser(Parser):
                 elif c == 0x5d:  # ]
                     pbytes = [c]
                     state = _STATE_OSC
+                    if streaming:
+                        context.dispatch_control_string_start(c)
                 elif c == 0x4e:  # N
                     state = _STATE_SS2
                 elif c == 0x4f:  # O
@@ -353,6 +482,8 @@ class DefaultParser(Parser):
                     # P(DCS) or X(SOS) or ^(PM) or _(APC)
                     pbytes = [c]
                     state = _STATE_STR
+                    if streaming:
+                        context.dispatch_control_string_start(c)
                 elif c < 0x20:  # control character
                     if c == 0x1b:  # ESC
                         seq = [0x1b]
@@ -395,7 +526,10 @@ class DefaultParser(Parser):
                     context.dispatch_csi(pbytes, ibytes, c)
                     state = _STATE_GROUND
                 elif c > 0x2f:  # parameter, 0 to ?
-                    pbytes.append(c)
+                    if len(pbytes) < _SEQUENCE_LIMIT:
+                        pbytes.append(c)
+                    else:
+                        state = _STATE_CSI_IGNORE
                 elif c > 0x1f:  # intermediate, SP to /
                     ibytes.append(c)
                     state = _STATE_CSI_INTERMEDIATE
@@ -436,8 +570,10 @@ class DefaultParser(Parser):
                     context.dispatch_invalid(seq)
                     state = _STATE_GROUND
                 elif c > 0x1f:  # intermediate, SP to /
-                    ibytes.append(c)
-                    state = _STATE_CSI_INTERMEDIATE
+                    if len(ibytes) < _SEQUENCE_LIMIT:
+                        ibytes.append(c)
+                    else:
+                        state = _STATE_CSI_IGNORE
 
                 # control chars
                 elif c == 0x1b:  # ESC
@@ -465,8 +601,10 @@ class DefaultParser(Parser):
                     context.dispatch_esc(ibytes, c)
                     state = _STATE_GROUND
                 elif c > 0x1f:  # SP to /
-                    ibytes.append(c)
-                    state = _STATE_ESC_INTERMEDIATE
+                    if len(ibytes) < _SEQUENCE_LIMIT:
+                        ibytes.append(c)
+                    else:
+                        state = _STATE_ESC_IGNORE
                 elif c == 0x1b:  # ESC
                     seq = [0x1b] + ibytes
                     context.dispatch_invalid(seq)
@@ -480,65 +618,100 @@ class DefaultParser(Parser):
                 else:
                     context.dispatch_char(c)
 
+            elif state == _STATE_CSI_IGNORE or state == _STATE_ESC_IGNORE:
+                # skip the rest of a too long sequence
+                #
+                # CSI P ... P I ... I F  or  ESC I ... I F
+                if c > 0x7e:
+                    if c == 0x7f:  # control character
+                        context.dispatch_char(c)
+                    else:
+                        state = _STATE_GROUND
+                elif c > 0x3f or c > 0x2f and state == _STATE_ESC_IGNORE:
+                    state = _STATE_GROUND  # Final byte
+                elif c > 0x1f:
+                    pass
+                elif c == 0x1b:  # ESC
+                    ibytes = []
+                    state = _STATE_ESC
+                elif c == 0x18 or c == 0x1a:
+                    context.dispatch_char(c)
+                    state = _STATE_GROUND
+                else:
+                    context.dispatch_char(c)
+
             elif state == _STATE_OSC:
                 # parse control string
                 if c == 0x07:
-                    context.dispatch_control_string(pbytes[0], ibytes)
+                    if streaming:
+                        _end_control_string(context, ibytes)
+                    else:
+                        context.dispatch_control_string(pbytes[0], ibytes)
                     state = _STATE_GROUND
                 elif c < 0x08:
-                    seq = [0x1b] + pbytes + ibytes + [c]
-                    context.dispatch_invalid(seq)
+                    if streaming:
+                        _end_control_string(context, ibytes, [c])
+                    else:
+                        seq = [0x1b] + pbytes + ibytes + [c]
+                        context.dispatch_invalid(seq)
                     state = _STATE_GROUND
-                elif c < 0x0e:
-                    ibytes.append(c)
                 elif c == 0x1b:
                     state = _STATE_OSC_ESC
-                elif c < 0x20:
-                    seq = [0x1b] + pbytes + ibytes + [c]
-                    context.dispatch_invalid(seq)
+                elif 0x0d < c < 0x20:
+                    if streaming:
+                        _end_control_string(context, ibytes, [c])
+                    else:
+                        seq = [0x1b] + pbytes + ibytes + [c]
+                        context.dispatch_invalid(seq)
                     state = _STATE_GROUND
                 else:
                     ibytes.append(c)
+                    if streaming and len(ibytes) >= _STRING_CHUNK:
+                        context.dispatch_control_string_data(
+                            _fromcodepoints(ibytes))
+                        ibytes = []
 
             elif state == _STATE_STR:
                 # parse control string
                 # 00/08 - 00/13, 02/00 - 07/14
                 #
                 if c < 0x08:
-                    seq = [0x1b] + pbytes + ibytes + [c]
-                    context.dispatch_invalid(seq)
+                    if streaming:
+                        _end_control_string(context, ibytes, [c])
+                    else:
+                        seq = [0x1b] + pbytes + ibytes + [c]
+                        context.dispatch_invalid(seq)
                     state = _STATE_GROUND
-                elif c < 0x0e:
-                    ibytes.append(c)
                 elif c == 0x1b:
                     state = _STATE_STR_ESC
-                elif c < 0x20:
-                    seq = [0x1b] + pbytes + ibytes + [c]
-                    context.dispatch_invalid(seq)
+                elif 0x0d < c < 0x20:
+                    if streaming:
+                        _end_control_string(context, ibytes, [c])
+                    else:
+                        seq = [0x1b] + pbytes + ibytes + [c]
+                        context.dispatch_invalid(seq)
                     state = _STATE_GROUND
                 else:
                     ibytes.append(c)
+                    if streaming and len(ibytes) >= _STRING_CHUNK:
+                        context.dispatch_control_string_data(
+                            _fromcodepoints(ibytes))
+                        ibytes = []
 
-            elif state == _STATE_OSC_ESC:
-                # parse control string
-                if c == 0x5c:
-                    context.dispatch_control_string(pbytes[0], ibytes)
-                    state = _STATE_GROUND
-                else:
-                    seq = [0x1b] + pbytes + ibytes + [0x1b, c]
-                    context.dispatch_invalid(seq)
-                    state = _STATE_GROUND
-
-            elif state == _STATE_STR_ESC:
+            elif state == _STATE_OSC_ESC or state == _STATE_STR_ESC:
                 # parse control string
-                # 00/08 - 00/13, 02/00 - 07/14
-                #
                 if c == 0x5c:
-                    context.dispatch_control_string(pbytes[0], ibytes)
+                    if streaming:
+                        _end_control_string(context, ibytes)
+                    else:
+                        context.dispatch_control_string(pbytes[0], ibytes)
                     state = _STATE_GROUND
                 else:
-                    seq = [0x1b] + pbytes + ibytes + [0x1b, c]
-                    context.dispatch_invalid(seq)
+                    if streaming:
+                        _end_control_string(context, ibytes, [0x1b, c])
+                    else:
+                        seq = [0x1b] + pbytes + ibytes + [0x1b, c]
+                        context.dispatch_invalid(seq)
                     state = _STATE_GROUND
 
             elif state == _STATE_SS3:
@@ -585,15 +758,431 @@ class DefaultParser(Parser):
                     context.dispatch_invalid(seq)
                     context.dispatch_char(c)
 
+        if streaming and ibytes and _STATE_OSC <= state <= _STATE_STR_ESC:
+            # hand over the value read so far
+            context.dispatch_control_string_data(_fromcodepoints(ibytes))
+            ibytes = []
+
         self.__pbytes = pbytes
         self.__ibytes = ibytes
         self.__state = state
 
 
+###############################################################################
+#
+# Table driven Parser implementation
+#
+_ACTION_TEXT = 0           # ground printable, pass the text run through
+_ACTION_CHAR = 1           # dispatch control character
+_ACTION_ESC = 2            # enter ESC, clear intermediate bytes
+_ACTION_PAYLOAD = 3        # append the run of control string characters
+_ACTION_PARAM = 4          # append to parameter bytes
+_ACTION_COLLECT = 5        # append to intermediate bytes
+_ACTION_CSI = 6            # enter CSI, clear parameter bytes
+_ACTION_CSI_DISPATCH = 7
+_ACTION_ESC_DISPATCH = 8
+_ACTION_NONE = 9           # state change only
+_ACTION_STR = 10           # enter control string, remember its prefix
+_ACTION_STR_DISPATCH = 11
+_ACTION_SS3_DISPATCH = 12
+_ACTION_SS2_DISPATCH = 13
+_ACTION_ABORT = 16         # dispatch invalid sequence
+_ACTION_ABORT_FINAL = 17   # dispatch invalid sequence with current char
+_ACTION_ABORT_ESC = 18     # dispatch invalid sequence and restart ESC
+_ACTION_ABORT_CHAR = 19    # dispatch invalid sequence and current char
+
+# the head of the invalid sequence dispatched by the _ACTION_ABORT* actions
+_SEQ_NONE = 0
+_SEQ_ESC = 1               # ESC
+_SEQ_ESC_INTERMEDIATE = 2  # ESC I ... I
+_SEQ_CSI_PARAMETER = 3     # CSI P ... P
+_SEQ_CSI_INTERMEDIATE = 4  # CSI P ... P I ... I
+_SEQ_STR = 5               # ESC prefix value
+_SEQ_STR_ESC = 6           # ESC prefix value ESC
+_SEQ_SS2 = 7               # ESC N
+_SEQ_SS3 = 8               # ESC O
+
+# code points above 0x9f are treated as one class
+_CHAR_CLASSES = 0xa1
+
+
+def _transition(state, c):
+    ''' returns (action, next state, invalid sequence type) for the pair
+        of a state and a character class '''
+
+    if state == _STATE_GROUND:
+        if c == 0x1b:  # ESC
+            return _ACTION_ESC, _STATE_ESC, _SEQ_NONE
+        elif 0x1f < c < 0x7f or c > 0x9f:
+            return _ACTION_TEXT, state, _SEQ_NONE
+        return _ACTION_CHAR, state, _SEQ_NONE
+
+    elif state == _STATE_ESC:
+        if c == 0x5b:  # [
+            return _ACTION_CSI, _STATE_CSI_PARAMETER, _SEQ_NONE
+        elif c == 0x5d:  # ]
+            return _ACTION_STR, _STATE_OSC, _SEQ_NONE
+        elif c == 0x4e:  # N
+            return _ACTION_NONE, _STATE_SS2, _SEQ_NONE
+        elif c == 0x4f:  # O
+            return _ACTION_NONE, _STATE_SS3, _SEQ_NONE
+        elif c == 0x50 or c == 0x58 or c == 0x5e or c == 0x5f:
+            # P(DCS) or X(SOS) or ^(PM) or _(APC)
+            return _ACTION_STR, _STATE_STR, _SEQ_NONE
+        elif c == 0x1b:
+            return _ACTION_ABORT_ESC, _STATE_ESC, _SEQ_ESC
+        elif c == 0x18 or c == 0x1a:  # CAN, SUB
+            return _ACTION_ABORT_CHAR, _STATE_GROUND, _SEQ_ESC
+        elif c < 0x20 or c == 0x7f:  # control character
+            return _ACTION_CHAR, state, _SEQ_NONE
+        elif c <= 0x2f:  # SP to /
+            return _ACTION_COLLECT, _STATE_ESC_INTERMEDIATE, _SEQ_NONE
+        elif c <= 0x7e:  # ~
+            return _ACTION_ESC_DISPATCH, _STATE_GROUND, _SEQ_NONE
+        return _ACTION_ABORT_FINAL, _STATE_GROUND, _SEQ_ESC
+
+    elif state == _STATE_ESC_INTERMEDIATE:
+        if c == 0x1b:
+            return _ACTION_ABORT_ESC, _STATE_ESC, _SEQ_ESC_INTERMEDIATE
+        elif c == 0x18 or c == 0x1a:
+            return _ACTION_ABORT_CHAR, _STATE_GROUND, _SEQ_ESC_INTERMEDIATE
+        elif c < 0x20 or c == 0x7f:
+            return _ACTION_CHAR, state, _SEQ_NONE
+        elif c <= 0x2f:  # SP to /
+            return _ACTION_COLLECT, state, _SEQ_NONE
+        elif c <= 0x7e:  # 0 to ~, Final byte
+            return _ACTION_ESC_DISPATCH, _STATE_GROUND, _SEQ_NONE
+        return _ACTION_ABORT_FINAL, _STATE_GROUND, _SEQ_ESC_INTERMEDIATE
+
+    elif state == _STATE_CSI_PARAMETER:
+        if c == 0x1b:
+            return _ACTION_ABORT_ESC, _STATE_ESC, _SEQ_CSI_PARAMETER
+        elif c == 0x18 or c == 0x1a:
+            return _ACTION_ABORT_CHAR, _STATE_GROUND, _SEQ_CSI_PARAMETER
+        elif c < 0x20 or c == 0x7f:
+            return _ACTION_CHAR, state, _SEQ_NONE
+        elif c <= 0x2f:  # intermediate, SP to /
+            return _ACTION_COLLECT, _STATE_CSI_INTERMEDIATE, _SEQ_NONE
+        elif c <= 0x3f:  # parameter, 0 to ?
+            return _ACTION_PARAM, state, _SEQ_NONE
+        elif c <= 0x7e:  # Final byte, @ to ~
+            return _ACTION_CSI_DISPATCH, _STATE_GROUND, _SEQ_NONE
+        return _ACTION_ABORT, _STATE_GROUND, _SEQ_CSI_PARAMETER
+
+    elif state == _STATE_CSI_INTERMEDIATE:
+        if c == 0x1b:
+            return _ACTION_ABORT_ESC, _STATE_ESC, _SEQ_CSI_INTERMEDIATE
+        elif c == 0x18 or c == 0x1a:
+            return _ACTION_ABORT_CHAR, _STATE_GROUND, _SEQ_CSI_INTERMEDIATE
+        elif c < 0x20 or c == 0x7f:
+            return _ACTION_CHAR, state, _SEQ_NONE
+        elif c <= 0x2f:  # intermediate, SP to /
+            return _ACTION_COLLECT, state, _SEQ_NONE
+        elif c <= 0x3f:
+            return _ACTION_ABORT_FINAL, _STATE_GROUND, _SEQ_CSI_INTERMEDIATE
+        elif c <= 0x7e:  # Final byte, @ to ~
+            return _ACTION_CSI_DISPATCH, _STATE_GROUND, _SEQ_NONE
+        return _ACTION_ABORT, _STATE_GROUND, _SEQ_CSI_INTERMEDIATE
+
+    elif state == _STATE_CSI_IGNORE or state == _STATE_ESC_IGNORE:
+        # TableParser enters them when the sequence gets too long
+        if c == 0x1b:
+            return _ACTION_ESC, _STATE_ESC, _SEQ_NONE
+        elif c == 0x18 or c == 0x1a:
+            return _ACTION_CHAR, _STATE_GROUND, _SEQ_NONE
+        elif c < 0x20 or c == 0x7f:
+            return _ACTION_CHAR, state, _SEQ_NONE
+        elif c <= 0x2f or c <= 0x3f and state == _STATE_CSI_IGNORE:
+            return _ACTION_NONE, state, _SEQ_NONE
+        return _ACTION_NONE, _STATE_GROUND, _SEQ_NONE  # Final byte
+
+    elif state == _STATE_OSC or state == _STATE_STR:
+        # 00/08 - 00/13, 02/00 - 07/14
+        if c == 0x07 and state == _STATE_OSC:
+            return _ACTION_STR_DISPATCH, _STATE_GROUND, _SEQ_NONE
+        elif c == 0x1b:
+            return _ACTION_NONE, state + 1, _SEQ_NONE  # *_ESC
+        elif c < 0x08 or 0x0d < c < 0x20:
+            return _ACTION_ABORT_FINAL, _STATE_GROUND, _SEQ_STR
+        return _ACTION_PAYLOAD, state, _SEQ_NONE
+
+    elif state == _STATE_OSC_ESC or state == _STATE_STR_ESC:
+        if c == 0x5c:  # \
+            return _ACTION_STR_DISPATCH, _STATE_GROUND, _SEQ_NONE
+        return _ACTION_ABORT_FINAL, _STATE_GROUND, _SEQ_STR_ESC
+
+    elif state == _STATE_SS2 or state == _STATE_SS3:
+        if state == _STATE_SS2:
+            seqtype, action = _SEQ_SS2, _ACTION_SS2_DISPATCH
+        else:
+            seqtype, action = _SEQ_SS3, _ACTION_SS3_DISPATCH
+        if c == 0x1b:
+            return _ACTION_ABORT_ESC, _STATE_ESC, seqtype
+        elif c == 0x18 or c == 0x1a:
+            return _ACTION_ABORT_CHAR, _STATE_GROUND, seqtype
+        elif c < 0x20:
+            return _ACTION_CHAR, state, _SEQ_NONE
+        elif c < 0x7f:
+            return action, _STATE_GROUND, _SEQ_NONE
+        # DefaultParser reports "ESC O" for both SS2 and SS3 here
+        return _ACTION_ABORT_CHAR, state, _SEQ_SS3
+
+    return None
+
+
+def _build_transition_table():
+    """ build a table of rows, one per state. A row maps each character
+        class to a pair of an action and the row of the next state. For
+        the _ACTION_ABORT* actions, the type of the invalid sequence is
+        folded into the action as _ACTION_ABORT* + seqtype * 4. """
+    table = []
+    for state in range(_STATE_ESC_IGNORE + 1):
+        if _transition(state, 0) is None:
+            table.append(None)  # unused state number
+        else:
+            table.append([None] * _CHAR_CLASSES)
+    for state, row in enumerate(table):
+        if row is None:
+            continue
+        for c in range(_CHAR_CLASSES):
+            action, next_state, seqtype = _transition(state, c)
+            if action >= _ACTION_ABORT:
+                action += seqtype * 4
+            row[c] = (action, table[next_state])
+    return table
+
+_TRANSITION_TABLE = _build_transition_table()
+
+# the rows of the states inside of control strings
+_STRING_ROWS = frozenset(id(_TRANSITION_TABLE[state])
+                         for state in (_STATE_OSC, _STATE_OSC_ESC,
+                                       _STATE_STR, _STATE_STR_ESC))
+
+
+def _invalid_sequence(seqtype, pbytes, ibytes):
+    if seqtype == _SEQ_CSI_PARAMETER:
+        return [0x1b, 0x5b] + pbytes
+    elif seqtype == _SEQ_CSI_INTERMEDIATE:
+        return [0x1b, 0x5b] + pbytes + ibytes
+    elif seqtype == _SEQ_ESC_INTERMEDIATE:
+        return [0x1b] + ibytes
+    elif seqtype == _SEQ_STR:
+        return [0x1b] + pbytes + ibytes
+    elif seqtype == _SEQ_STR_ESC:
+        return [0x1b] + pbytes + ibytes + [0x1b]
+    elif seqtype == _SEQ_SS2:
+        return [0x1b, 0x4e]
+    elif seqtype == _SEQ_SS3:
+        return [0x1b, 0x4f]
+    return [0x1b]
+
+
+# runs of text, control characters but ESC and complete, well-formed control
+# sequences, which TableParser takes from the scanner at once in the ground
+# state, and their tokens
+_RUN_PATTERN = re.compile(u'(?:[^\x1b]+|\x1b\\[[0-?]*[ -/]*[@-~])*')
+_ESC_RUN_PATTERN = re.compile(u'(?:\\[[0-?]*[ -/]*[@-~]'
+                              u'(?:[^\x1b]+|\x1b\\[[0-?]*[ -/]*[@-~])*)?')
+_RUN_TOKEN = re.compile(u'([^\x00-\x1f\x7f-\x9f]+)'
+                        u'|([\x00-\x1a\x1c-\x1f\x7f-\x9f])'
+                        u'|(\x1b\\[([0-?]*)([ -/]*)([@-~]))')
+
+
+def _dispatch_run(context, run):
+    ''' dispatch the text, the control characters and the control
+        sequences of a run '''
+    for text, char, seq, params, intermediates, final \
+            in _RUN_TOKEN.findall(run):
+        if text:
+            context.dispatch_text(text)
+        elif char:
+            context.dispatch_char(ord(char))
+        # a too long sequence is ignored, as DefaultParser does
+        elif (len(params) <= _SEQUENCE_LIMIT
+              and len(intermediates) <= _SEQUENCE_LIMIT):
+            pbytes = map(ord, params)
+            if intermediates:
+                ibytes = map(ord, intermediates)
+            else:
+                ibytes = []
+            context.dispatch_csi(pbytes, ibytes, ord(final), seq)
+
+
+class TableParser(Parser):
+
+    ''' parse ESC/CSI/string seqneces with a precomputed state transition
+        table, generates the same events as DefaultParser.
+
+        Where the scanner can cut out runs, control string values and runs
+        of text, control characters and complete control sequences in the
+        ground state are taken at once instead of going through the table
+        character by character. '''
+
+    def __init__(self):
+        self.reset()
+
+    def init(self, context):
+        self.__context = context
+
+    def state_is_esc(self):
+        return self.__row is not _TRANSITION_TABLE[_STATE_GROUND]
+
+    def __getstate(self):
+        for state, row in enumerate(_TRANSITION_TABLE):
+            if row is self.__row:
+                return state
+
+    def flush(self):
+        pbytes = self.__pbytes
+        ibytes = self.__ibytes
+        state = self.__getstate()
+        context = self.__context
+        if state == _STATE_ESC:
+            context.dispatch_char(0x1b)
+        elif state == _STATE_ESC_INTERMEDIATE:
+            context.dispatch_invalid([0x1b] + ibytes)
+        elif state == _STATE_CSI_INTERMEDIATE:
+            context.dispatch_invalid([0x1b, 0x5b] + ibytes)
+        elif state == _STATE_CSI_PARAMETER:
+            context.dispatch_invalid([0x1b, 0x5b] + ibytes + pbytes)
+
+    def reset(self):
+        self.__row = _TRANSITION_TABLE[_STATE_GROUND]
+        self.__pbytes = []
+        self.__ibytes = []
+
+    def parse(self, data):
+        """
+        >>> from StringIO import StringIO
+        >>> context = ParseContext(StringIO(), handler=_MockHandler())
+        >>> parser = TableParser()
+        >>> parser.init(context)
+        >>> parser.parse("\\x1b[1;2mA\\x1b(B")
+        ([49, 59, 50], [], 109)
+        65
+        ([40], 66)
+        """
+        context = self.__context
+        context.assign(data)
+        pbytes = self.__pbytes
+        ibytes = self.__ibytes
+        row = self.__row
+        ground = _TRANSITION_TABLE[_STATE_GROUND]
+        scanner = iter(context)
+        textrun = context.has_textrun()
+        streaming = context.streams_control_string()
+        for c in scanner:
+            if c < 0xa0:
+                action, row = row[c]
+            else:
+                action, row = row[0xa0]
+
+            if action == _ACTION_TEXT:
+                if textrun:
+                    _dispatch_run(context, scanner.send(_RUN_PATTERN))
+                else:
+                    context.dispatch_char(c)
+            elif action == _ACTION_CHAR:
+                if textrun and row is ground:
+                    _dispatch_run(context, scanner.send(_RUN_PATTERN))
+                else:
+                    context.dispatch_char(c)
+            elif action == _ACTION_ESC:
+                ibytes = []
+                if textrun:
+                    run = scanner.send(_ESC_RUN_PATTERN)
+                    if len(run) > 1:
+                        _dispatch_run(context, run)
+                        row = ground
+            elif action == _ACTION_PAYLOAD:
+                if textrun:
+                    run = scanner.send(_PAYLOAD_PATTERN)
+                    if streaming:
+                        context.dispatch_control_string_data(run)
+                    else:
+                        ibytes.extend(_codepoints(run))
+                else:
+                    ibytes.append(c)
+                    if streaming and len(ibytes) >= _STRING_CHUNK:
+                        context.dispatch_control_string_data(
+                            _fromcodepoints(ibytes))
+                        ibytes = []
+            elif action == _ACTION_PARAM:
+                if len(pbytes) < _SEQUENCE_LIMIT:
+                    pbytes.append(c)
+                else:
+                    row = _TRANSITION_TABLE[_STATE_CSI_IGNORE]
+            elif action == _ACTION_COLLECT:
+                if len(ibytes) < _SEQUENCE_LIMIT:
+                    ibytes.append(c)
+                elif row is _TRANSITION_TABLE[_STATE_ESC_INTERMEDIATE]:
+                    row = _TRANSITION_TABLE[_STATE_ESC_IGNORE]
+                else:
+                    row = _TRANSITION_TABLE[_STATE_CSI_IGNORE]
+            elif action == _ACTION_CSI:
+                pbytes = []
+            elif action == _ACTION_CSI_DISPATCH:
+                context.dispatch_csi(pbytes, ibytes, c)
+            elif action == _ACTION_ESC_DISPATCH:
+                context.dispatch_esc(ibytes, c)
+            elif action == _ACTION_NONE:
+                pass
+            elif action == _ACTION_STR:
+                pbytes = [c]
+                if streaming:
+                    context.dispatch_control_string_start(c)
+            elif action == _ACTION_STR_DISPATCH:
+                if streaming:
+                    _end_control_string(context, ibytes)
+                else:
+                    context.dispatch_control_string(pbytes[0], ibytes)
+            elif action == _ACTION_SS3_DISPATCH:
+                context.dispatch_ss3(c)
+            elif action == _ACTION_SS2_DISPATCH:
+                context.dispatch_ss2(c)
+            else:
+                seqtype, action = divmod(action - _ACTION_ABORT, 4)
+                if streaming and seqtype == _SEQ_STR:
+                    _end_control_string(context, ibytes, [c])
+                    continue
+                elif streaming and seqtype == _SEQ_STR_ESC:
+                    _end_control_string(context, ibytes, [0x1b, c])
+                    continue
+                seq = _invalid_sequence(seqtype, pbytes, ibytes)
+                if action == _ACTION_ABORT_FINAL - _ACTION_ABORT:
+                    seq.append(c)
+                context.dispatch_invalid(seq)
+                if action == _ACTION_ABORT_ESC - _ACTION_ABORT:
+                    ibytes = []
+                elif action == _ACTION_ABORT_CHAR - _ACTION_ABORT:
+                    context.dispatch_char(c)
+
+        if streaming and ibytes and id(row) in _STRING_ROWS:
+            # hand over the value read so far
+            context.dispatch_control_string_data(_fromcodepoints(ibytes))
+            ibytes = []
+
+        self.__pbytes = pbytes
+        self.__ibytes = ibytes
+        self.__row = row
+
+
 ###############################################################################
 #
 # Scanner implementation
 #
+def _tobytes(value):
+    """ the incremental decoders of Python 2 take str only, copy memoryviews
+        (e.g. of the buffer of DefaultPTY)
+
+    >>> _tobytes(memoryview("abc"))
+    'abc'
+    """
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return value
+
+
 class DefaultScanner(Scanner):
 
     ''' scan input stream and iterate UCS code points '''
@@ -624,7 +1213,7 @@ class DefaultScanner(Scanner):
         if self._termenc != termenc:
             self._decoder = codecs.getincrementaldecoder(termenc)(errors='replace')
             self._termenc = termenc
-        self._data = self._decoder.decode(value)
+        self._data = self._decoder.decode(_tobytes(value))
 
     def continuous_assign(self, value):
         """
@@ -632,8 +1221,11 @@ class DefaultScanner(Scanner):
         >>> scanner.continuous_assign("01234")
         >>> scanner._data
         u'01234'
+        >>> scanner.continuous_assign(memoryview("56"))
+        >>> scanner._data
+        u'56'
         """
-        self._data = self._decoder.decode(value)
+        self._data = self._decoder.decode(_tobytes(value))
 
     def __iter__(self):
         """
@@ -641,21 +1233,303 @@ class DefaultScanner(Scanner):
         >>> scanner.assign("abcde", "UTF-8")
         >>> print [ c for c in scanner ]
         [97, 98, 99, 100, 101]
+
+        Sending a compiled pattern just after a code point is yielded makes
+        the iterator answer the whole run which starts with that code point
+        and continues as long as the pattern matches
+
+        >>> scanner.assign("abc\x1b[md", "UTF-8")
+        >>> it = iter(scanner)
+        >>> it.next()
+        97
+        >>> it.send(_TEXTRUN_PATTERN)
+        u'abc'
+        >>> [ c for c in it ]
+        [27, 91, 109, 100]
         """
-        if self._ucs4:
-            c1 = 0
-            for x in self._data:
-                c = ord(x)
-                if c >= 0xd800 and c <= 0xdbff:
+        data = self._data
+        ucs4 = self._ucs4
+        c1 = 0
+        it = enumerate(data)
+        for pos, x in it:
+            c = ord(x)
+            start = pos
+            if ucs4 and c >= 0xd800 and c <= 0xdfff:
+                if c <= 0xdbff:
                     c1 = c - 0xd800
                     continue
-                elif c1 != 0 and c >= 0xdc00 and c <= 0xdfff:
+                elif c1 != 0:
                     c = 0x10000 + ((c1 << 10) | (c - 0xdc00))
                     c1 = 0
-                yield c
+                    start -= 1
+            pattern = (yield c)
+            if pattern is not None:
+                end = pattern.match(data, pos + 1).end()
+                yield data[start:end]
+                # skip over the run
+                skip = end - pos - 1
+                next(islice(it, skip, skip), None)
+
+
+# ASCII compatible encodings, in which the bytes 0x00-0x7f always stand for
+# themselves and never appear inside of multibyte characters
+_ASCII_TRANSPARENT_ENCODINGS = ('ascii', 'utf-8', 'euc_jp', 'euc_jis_2004',
+                                'euc_jisx0213', 'euc_kr', 'gb2312')
+
+# ASCII transparent encodings whose decoders replace an incomplete character
+# together with the byte which follows it, even if it is an ASCII byte
+_RUN_DECODED_ENCODINGS = ('euc_jp', 'euc_jis_2004', 'euc_jisx0213', 'euc_kr',
+                          'gb2312')
+
+_BYTERUN_PATTERN = re.compile('([\x00-\x7f]+)|([\x80-\xff]+)')
+
+
+def _is_ascii_transparent(termenc):
+    """
+    >>> _is_ascii_transparent('UTF-8')
+    True
+    >>> _is_ascii_transparent('latin-1')
+    True
+    >>> _is_ascii_transparent('shift_jis')
+    False
+    """
+    name = codecs.lookup(termenc).name
+    return name in _ASCII_TRANSPARENT_ENCODINGS or name.startswith('iso8859')
+
+
+def _is_run_decoded(termenc):
+    """
+    >>> _is_run_decoded('EUC-JP')
+    True
+    >>> _is_run_decoded('UTF-8')
+    False
+    """
+    return codecs.lookup(termenc).name in _RUN_DECODED_ENCODINGS
+
+
+class EUCScanner(DefaultScanner):
+
+    ''' scan input stream and iterate UCS code points as DefaultScanner,
+        but with the EUC encodings, never let a broken multibyte character
+        take the ASCII byte which follows it (e.g. ESC) with it: the runs
+        of ASCII bytes are taken as they are and only the runs of non-ASCII
+        bytes go through the decoder. The input is still decoded before it
+        is parsed, with the other encodings it works as DefaultScanner (the
+        decoders of UTF-8 and the single byte encodings never take ASCII
+        bytes into a replaced character).
+    '''
+
+    def __init__(self, ucs4=True, termenc=None):
+        """
+        >>> scanner = EUCScanner()
+        >>> scanner._ucs4
+        True
+        """
+        DefaultScanner.__init__(self, ucs4, termenc)
+        self._byruns = bool(termenc) and _is_run_decoded(termenc)
+        self._held = False
+
+    # deprecated
+    def assign(self, value, termenc):
+        """
+        >>> scanner = EUCScanner()
+        >>> scanner.assign("01234", "ascii")
+        >>> scanner._data
+        u'01234'
+        """
+        if self._termenc != termenc:
+            self._decoder = codecs.getincrementaldecoder(termenc)(errors='replace')
+            self._termenc = termenc
+            self._byruns = _is_run_decoded(termenc)
+            self._held = False
+        self.continuous_assign(value)
+
+    def continuous_assign(self, value):
+        """
+        >>> scanner = EUCScanner(termenc="euc-jp")
+        >>> scanner.continuous_assign("\\xa4\\xa2\\xa4\\x1b[m")
+        >>> scanner._data
+        u'\\u3042\\ufffd\\x1b[m'
+
+        The decoder keeps an incomplete character across the chunks
+
+        >>> scanner.continuous_assign("\\xa4")
+        >>> scanner.continuous_assign("")
+        >>> scanner.continuous_assign("\\xa2a")
+        >>> scanner._data
+        u'\\u3042a'
+        """
+        if self._byruns:
+            self._data = self.__decode_runs(_tobytes(value))
         else:
-            for x in self._data:
-                yield ord(x)
+            self._data = self._decoder.decode(_tobytes(value))
+
+    def __decode_runs(self, data):
+        decode = self._decoder.decode
+        pieces = []
+        for ascii, nonascii in _BYTERUN_PATTERN.findall(data):
+            if ascii:
+                if self._held:
+                    # replace the incomplete character left in the decoder
+                    pieces.append(decode('', True))
+                    self._held = False
+                pieces.append(unicode(ascii))
+            else:
+                pieces.append(decode(nonascii))
+                self._held = True
+        return u''.join(pieces)
+
+
+try:
+    import _tff
+except ImportError:
+    pass
+else:
+    # use the C implementations if available
+    class DefaultScanner(_tff.DefaultScanner, Scanner):
+
+        ''' scan input stream and iterate UCS code points '''
+
+    class EUCScanner(_tff.EUCScanner, Scanner):
+
+        ''' scan input stream and iterate UCS code points as DefaultScanner,
+            but with the EUC encodings, never let a broken multibyte
+            character take the ASCII byte which follows it (e.g. ESC) '''
+
+    class DefaultParser(_tff.DefaultParser, Parser):
+
+        ''' parse ESC/CSI/string seqneces '''
+
+
+###############################################################################
+#
+# Character width
+#
+# The width classes of the code points are kept in a two-level table: the
+# index has an entry per block of 256 code points, which refers to a
+# bytearray of the classes of the block. Blocks with the same contents
+# (most of them, e.g. the unassigned planes or CJK ideographs) share one
+# bytearray. A block is filled from unicodedata the first time one of its
+# code points is looked up.
+#
+# For text runs, WidthTable translates the whole run with unicode.translate
+# and a table of the widths of the BMP, so that no Python code runs per
+# character. The runs with other code points (or surrogate pairs) are
+# looked up code point by code point.
+#
+_WIDTH_ZERO = 0         # combining marks, format and control characters
+_WIDTH_NARROW = 1
+_WIDTH_WIDE = 2         # East Asian Wide and Fullwidth
+_WIDTH_AMBIGUOUS = 3    # East Asian Ambiguous, narrow or wide by the locale
+_WIDTH_UNASSIGNED = 4   # not assigned in the unicodedata of this Python
+
+_WIDTH_BLOCK_BITS = 8
+_WIDTH_INDEX = [None] * (0x110000 >> _WIDTH_BLOCK_BITS)
+_WIDTH_BLOCKS = {}  # contents -> shared block
+
+# printable runs which take one cell each on every terminal
+_ASCII_PRINTABLE_PATTERN = re.compile(u'[\x20-\x7e]*$')
+
+# a character WidthTable did not translate into its width
+_UNTRANSLATED_PATTERN = re.compile(u'[^\x00-\x02]')
+
+
+def _classify_width(c):
+    if c > sys.maxunicode:  # narrow build, no data for the plane
+        if 0x20000 <= c <= 0x3fffd:
+            return _WIDTH_WIDE
+        return _WIDTH_NARROW
+    char = unichr(c)
+    category = unicodedata.category(char)
+    if category in ('Mn', 'Me', 'Cc') or category == 'Cf' and c != 0xad \
+            or 0x1160 <= c <= 0x11ff:  # Hangul medial vowels, final jamo
+        return _WIDTH_ZERO
+    east_asian_width = unicodedata.east_asian_width(char)
+    if east_asian_width in ('W', 'F'):
+        return _WIDTH_WIDE
+    if east_asian_width == 'A':
+        return _WIDTH_AMBIGUOUS
+    if category == 'Cn':
+        return _WIDTH_UNASSIGNED
+    return _WIDTH_NARROW
+
+
+def _width_block(n):
+    ''' fill the entry of the index for the n-th block '''
+    start = n << _WIDTH_BLOCK_BITS
+    block = bytearray(_classify_width(c)
+                      for c in xrange(start, start + (1 << _WIDTH_BLOCK_BITS)))
+    block = _WIDTH_BLOCKS.setdefault(str(block), block)
+    _WIDTH_INDEX[n] = block
+    return block
+
+
+def _width_class(c):
+    ''' the width class (_WIDTH_*) of the code point '''
+    block = _WIDTH_INDEX[c >> _WIDTH_BLOCK_BITS]
+    if block is None:
+        block = _width_block(c >> _WIDTH_BLOCK_BITS)
+    return block[c & 0xff]
+
+
+class WidthTable:
+
+    ''' the number of the cells the code points take on the terminal.
+        Combining marks and format characters take no cell, East Asian
+        Wide and Fullwidth characters take two, East Asian Ambiguous
+        characters take "ambiguous" cells (2 for the CJK locales)
+
+    >>> table = WidthTable()
+    >>> table.widths(u"a\\u3042\\u0301\\u00b0")
+    [1, 2, 0, 1]
+    >>> table.width(0xff21)
+    2
+    >>> WidthTable(ambiguous=2).text_width(u"a\\u3042\\u0301\\u00b0")
+    5
+    '''
+
+    def __init__(self, ambiguous=1):
+        self.__widths = (0, 1, 2, ambiguous, 1)  # width class -> width
+        self.__translation = None
+        self.ambiguous = ambiguous
+
+    def width(self, c):
+        ''' the width of the code point '''
+        block = _WIDTH_INDEX[c >> _WIDTH_BLOCK_BITS]
+        if block is None:
+            block = _width_block(c >> _WIDTH_BLOCK_BITS)
+        return self.__widths[block[c & 0xff]]
+
+    def __translate(self, text):
+        ''' the text with each code point of the BMP replaced by the
+            character of its width, surrogates are left as they are '''
+        translation = self.__translation
+        if translation is None:
+            chars = [unichr(width) for width in self.__widths]
+            translation = [chars[_width_class(c)] for c in xrange(0x10000)]
+            translation[0xd800:0xe000] = map(unichr, xrange(0xd800, 0xe000))
+            self.__translation = translation
+        return text.translate(translation)
+
+    def widths(self, text):
+        ''' the list of the widths of the code points of the text run
+            (a surrogate pair is a code point) '''
+        if _ASCII_PRINTABLE_PATTERN.match(text):
+            return [1] * len(text)
+        translated = self.__translate(text)
+        if not _UNTRANSLATED_PATTERN.search(translated):
+            return map(ord, translated)
+        return [self.width(c) for c in _codepoints(text)]
+
+    def text_width(self, text):
+        ''' the number of the cells the text run takes '''
+        if _ASCII_PRINTABLE_PATTERN.match(text):
+            return len(text)
+        translated = self.__translate(text)
+        if not _UNTRANSLATED_PATTERN.search(translated):
+            return len(translated) + translated.count(u'\x02') \
+                - translated.count(u'\x00')
+        return sum(self.width(c) for c in _codepoints(text))
 
 
 ###############################################################################
@@ -691,9 +1565,21 @@ class DefaultHandler(EventObserver):
     def handle_control_string(self, context, prefix, value):
         return False
 
+    def handle_control_string_start(self, context, prefix):
+        return False
+
+    def handle_control_string_data(self, context, chunk):
+        pass
+
+    def handle_control_string_end(self, context, valid):
+        pass
+
     def handle_char(self, context, c):
         return False
 
+    def handle_text(self, context, text):
+        return False
+
     def handle_invalid(self, context, seq):
         return False
 
@@ -762,11 +1648,29 @@ class FilterMultiplexer(EventObserver):
         handled_rhs = self.__rhs.handle_control_string(context, prefix, value)
         return handled_lhs and handled_rhs
 
+    def handle_control_string_start(self, context, prefix):
+        handled_lhs = self.__lhs.handle_control_string_start(context, prefix)
+        handled_rhs = self.__rhs.handle_control_string_start(context, prefix)
+        return handled_lhs and handled_rhs
+
+    def handle_control_string_data(self, context, chunk):
+        self.__lhs.handle_control_string_data(context, chunk)
+        self.__rhs.handle_control_string_data(context, chunk)
+
+    def handle_control_string_end(self, context, valid):
+        self.__lhs.handle_control_string_end(context, valid)
+        self.__rhs.handle_control_string_end(context, valid)
+
     def handle_char(self, context, c):
         handled_lhs = self.__lhs.handle_char(context, c)
         handled_rhs = self.__rhs.handle_char(context, c)
         return handled_lhs and handled_rhs
 
+    def handle_text(self, context, text):
+        handled_lhs = self.__lhs.handle_text(context, text)
+        handled_rhs = self.__rhs.handle_text(context, text)
+        return handled_lhs and handled_rhs
+
     def handle_invalid(self, context, seq):
         handled_lhs = self.__lhs.handle_invalid(context, seq)
         handled_rhs = self.__rhs.handle_invalid(context, seq)
@@ -783,55 +1687,1859 @@ class FilterMultiplexer(EventObserver):
         return handled_lhs and handled_rhs
 
 
-###############################################################################
-#
-# Dispatcher implementation
-#
-class ParseContext(OutputStream, EventDispatcher):
+class FilterChain(EventObserver):
+
+    ''' chain a flat list of filters, works like nested FilterMultiplexers
+        (an event is handled only if all filters handle it) but calls only
+        the filters which implement the handle_* method by themselves.
+
+        A filter may declare the finals of the sequences it is interested
+        in with "csi_finals" and "esc_finals" attributes (strings), then
+        its handle_csi/handle_esc are called only for them.
+        The filters are inspected when the chain is constructed.
+
+    >>> class SGRFilter(DefaultHandler):
+    ...     csi_finals = "m"
+    ...     def handle_csi(self, context, parameter, intermediate, final):
+    ...         print "SGR", parameter
+    ...         return True
+    >>> class CharFilter(DefaultHandler):
+    ...     def handle_char(self, context, c):
+    ...         print "char", c
+    ...         return True
+    >>> chain = FilterChain([SGRFilter(), CharFilter()])
+    >>> chain.handle_csi(None, [49], [], 0x6d)
+    SGR [49]
+    False
+    >>> chain.handle_csi(None, [49], [], 0x48)
+    False
+    >>> chain.handle_char(None, 0x41)
+    char 65
+    False
+    >>> FilterChain([SGRFilter()]).handle_csi(None, [49], [], 0x6d)
+    SGR [49]
+    True
+    '''
+
+    def __init__(self, filters):
+        self.__filters = list(filters)
+        self.__start = self.__subscribe('handle_start')[0]
+        self.__end = self.__subscribe('handle_end')[0]
+        self.__draw = self.__subscribe('handle_draw')[0]
+        self.__resize = self.__subscribe('handle_resize')[0]
+        self.__csi = self.__subscribe('handle_csi')
+        self.__esc = self.__subscribe('handle_esc')
+        self.__csi_table = self.__index('handle_csi', 'csi_finals')
+        self.__esc_table = self.__index('handle_esc', 'esc_finals')
+        self.__ss2 = self.__subscribe('handle_ss2')
+        self.__ss3 = self.__subscribe('handle_ss3')
+        self.__control_string = self.__subscribe('handle_control_string')
+        self.__control_string_start = self.__subscribe(
+            'handle_control_string_start')
+        self.__control_string_data = self.__subscribe(
+            'handle_control_string_data')[0]
+        self.__control_string_end = self.__subscribe(
+            'handle_control_string_end')[0]
+        self.__char = self.__subscribe('handle_char')
+        self.__text = self.__subscribe('handle_text')
+        self.__invalid = self.__subscribe('handle_invalid')
+
+    def get_filters(self):
+        return self.__filters
+
+    def __subscribe(self, name, final=None, attr=None):
+        ''' returns the bound methods to call and whether all filters are
+            in them (otherwise the event can not be handled) '''
+        methods = []
+        for handler in self.__filters:
+            if not _overrides(handler, name):
+                continue
+            if final is not None:
+                finals = getattr(handler, attr, None)
+                if finals is not None and unichr(final) not in finals:
+                    continue
+            methods.append(getattr(handler, name))
+        complete = bool(methods) and len(methods) == len(self.__filters)
+        return methods, complete
 
-    def __init__(self,
-                 output,
-                 termenc='UTF-8',
-                 scanner=DefaultScanner(),
-                 handler=DefaultHandler(),
-                 buffering=False):
-        self.__termenc = termenc
-        self.__scanner = scanner
-        self.__handler = handler
-        self._c1 = 0
+    def __index(self, name, attr):
+        return [self.__subscribe(name, final, attr) for final in xrange(0x80)]
 
-        if buffering:
-            try:
-                from cStringIO import StringIO
-                self._output = codecs.getwriter(termenc)(StringIO())
-            except ImportError:
-                try:
-                    from StringIO import StringIO
-                    self._output = codecs.getwriter(termenc)(StringIO())
-                except ImportError:
-                    from io import StringIO
-                    self._output = codecs.getwriter(termenc)(StringIO())
-        else:
-            self._output = codecs.getwriter(termenc)(output)
-        self._target_output = output
-        self._buffering = buffering
+    def handle_start(self, context):
+        for method in self.__start:
+            method(context)
 
-    def __iter__(self):
-        return self.__scanner.__iter__()
+    def handle_end(self, context):
+        for method in self.__end:
+            method(context)
 
-    def assign(self, data):
-        self.__scanner.assign(data, self.__termenc)
-        if self._buffering:
-            self._output.truncate(0)
+    def handle_csi(self, context, parameter, intermediate, final):
+        if final < 0x80:
+            methods, handled = self.__csi_table[final]
+        else:
+            methods, handled = self.__csi
+        for method in methods:
+            if not method(context, parameter, intermediate, final):
+                handled = False
+        return handled
 
-    def sethandler(self, handler):
-        self.__handler = handler
+    def handle_esc(self, context, intermediate, final):
+        if final < 0x80:
+            methods, handled = self.__esc_table[final]
+        else:
+            methods, handled = self.__esc
+        for method in methods:
+            if not method(context, intermediate, final):
+                handled = False
+        return handled
 
-    def putu(self, data):
-        self._output.write(data)
+    def handle_ss2(self, context, final):
+        methods, handled = self.__ss2
+        for method in methods:
+            if not method(context, final):
+                handled = False
+        return handled
+
+    def handle_ss3(self, context, final):
+        methods, handled = self.__ss3
+        for method in methods:
+            if not method(context, final):
+                handled = False
+        return handled
+
+    def handle_control_string(self, context, prefix, value):
+        methods, handled = self.__control_string
+        for method in methods:
+            if not method(context, prefix, value):
+                handled = False
+        return handled
+
+    def handle_control_string_start(self, context, prefix):
+        methods, handled = self.__control_string_start
+        for method in methods:
+            if not method(context, prefix):
+                handled = False
+        return handled
+
+    def handle_control_string_data(self, context, chunk):
+        for method in self.__control_string_data:
+            method(context, chunk)
+
+    def handle_control_string_end(self, context, valid):
+        for method in self.__control_string_end:
+            method(context, valid)
+
+    def handle_char(self, context, c):
+        methods, handled = self.__char
+        for method in methods:
+            if not method(context, c):
+                handled = False
+        return handled
+
+    def handle_text(self, context, text):
+        methods, handled = self.__text
+        for method in methods:
+            if not method(context, text):
+                handled = False
+        return handled
+
+    def handle_invalid(self, context, seq):
+        methods, handled = self.__invalid
+        for method in methods:
+            if not method(context, seq):
+                handled = False
+        return handled
+
+    def handle_draw(self, context):
+        for method in self.__draw:
+            method(context)
+
+    def handle_resize(self, context, row, col):
+        for method in self.__resize:
+            method(context, row, col)
+
+
+def _overrides(handler, name):
+    ''' test whether the handler implements the named method by itself '''
+    method = getattr(handler.__class__, name, None)
+    if method is None:
+        return False
+    method = getattr(method, 'im_func', method)
+    for base in (EventObserver, DefaultHandler):
+        default = getattr(base, name, None)
+        if method is getattr(default, 'im_func', default):
+            return False
+    return True
+
+
+def _accepts_text(handler):
+    ''' test whether the handler can take a whole text run at once
+
+    >>> _accepts_text(DefaultHandler())
+    True
+    >>> class CharHandler(DefaultHandler):
+    ...     def handle_char(self, context, c):
+    ...         return True
+    >>> _accepts_text(CharHandler())
+    False
+    >>> _accepts_text(FilterMultiplexer(DefaultHandler(), CharHandler()))
+    False
+    '''
+    if isinstance(handler, _Instrumented):
+        return _accepts_text(handler.get_target())
+    if isinstance(handler, FilterMultiplexer):
+        return (_accepts_text(handler.get_lhs())
+                and _accepts_text(handler.get_rhs()))
+    if isinstance(handler, FilterChain):
+        return all(_accepts_text(f) for f in handler.get_filters())
+    if _overrides(handler, 'handle_text'):
+        return True
+    # DefaultHandler.handle_text passes text through, which is correct
+    # only as long as the handler leaves handle_char as it is.
+    return (isinstance(handler, DefaultHandler)
+            and not _overrides(handler, 'handle_char'))
+
+
+def _streams_control_string(handler):
+    ''' test whether the handler takes the values of control strings in
+        chunks (handle_control_string_start/data/end). In a multiplexer or
+        a chain, the other filters must leave control strings alone.
+
+    >>> _streams_control_string(DefaultHandler())
+    False
+    >>> class StreamingHandler(DefaultHandler):
+    ...     def handle_control_string_data(self, context, chunk):
+    ...         pass
+    >>> _streams_control_string(StreamingHandler())
+    True
+    >>> _streams_control_string(FilterChain([StreamingHandler(),
+    ...                                      DefaultHandler()]))
+    True
+    >>> class StringHandler(DefaultHandler):
+    ...     def handle_control_string(self, context, prefix, value):
+    ...         return True
+    >>> _streams_control_string(FilterMultiplexer(StreamingHandler(),
+    ...                                           StringHandler()))
+    False
+    '''
+    if isinstance(handler, _Instrumented):
+        return _streams_control_string(handler.get_target())
+    if isinstance(handler, FilterMultiplexer):
+        filters = [handler.get_lhs(), handler.get_rhs()]
+    elif isinstance(handler, FilterChain):
+        filters = handler.get_filters()
+    else:
+        return _overrides(handler, 'handle_control_string_data')
+    streams = False
+    for f in filters:
+        if _streams_control_string(f):
+            streams = True
+        elif (not isinstance(f, DefaultHandler)
+              or _overrides(f, 'handle_control_string')
+              or _overrides(f, 'handle_invalid')):
+            return False
+    return streams
+
+
+def _iter_codepoints(text):
+    ''' iterate UCS code points of a text run '''
+    c1 = 0
+    for x in text:
+        c = ord(x)
+        if c >= 0xd800 and c <= 0xdbff:
+            c1 = c - 0xd800
+            continue
+        elif c1 != 0 and c >= 0xdc00 and c <= 0xdfff:
+            c = 0x10000 + ((c1 << 10) | (c - 0xdc00))
+            c1 = 0
+        yield c
+
+
+if sys.maxunicode > 0xffff:
+    def _codepoints(text):
+        return map(ord, text)
+
+    def _fromcodepoints(codes):
+        return u''.join(map(unichr, codes))
+else:
+    def _codepoints(text):
+        return list(_iter_codepoints(text))
+
+    def _fromcodepoints(codes):
+        chars = []
+        for c in codes:
+            if c > 0xffff:
+                c -= 0x10000
+                chars.append(unichr((c >> 10) + 0xd800))
+                chars.append(unichr((c & 0x3ff) + 0xdc00))
+            else:
+                chars.append(unichr(c))
+        return u''.join(chars)
+
+
+###############################################################################
+#
+# CSI parameter implementation
+#
+class CSIParameter(list):
+
+    ''' the parameter bytes of a CSI sequence, which behaves as the list of
+        code points and parses itself into numeric parameters lazily
+        (at most once, the result is cached until the list is modified)
+
+    >>> parameter = CSIParameter(map(ord, "?1;;25:2:3"))
+    >>> parameter.private
+    63
+    >>> parameter.params
+    [1, None, 25]
+    >>> parameter.subparams
+    [[1], [None], [25, 2, 3]]
+    >>> parameter.get(1, 1)
+    1
+    >>> parameter.get(3, 1)
+    1
+    >>> parameter.tostring()
+    '?1;;25:2:3'
+    >>> parameter.extend(map(ord, ";7"))
+    >>> parameter.params
+    [1, None, 25, 7]
+    >>> CSIParameter([]).params
+    []
+    '''
+
+    __parsed = None
+
+    def __invalidating(method):
+        def wrapper(self, *args):
+            self.__parsed = None
+            return method(self, *args)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    # the methods of list which modify it drop the parsed values
+    __setitem__ = __invalidating(list.__setitem__)
+    __delitem__ = __invalidating(list.__delitem__)
+    __setslice__ = __invalidating(list.__setslice__)
+    __delslice__ = __invalidating(list.__delslice__)
+    __iadd__ = __invalidating(list.__iadd__)
+    __imul__ = __invalidating(list.__imul__)
+    append = __invalidating(list.append)
+    extend = __invalidating(list.extend)
+    insert = __invalidating(list.insert)
+    pop = __invalidating(list.pop)
+    remove = __invalidating(list.remove)
+    reverse = __invalidating(list.reverse)
+    sort = __invalidating(list.sort)
+    del __invalidating
+
+    def __parse(self):
+        parsed = self.__parsed
+        if parsed is None:
+            private = None
+            subparams = []
+            values = []
+            value = None
+            it = iter(self)
+            if self and 0x3c <= self[0] <= 0x3f:
+                private = it.next()
+            for c in it:
+                if 0x30 <= c <= 0x39:
+                    value = (value or 0) * 10 + c - 0x30
+                elif c == 0x3a:  # :
+                    values.append(value)
+                    value = None
+                elif c == 0x3b:  # ;
+                    values.append(value)
+                    subparams.append(values)
+                    values = []
+                    value = None
+                # the other parameter bytes are ignored
+            if len(self) > (private is not None):
+                values.append(value)
+                subparams.append(values)
+            params = [values[0] for values in subparams]
+            parsed = self.__parsed = (private, params, subparams)
+        return parsed
+
+    @property
+    def private(self):
+        ''' the code point of the private marker (one of "<=>?", 0x3c-0x3f)
+            or None '''
+        return self.__parse()[0]
+
+    @property
+    def params(self):
+        ''' the list of parameter values, None stands for the default '''
+        return self.__parse()[1]
+
+    @property
+    def subparams(self):
+        ''' the list of the parameter values with their ':' subparameters '''
+        return self.__parse()[2]
+
+    def get(self, index, default=None):
+        ''' get the value of the index-th parameter, or the default if it
+            is omitted '''
+        params = self.__parse()[1]
+        if index < len(params):
+            value = params[index]
+            if value is not None:
+                return value
+        return default
+
+    def tostring(self):
+        ''' serialize the parameter bytes as they were '''
+        return ''.join(map(chr, self))
+
+
+###############################################################################
+#
+# Screen
+#
+# The attribute of a cell is a bitfield of the SGR flags (bits 0-7), the
+# foreground color (bits 8-16) and the background color (bits 17-25), the
+# colors are 0-255 or _COLOR_DEFAULT. The charset of a cell is the final
+# byte of the designation (ESC ( F or ESC ) F) of the set which was shifted
+# in (SI or SO) when the cell was written, e.g. "0" for the DEC special
+# graphics; handle_draw writes the cells with G0 and restores the charsets
+# of the application afterwards.
+#
+_ATTR_BOLD = 0x01
+_ATTR_DIM = 0x02
+_ATTR_ITALIC = 0x04
+_ATTR_UNDERLINE = 0x08
+_ATTR_BLINK = 0x10
+_ATTR_REVERSE = 0x20
+_ATTR_CONCEAL = 0x40
+_ATTR_CROSSED = 0x80
+
+_COLOR_DEFAULT = 0x100
+_FG_SHIFT = 8
+_BG_SHIFT = 17
+_FG_MASK = 0x1ff << _FG_SHIFT
+_BG_MASK = 0x1ff << _BG_SHIFT
+
+_ATTR_DEFAULT = (_COLOR_DEFAULT << _FG_SHIFT) | (_COLOR_DEFAULT << _BG_SHIFT)
+
+_CHARSET_DEFAULT = 0x42  # B, ASCII
+
+# SGR parameter -> attribute flag, and the flags each reset parameter clears
+_SGR_FLAGS = {1: _ATTR_BOLD, 2: _ATTR_DIM, 3: _ATTR_ITALIC,
+              4: _ATTR_UNDERLINE, 5: _ATTR_BLINK, 7: _ATTR_REVERSE,
+              8: _ATTR_CONCEAL, 9: _ATTR_CROSSED}
+_SGR_RESETS = {22: _ATTR_BOLD | _ATTR_DIM, 23: _ATTR_ITALIC,
+               24: _ATTR_UNDERLINE, 25: _ATTR_BLINK, 27: _ATTR_REVERSE,
+               28: _ATTR_CONCEAL, 29: _ATTR_CROSSED}
+
+# printable runs in which every character takes one cell
+_NARROW_PATTERN = re.compile(u'[\x20-\x7e\xa0-\u02ff]*$')
+
+# DEC private modes which switch to the alternate screen
+_ALTERNATE_SCREEN_MODES = frozenset([47, 1047, 1049])
+
+
+# the number of cells the code point takes (East Asian ambiguous characters
+# are narrow, combining characters take no cell)
+_char_width = WidthTable().width
+
+
+def _rgb_to_256(r, g, b):
+    ''' the nearest color of the 6x6x6 cube of the 256 color palette '''
+    return 16 + (r * 5 + 127) // 255 * 36 + (g * 5 + 127) // 255 * 6 \
+        + (b * 5 + 127) // 255
+
+
+def _sgr(attr):
+    ''' the SGR sequence which sets the attribute from the default '''
+    params = ['0']
+    for value, flag in sorted(_SGR_FLAGS.items()):
+        if attr & flag:
+            params.append(str(value))
+    fg = (attr & _FG_MASK) >> _FG_SHIFT
+    if fg != _COLOR_DEFAULT:
+        params.append('38;5;%d' % fg)
+    bg = (attr & _BG_MASK) >> _BG_SHIFT
+    if bg != _COLOR_DEFAULT:
+        params.append('48;5;%d' % bg)
+    return u'\x1b[%sm' % ';'.join(params)
+
+
+class Screen(DefaultHandler):
+
+    ''' reference screen model: a handler of the output which keeps the
+        cells in flat arrays of code points, attributes and widths, and
+        marks the rows it changes as dirty. It implements the common
+        cursor, erase, scroll, insert/delete and SGR sequences; handle_draw
+        writes only the dirty rows to the terminal. It keeps the charset
+        of each cell, so that the rows it writes again (e.g. after a resize)
+        keep their line-drawing characters. Sequences it does not know
+        (modes, control strings, ...) are passed through; the escape and
+        control sequences after the dirty rows are written, as they may
+        change how the terminal shows what follows.
+
+    >>> from StringIO import StringIO
+    >>> output = StringIO()
+    >>> screen = Screen(3, 8)
+    >>> context = ParseContext(output, handler=screen)
+    >>> parser = DefaultParser()
+    >>> parser.init(context)
+    >>> parser.parse("abc\\r\\n\\x1b[1mdef\\x1b[m")
+    >>> screen.getline(1)
+    u'def     '
+    >>> screen.handle_draw(context)
+    >>> output.getvalue()
+    '\\x1b[1;1Habc\\x1b[K\\x1b[2;1H\\x1b[0;1mdef\\x1b[m\\x1b[K\\x1b[3;1H\\x1b[K\\x1b[2;4H'
+    >>> output.truncate(0)
+    >>> parser.parse("\\x1b[1;2HX\\x1b[?25l")
+    >>> screen.handle_draw(context)
+    >>> output.getvalue()
+    '\\x1b[1;1HaXc\\x1b[K\\x1b[1;3H\\x1b[?25l'
+    >>> output.truncate(0)
+    >>> parser.parse("\\x1b[2;1H\\x1b(0lqqk\\x1b(B \\x1b)0\\x0ex\\x0f")
+    >>> screen.handle_draw(context)
+    >>> output.getvalue()
+    '\\x1b[2;1H\\x1b(0lqqk\\x1b(B \\x1b(0x\\x1b[K\\x1b[2;7H\\x1b(B\\x1b)0'
+    >>> output.truncate(0)
+    >>> screen.handle_resize(context, 2, 6)
+    >>> screen.handle_draw(context)
+    >>> output.getvalue()[12:]
+    '\\x1b[2;1H\\x1b(0lqqk\\x1b(B \\x1b(0x\\x1b[2;6H\\x1b(B'
+    >>> output.truncate(0)
+    >>> parser.parse("\\x1b[?1049h\\x1b[HALT\\x1b[?1049l")
+    >>> output.getvalue()
+    '\\x1b[?1049h\\x1b[1;1HALT\\x1b[K\\x1b[1;4H\\x1b[?1049l'
+    >>> screen.getline(0)
+    u'aXc   '
+    '''
+
+    def __init__(self, row=24, col=80):
+        self.row = row
+        self.col = col
+        size = row * col
+        self.__codes = array('L', [0x20]) * size
+        self.__attrs = array('L', [_ATTR_DEFAULT]) * size
+        self.__widths = array('B', [1]) * size
+        self.__charsets = array('B', [_CHARSET_DEFAULT]) * size
+        self.__dirty = bytearray('\x01') * row
+        self.__y = 0
+        self.__x = 0
+        self.__wrapnext = False
+        self.__attr = _ATTR_DEFAULT
+        self.__top = 0
+        self.__bottom = row - 1
+        self.__saved = (0, 0, _ATTR_DEFAULT)
+        self.__alternate = False
+        self.__other = (array('L', [0x20]) * size,  # the cells of the
+                        array('L', [_ATTR_DEFAULT]) * size,  # other screen
+                        array('B', [1]) * size,
+                        array('B', [_CHARSET_DEFAULT]) * size)
+        self.__designations = [_CHARSET_DEFAULT, _CHARSET_DEFAULT]  # G0, G1
+        self.__shift = 0  # 1 after SO, 0 after SI
+        self.__shown = (_CHARSET_DEFAULT, _CHARSET_DEFAULT, 0)  # written
+
+    def getcursor(self):
+        ''' the cursor position (row, col), zero-origin '''
+        return self.__y, self.__x
+
+    def getline(self, y):
+        ''' the text of the y-th row '''
+        start = y * self.col
+        codes = [self.__codes[i] for i in xrange(start, start + self.col)
+                 if self.__widths[i]]
+        return _fromcodepoints(codes)
+
+    def getcell(self, y, x):
+        ''' (code point, attribute, width) of the cell '''
+        i = y * self.col + x
+        return self.__codes[i], self.__attrs[i], self.__widths[i]
+
+    def is_dirty(self, y):
+        return self.__dirty[y] != 0
+
+    def __touch(self, top, bottom):
+        for y in xrange(top, bottom + 1):
+            self.__dirty[y] = 1
+
+    def __split_wide(self, i):
+        ''' blank the wide character which the boundary before the i-th
+            cell would cut in two '''
+        widths = self.__widths
+        if i < len(widths) and widths[i] == 0:
+            self.__codes[i - 1] = self.__codes[i] = 0x20
+            widths[i - 1] = widths[i] = 1
+
+    def __erase(self, start, end):
+        ''' erase the cells [start, end) of the flat arrays, with the
+            background color of the current attribute '''
+        if end <= start:
+            return
+        self.__split_wide(start)
+        self.__split_wide(end)
+        n = end - start
+        attr = (self.__attr & _BG_MASK) | (_COLOR_DEFAULT << _FG_SHIFT)
+        self.__codes[start:end] = array('L', [0x20]) * n
+        self.__attrs[start:end] = array('L', [attr]) * n
+        self.__widths[start:end] = array('B', [1]) * n
+        self.__charsets[start:end] = array('B', [_CHARSET_DEFAULT]) * n
+
+    def __copy_rows(self, dst, src, count):
+        col = self.col
+        for a in (self.__codes, self.__attrs, self.__widths, self.__charsets):
+            a[dst * col:(dst + count) * col] = a[src * col:(src + count) * col]
+
+    def __scroll_up(self, top, bottom, n):
+        n = min(n, bottom - top + 1)
+        self.__copy_rows(top, top + n, bottom - top + 1 - n)
+        self.__erase((bottom + 1 - n) * self.col, (bottom + 1) * self.col)
+        self.__touch(top, bottom)
+
+    def __scroll_down(self, top, bottom, n):
+        n = min(n, bottom - top + 1)
+        self.__copy_rows(top + n, top, bottom - top + 1 - n)
+        self.__erase(top * self.col, (top + n) * self.col)
+        self.__touch(top, bottom)
+
+    def __linefeed(self):
+        if self.__y == self.__bottom:
+            self.__scroll_up(self.__top, self.__bottom, 1)
+        elif self.__y < self.row - 1:
+            self.__y += 1
+
+    def __moveto(self, y, x):
+        self.__y = max(0, min(y, self.row - 1))
+        self.__x = max(0, min(x, self.col - 1))
+        self.__wrapnext = False
+
+    def __write(self, c, width):
+        ''' put a code point at the cursor '''
+        col = self.col
+        if self.__wrapnext or self.__x + width > col:
+            self.__x = 0
+            self.__linefeed()
+        self.__wrapnext = False
+        i = self.__y * col + self.__x
+        self.__split_wide(i)
+        self.__split_wide(i + width)
+        charset = self.__designations[self.__shift]
+        self.__codes[i] = c
+        self.__attrs[i] = self.__attr
+        self.__widths[i] = width
+        self.__charsets[i] = charset
+        if width == 2:
+            self.__codes[i + 1] = 0x20
+            self.__attrs[i + 1] = self.__attr
+            self.__widths[i + 1] = 0
+            self.__charsets[i + 1] = charset
+        self.__dirty[self.__y] = 1
+        if self.__x + width < col:
+            self.__x += width
+        else:
+            self.__x = col - 1
+            self.__wrapnext = True
+
+    def __switch_screen(self, mode, alternate):
+        ''' switch to the alternate screen or back, as xterm does for the
+            modes 47, 1047 and 1049 '''
+        if alternate == self.__alternate:
+            return
+        size = self.row * self.col
+        if alternate and mode == 1049:
+            self.__saved = (self.__y, self.__x, self.__attr)
+        elif not alternate and mode != 47:
+            self.__erase(0, size)
+        cells = self.__codes, self.__attrs, self.__widths, self.__charsets
+        self.__codes, self.__attrs, self.__widths, self.__charsets = \
+            self.__other
+        self.__other = cells
+        self.__alternate = alternate
+        if alternate and mode == 1049:
+            self.__erase(0, size)
+        elif not alternate and mode == 1049:
+            y, x, self.__attr = self.__saved
+            self.__moveto(y, x)
+
+    def __write_narrow(self, text):
+        ''' put a run of one-cell characters at the cursor '''
+        col = self.col
+        charset = self.__designations[self.__shift]
+        pos = 0
+        while pos < len(text):
+            if self.__wrapnext:
+                self.__x = 0
+                self.__linefeed()
+                self.__wrapnext = False
+            n = min(len(text) - pos, col - self.__x)
+            i = self.__y * col + self.__x
+            self.__split_wide(i)
+            self.__split_wide(i + n)
+            self.__codes[i:i + n] = array('L', map(ord, text[pos:pos + n]))
+            self.__attrs[i:i + n] = array('L', [self.__attr]) * n
+            self.__widths[i:i + n] = array('B', [1]) * n
+            self.__charsets[i:i + n] = array('B', [charset]) * n
+            self.__dirty[self.__y] = 1
+            pos += n
+            if self.__x + n < col:
+                self.__x += n
+            else:
+                self.__x = col - 1
+                self.__wrapnext = True
+
+    def __sgr(self, parameter):
+        attr = self.__attr
+        params = parameter.params or [0]
+        i = 0
+        while i < len(params):
+            value = params[i] or 0
+            i += 1
+            if value == 0:
+                attr = _ATTR_DEFAULT
+            elif value in _SGR_FLAGS:
+                attr |= _SGR_FLAGS[value]
+            elif value in _SGR_RESETS:
+                attr &= ~_SGR_RESETS[value]
+            elif 30 <= value <= 37 or 90 <= value <= 97 or value == 39 \
+                    or value == 38:
+                if value == 38:
+                    color, i = self.__extended_color(parameter, i)
+                elif value == 39:
+                    color = _COLOR_DEFAULT
+                elif value < 90:
+                    color = value - 30
+                else:
+                    color = value - 90 + 8
+                if color is not None:
+                    attr = (attr & ~_FG_MASK) | (color << _FG_SHIFT)
+            elif 40 <= value <= 47 or 100 <= value <= 107 or value == 49 \
+                    or value == 48:
+                if value == 48:
+                    color, i = self.__extended_color(parameter, i)
+                elif value == 49:
+                    color = _COLOR_DEFAULT
+                elif value < 100:
+                    color = value - 40
+                else:
+                    color = value - 100 + 8
+                if color is not None:
+                    attr = (attr & ~_BG_MASK) | (color << _BG_SHIFT)
+        self.__attr = attr
+
+    def __extended_color(self, parameter, i):
+        ''' parse the rest of SGR 38/48, "5;n" or "2;r;g;b" (or the same
+            with ":"), returns the color (or None) and the index of the next
+            parameter '''
+        subparams = parameter.subparams[i - 1]
+        if len(subparams) > 1:
+            values = subparams[1:]  # 38:5:n or 38:2:[id]:r:g:b
+        else:
+            values = parameter.params[i:i + 4]
+            if values[:1] == [5]:
+                values = values[:2]
+            elif values[:1] != [2]:
+                values = []
+            i += len(values)
+        values = [v or 0 for v in values]
+        if len(values) == 2 and values[0] == 5:
+            return min(values[1], 255), i
+        elif len(values) >= 4 and values[0] == 2:
+            r, g, b = [min(v, 255) for v in values[-3:]]
+            return _rgb_to_256(r, g, b), i
+        return None, i
+
+# EventObserver
+    def handle_text(self, context, text):
+        if _NARROW_PATTERN.match(text):
+            self.__write_narrow(text)
+        else:
+            for c in _iter_codepoints(text):
+                self.handle_char(context, c)
+        return True
+
+    def handle_char(self, context, c):
+        if 0x1f < c < 0x7f or c > 0x9f:
+            width = _char_width(c)
+            if width:
+                self.__write(c, width)
+        elif c == 0x0a or c == 0x0b or c == 0x0c:  # LF, VT, FF
+            self.__linefeed()
+            self.__wrapnext = False
+        elif c == 0x0d:  # CR
+            self.__x = 0
+            self.__wrapnext = False
+        elif c == 0x08:  # BS
+            self.__moveto(self.__y, self.__x - 1)
+        elif c == 0x09:  # HT
+            self.__moveto(self.__y, (self.__x // 8 + 1) * 8)
+        elif c == 0x0e:  # SO
+            self.__shift = 1
+        elif c == 0x0f:  # SI
+            self.__shift = 0
+        else:
+            return False  # BEL, ...
+        return True
+
+    def handle_esc(self, context, intermediate, final):
+        if intermediate == [0x28] or intermediate == [0x29]:  # (, G0 / ), G1
+            self.__designations[intermediate[0] - 0x28] = final
+            return True
+        if intermediate:
+            self.handle_draw(context)
+            return False
+        if final == 0x37:  # 7, DECSC
+            self.__saved = (self.__y, self.__x, self.__attr)
+        elif final == 0x38:  # 8, DECRC
+            y, x, self.__attr = self.__saved
+            self.__moveto(y, x)
+        elif final == 0x44:  # D, IND
+            self.__linefeed()
+        elif final == 0x45:  # E, NEL
+            self.__x = 0
+            self.__linefeed()
+            self.__wrapnext = False
+        elif final == 0x4d:  # M, RI
+            if self.__y == self.__top:
+                self.__scroll_down(self.__top, self.__bottom, 1)
+            elif self.__y > 0:
+                self.__y -= 1
+        elif final == 0x63:  # c, RIS
+            self.__init__(self.row, self.col)
+            return False
+        else:  # locking shifts, ...
+            self.handle_draw(context)
+            return False
+        return True
+
+    def handle_csi(self, context, parameter, intermediate, final):
+        if intermediate:
+            self.handle_draw(context)
+            return False
+        if not isinstance(parameter, CSIParameter):
+            parameter = CSIParameter(parameter)
+        if parameter.private is not None:
+            self.handle_draw(context)
+            if parameter.private == 0x3f and (final == 0x68 or final == 0x6c):
+                for mode in parameter.params:  # h, SM / l, RM
+                    if mode in _ALTERNATE_SCREEN_MODES:
+                        self.__switch_screen(mode, final == 0x68)
+            return False
+        n = parameter.get(0, 1) or 1
+        y, x = self.__y, self.__x
+        col = self.col
+        if final == 0x6d:  # m, SGR
+            self.__sgr(parameter)
+        elif final == 0x48 or final == 0x66:  # H, CUP / f, HVP
+            self.__moveto(n - 1, (parameter.get(1, 1) or 1) - 1)
+        elif final == 0x41:  # A, CUU
+            self.__moveto(max(y - n, min(y, self.__top)), x)
+        elif final == 0x42:  # B, CUD
+            self.__moveto(min(y + n, max(y, self.__bottom)), x)
+        elif final == 0x43:  # C, CUF
+            self.__moveto(y, x + n)
+        elif final == 0x44:  # D, CUB
+            self.__moveto(y, x - n)
+        elif final == 0x45:  # E, CNL
+            self.__moveto(y + n, 0)
+        elif final == 0x46:  # F, CPL
+            self.__moveto(y - n, 0)
+        elif final == 0x47 or final == 0x60:  # G, CHA / `, HPA
+            self.__moveto(y, n - 1)
+        elif final == 0x64:  # d, VPA
+            self.__moveto(n - 1, x)
+        elif final == 0x4a:  # J, ED
+            mode = parameter.get(0, 0)
+            if mode == 0:
+                self.__erase(y * col + x, self.row * col)
+                self.__touch(y, self.row - 1)
+            elif mode == 1:
+                self.__erase(0, y * col + x + 1)
+                self.__touch(0, y)
+            elif mode == 2 or mode == 3:
+                self.__erase(0, self.row * col)
+                self.__touch(0, self.row - 1)
+        elif final == 0x4b:  # K, EL
+            mode = parameter.get(0, 0)
+            if mode == 0:
+                self.__erase(y * col + x, (y + 1) * col)
+            elif mode == 1:
+                self.__erase(y * col, y * col + x + 1)
+            elif mode == 2:
+                self.__erase(y * col, (y + 1) * col)
+            self.__dirty[y] = 1
+        elif final == 0x58:  # X, ECH
+            self.__erase(y * col + x, y * col + min(x + n, col))
+            self.__dirty[y] = 1
+        elif final == 0x40 or final == 0x50:  # @, ICH / P, DCH
+            n = min(n, col - x)
+            start, end = y * col + x, (y + 1) * col
+            self.__split_wide(start)
+            if final == 0x40:
+                self.__split_wide(end - n)
+            else:
+                self.__split_wide(start + n)
+            for a in (self.__codes, self.__attrs, self.__widths,
+                      self.__charsets):
+                if final == 0x40:
+                    a[start + n:end] = a[start:end - n]
+                else:
+                    a[start:end - n] = a[start + n:end]
+            if final == 0x40:
+                self.__erase(start, start + n)
+            else:
+                self.__erase(end - n, end)
+            self.__dirty[y] = 1
+        elif final == 0x4c or final == 0x4d:  # L, IL / M, DL
+            if self.__top <= y <= self.__bottom:
+                if final == 0x4c:
+                    self.__scroll_down(y, self.__bottom, n)
+                else:
+                    self.__scroll_up(y, self.__bottom, n)
+                self.__x = 0
+                self.__wrapnext = False
+        elif final == 0x53:  # S, SU
+            self.__scroll_up(self.__top, self.__bottom, n)
+        elif final == 0x54:  # T, SD
+            self.__scroll_down(self.__top, self.__bottom, n)
+        elif final == 0x72:  # r, DECSTBM
+            top = (parameter.get(0, 1) or 1) - 1
+            bottom = (parameter.get(1, self.row) or self.row) - 1
+            bottom = min(bottom, self.row - 1)
+            if top < bottom:
+                self.__top, self.__bottom = top, bottom
+                self.__moveto(0, 0)
+        else:
+            self.handle_draw(context)
+            return False
+        return True
+
+    def handle_draw(self, context):
+        ''' write the dirty rows to the terminal, and put the cursor (and
+            the charsets) back '''
+        dirty = self.__dirty
+        g0, g1 = self.__designations
+        charsets = (g0, g1, self.__shift)
+        drawing = any(dirty)
+        if not drawing and charsets == self.__shown:
+            return
+        codes = self.__codes
+        attrs = self.__attrs
+        widths = self.__widths
+        cellsets = self.__charsets
+        col = self.col
+        shown, shown_g1, shift = self.__shown
+        chunks = []
+        if drawing and shift:
+            chunks.append(u'\x0f')  # SI, the cells are written with G0
+            shift = 0
+        for y in xrange(self.row):
+            if not dirty[y]:
+                continue
+            dirty[y] = 0
+            chunks.append(u'\x1b[%d;1H' % (y + 1))
+            start = y * col
+            end = start + col
+            # trailing blanks are erased with EL
+            while end > start and codes[end - 1] == 0x20 \
+                    and attrs[end - 1] == _ATTR_DEFAULT \
+                    and widths[end - 1] == 1:
+                end -= 1
+            attr = _ATTR_DEFAULT
+            run = []
+            for i in xrange(start, end):
+                if not widths[i]:
+                    continue
+                if attrs[i] != attr or cellsets[i] != shown:
+                    if run:
+                        chunks.append(_fromcodepoints(run))
+                        run = []
+                    if attrs[i] != attr:
+                        attr = attrs[i]
+                        if attr == _ATTR_DEFAULT:
+                            chunks.append(u'\x1b[m')
+                        else:
+                            chunks.append(_sgr(attr))
+                    if cellsets[i] != shown:
+                        shown = cellsets[i]
+                        chunks.append(u'\x1b(' + unichr(shown))
+                run.append(codes[i])
+            if run:
+                chunks.append(_fromcodepoints(run))
+            if attr != _ATTR_DEFAULT:
+                chunks.append(u'\x1b[m')
+            if end < start + col:
+                chunks.append(u'\x1b[K')
+        if drawing:
+            chunks.append(u'\x1b[%d;%dH' % (self.__y + 1, self.__x + 1))
+        if shown != g0:
+            chunks.append(u'\x1b(' + unichr(g0))
+        if shown_g1 != g1:
+            chunks.append(u'\x1b)' + unichr(g1))
+        if shift != self.__shift:
+            chunks.append(u'\x0e' if self.__shift else u'\x0f')  # SO / SI
+        self.__shown = charsets
+        context.putu(u''.join(chunks))
+
+    def handle_resize(self, context, row, col):
+        codes = self.__codes
+        attrs = self.__attrs
+        widths = self.__widths
+        cellsets = self.__charsets
+        oldcol = self.col
+        rows = min(row, self.row)
+        cols = min(col, oldcol)
+        y, x, attr = self.__y, self.__x, self.__attr
+        alternate = self.__alternate
+        designations = self.__designations
+        shift = self.__shift
+        shown = self.__shown
+        self.__init__(row, col)
+        self.__alternate = alternate
+        self.__designations = designations
+        self.__shift = shift
+        self.__shown = shown
+        for i in xrange(rows):
+            src = i * oldcol
+            dst = i * col
+            self.__codes[dst:dst + cols] = codes[src:src + cols]
+            self.__attrs[dst:dst + cols] = attrs[src:src + cols]
+            self.__widths[dst:dst + cols] = widths[src:src + cols]
+            self.__charsets[dst:dst + cols] = cellsets[src:src + cols]
+        self.__attr = attr
+        self.__moveto(y, x)
+
+
+###############################################################################
+#
+# Output optimizer
+#
+# OutputOptimizer rewrites the text which OutputBuffer is about to write,
+# keeping the SGR attributes and the cursor position the terminal has. It
+# holds back SGR sequences and cursor motions until something else is
+# written, drops the ones which change nothing, and writes the rest as the
+# shortest equivalent sequences (SGR from the current attributes or from
+# the default, CR/LF/BS or relative moves instead of CUP).
+#
+# It assumes the terminal starts with the default modes and the scrolling
+# region of the full screen, and that everything written to it goes through
+# the optimizer: the OutputBuffers writing to one terminal (the processes of
+# a Session) share one, and rewrite their text when they flush, in the order
+# the terminal gets it. It tracks the cursor only while it knows the size of
+# the screen, and forgets what it knows on sequences it does not understand,
+# on characters of ambiguous width and on bytes written with
+# OutputBuffer.writebytes().
+#
+_OPTIMIZER_TOKEN = re.compile(u'([^\x00-\x1f\x7f-\x9f]+)'
+                              u'|(\x1b\\[([0-?]*)([ -/]*)([@-~]))'
+                              u'|(\x1b([P\\]X^_])[^\x07\x18\x1a\x1b]*'
+                              u'(\x07|\x1b\\\\)?)'
+                              u'|(\x1b([ -/]*)([0-~]))'
+                              u'|([\x00-\x1f\x7f-\x9f])')
+
+# DEC private modes which move neither the cursor nor the scrolling region
+_HARMLESS_MODES = frozenset([1, 12, 25, 1000, 1001, 1002, 1003, 1004, 1005,
+                             1006, 1015, 2004])
+
+# modes under which the cursor does not move the way OutputOptimizer expects,
+# (private, number) -> whether setting (True) or resetting it breaks it
+_TRACKING_MODES = {(True, 6): True,     # DECOM
+                   (True, 7): False,    # DECAWM
+                   (True, 69): True,    # DECLRMM
+                   (False, 20): True}   # LNM
+
+_SGR_DEFAULT = (0, None, None)
+
+# the number of the SGR transitions OutputOptimizer remembers (each way)
+_SGR_CACHE_SIZE = 1024
+
+
+def _apply_sgr(attr, params):
+    ''' the attribute (flags, foreground, background) after the SGR, or
+        None if it is not known. The colors are the normalized parameters
+        which set them ("31", "38;5;208", ...), None for the default '''
+    fields = params.split(u';')
+    i = 0
+    while i < len(fields):
+        field = fields[i]
+        i += 1
+        if u':' in field:
+            sub = field.split(u':')
+            if attr is None or sub[0] not in (u'38', u'48') \
+                    or not (sub[1:2] == [u'5'] and len(sub) == 3
+                            or sub[1:2] == [u'2'] and len(sub) in (5, 6)):
+                return None
+            color = field
+            value = int(sub[0])
+        else:
+            if field and not field.isdigit():
+                return None
+            value = int(field or 0)
+            if value == 0:
+                attr = _SGR_DEFAULT
+                continue
+            if attr is None:
+                return None
+            if value == 38 or value == 48:
+                kind = fields[i:i + 1]
+                if kind == [u'5']:
+                    values = fields[i + 1:i + 2]
+                    n = 1
+                elif kind == [u'2']:
+                    values = fields[i + 1:i + 4]
+                    n = 3
+                else:
+                    return None
+                if len(values) != n \
+                        or not all(v.isdigit() or not v for v in values):
+                    return None
+                color = u';'.join([str(value), kind[0]]
+                                  + [str(int(v or 0)) for v in values])
+                i += n + 1
+            else:
+                color = str(value)
+        flags, fg, bg = attr
+        if value in _SGR_FLAGS:
+            flags |= _SGR_FLAGS[value]
+        elif value in _SGR_RESETS:
+            flags &= ~_SGR_RESETS[value]
+        elif 30 <= value <= 38 or 90 <= value <= 97:
+            fg = color
+        elif value == 39:
+            fg = None
+        elif 40 <= value <= 48 or 100 <= value <= 107:
+            bg = color
+        elif value == 49:
+            bg = None
+        else:
+            return None
+        attr = (flags, fg, bg)
+    return attr
+
+
+def _sgr_params(attr, base):
+    ''' the SGR parameters which change the attribute base to attr '''
+    flags, fg, bg = attr
+    baseflags, basefg, basebg = base
+    params = []
+    removed = baseflags & ~flags
+    added = flags & ~baseflags
+    for value, mask in sorted(_SGR_RESETS.items()):
+        if removed & mask:
+            params.append(str(value))
+            added |= flags & mask  # 22 resets both bold and dim
+    for value, flag in sorted(_SGR_FLAGS.items()):
+        if added & flag:
+            params.append(str(value))
+    if fg != basefg:
+        params.append(fg or u'39')
+    if bg != basebg:
+        params.append(bg or u'49')
+    return params
+
+
+def _shortest(candidates):
+    return min(candidates, key=len)
+
+
+class OutputOptimizer:
+
+    ''' rewrite an output stream to the shortest equivalent sequences of SGR
+        and cursor motion
+
+    >>> optimizer = OutputOptimizer(24, 80)
+    >>> optimizer.rewrite(u"\\x1b[0m\\x1b[0m\\x1b[1mA\\x1b[1m\\x1b[0;1mB")
+    u'\\x1b[0;1mAB'
+    >>> optimizer.rewrite(u"\\x1b[1;1Habc\\x1b[1;1H\\x1b[2;3Hd\\x1b[2;3H")
+    u'\\x1b[Habc\\n\\x08d\\x08'
+    >>> optimizer.rewrite(u"\\x1b[0m\\x1b[31mx\\x1b[1;38;5;208mx\\x1b[m")
+    u'\\x1b[0;31mx\\x1b[1;38;5;208mx\\x1b[m'
+    >>> optimizer.rewrite(u"\\x1b[?1049h\\x1b[5;1Hz\\x1b[5;1H")
+    u'\\x1b[?1049h\\x1b[5Hz\\r'
+    '''
+
+    def __init__(self, row=None, col=None):
+        self.__modes = set()
+        self.__attr = None
+        self.__pending_attr = None
+        self.__target = None
+        self.__y = None
+        self.__x = None
+        self.__row = None
+        self.__col = None
+        self.__top = None
+        self.__bottom = None
+        self.__sgr_cache = {}  # (attr, current) -> SGR
+        self.__apply_cache = {}  # (attr, parameters) -> attr
+        if row and col:
+            self.resize(row, col)
+
+    def resize(self, row, col):
+        ''' the screen was resized (terminals reset the scrolling region) '''
+        self.__row = row
+        self.__col = col
+        self.__top = 0
+        self.__bottom = row - 1
+        self.__y = None
+        self.__x = None
+
+    def invalidate(self):
+        ''' forget the cursor position and the attributes, after something
+            was written to the terminal bypassing the optimizer '''
+        self.__target = None
+        self.__pending_attr = None
+        self.__y = None
+        self.__x = None
+        self.__attr = None
+
+    def rewrite(self, text):
+        ''' returns the text rewritten, with nothing held back '''
+        out = []
+        for m in _OPTIMIZER_TOKEN.finditer(text):
+            run, csi, control_string, esc, c = m.group(1, 2, 6, 9, 12)
+            if run is not None:
+                self.__flush(out)
+                out.append(run)
+                self.__advance(run)
+            elif csi is not None:
+                self.__csi(out, csi, *m.group(3, 4, 5))
+            elif control_string is not None:
+                self.__flush(out)
+                out.append(control_string)
+                if m.group(7) != u']' or m.group(8) is None:
+                    self.invalidate()  # DCS may draw, or the string is cut
+            elif esc is not None:
+                self.__esc(out, esc, *m.group(10, 11))
+            else:
+                self.__control(out, c)
+        self.__flush(out)
+        return u''.join(out)
+
+    def __tracking(self):
+        return self.__col is not None and not self.__modes
+
+    def __position(self):
+        ''' where the cursor will be, (y, x), either may be None. x is col
+            if the next character wraps '''
+        if self.__target is not None:
+            return self.__target
+        return self.__y, self.__x
+
+    def __flush(self, out):
+        ''' write the pending cursor motion and SGR '''
+        if self.__target is not None:
+            out.append(self.__motion(*self.__target))
+            self.__y, self.__x = self.__target
+            self.__target = None
+        attr = self.__pending_attr
+        if attr is not None:
+            self.__pending_attr = None
+            if attr != self.__attr:
+                out.append(self.__sgr(attr))
+                self.__attr = attr
+
+    def __sgr(self, attr):
+        ''' the shortest SGR which changes the current attribute to attr '''
+        key = (attr, self.__attr)
+        cache = self.__sgr_cache
+        if key in cache:
+            return cache[key]
+        if attr == _SGR_DEFAULT:
+            sgr = u'\x1b[m'
+        else:
+            candidates = [u'\x1b[%sm' % u';'.join(
+                [u'0'] + _sgr_params(attr, _SGR_DEFAULT))]
+            if self.__attr is not None:
+                candidates.append(u'\x1b[%sm' % u';'.join(
+                    _sgr_params(attr, self.__attr)))
+            sgr = _shortest(candidates)
+        if len(cache) >= _SGR_CACHE_SIZE:
+            cache.clear()
+        cache[key] = sgr
+        return sgr
+
+    def __motion(self, ty, tx):
+        ''' the shortest sequence which moves the cursor to (ty, tx) '''
+        y, x = self.__y, self.__x
+        if (y, x) == (ty, tx):
+            return u''
+        if tx == 0:
+            candidates = [u'\x1b[%dH' % (ty + 1) if ty else u'\x1b[H']
+        else:
+            candidates = [u'\x1b[%d;%dH' % (ty + 1, tx + 1)]
+        if y is None:
+            return candidates[0]
+        dy = ty - y
+        if dy == 0:
+            vertical = u''
+        elif dy > 0 and ty <= (self.__bottom if y <= self.__bottom
+                               else self.__row - 1):
+            vertical = _shortest([u'\n' * dy, u'\x1b[%dB' % dy])
+        elif dy < 0 and ty >= (self.__top if y >= self.__top else 0):
+            vertical = _shortest([u'\x1bM' * -dy, u'\x1b[%dA' % -dy])
+        else:
+            return candidates[0]
+        if x is not None and x >= self.__col:
+            x = None  # the next character wraps
+        if x == tx:
+            return vertical
+        if tx == 0:
+            candidates.append(vertical + u'\r')
+        else:
+            candidates.append(vertical + u'\r\x1b[%dC' % tx)
+            candidates.append(vertical + u'\x1b[%dG' % (tx + 1))
+        if x is not None:
+            dx = tx - x
+            if dx > 0:
+                candidates.append(vertical + u'\x1b[%dC' % dx)
+            else:
+                candidates.append(vertical + u'\x08' * -dx)
+                candidates.append(vertical + u'\x1b[%dD' % -dx)
+        return _shortest(candidates)
+
+    def __move(self, out, source, y, x):
+        ''' hold the cursor motion back if the destination is known '''
+        if not self.__tracking():
+            y = x = None
+        if y is not None and x is not None:
+            self.__target = (y, x)
+        else:
+            self.__flush(out)
+            out.append(source)
+            self.__y, self.__x = y, x
+
+    def __linefeed(self):
+        y = self.__y
+        if y is None or not self.__tracking():
+            self.__y = None
+        elif y != self.__bottom and y < self.__row - 1:
+            self.__y = y + 1
+
+    def __index(self, down):
+        ''' LF/IND or RI, which keep the column (if it is known) '''
+        if down:
+            self.__linefeed()
+        elif self.__y is None or not self.__tracking():
+            self.__y = None
+        elif self.__y != self.__top and self.__y > 0:
+            self.__y -= 1
+        if self.__x is not None and self.__x >= self.__col:
+            self.__x = None  # whether the wrap is still pending differs
+
+    def __advance(self, run):
+        ''' move the cursor over the printed text '''
+        x = self.__x
+        if x is None or not self.__tracking():
+            self.__x = None
+            return
+        col = self.__col
+        if _ASCII_PRINTABLE_PATTERN.match(run):
+            widths = None
+            width = len(run)
+        else:
+            widths = []
+            for c in _iter_codepoints(run):
+                width = _width_class(c)
+                if width > _WIDTH_WIDE or c > 0xffff:
+                    # ambiguous, or emoji and others terminals disagree on
+                    self.__x = None
+                    return
+                widths.append(width)
+        if widths is None:
+            if x >= col:
+                x = 0
+                self.__linefeed()
+            x += width
+            if x > col:
+                n = (x - 1) // col
+                for i in xrange(min(n, self.__row)):
+                    self.__linefeed()
+                x -= n * col
+        else:
+            for width in widths:
+                if width == 0:
+                    continue
+                if x + width > col:
+                    x = 0
+                    self.__linefeed()
+                x += width
+        self.__x = x
+
+    def __csi(self, out, source, params, intermediate, final):
+        if final == u'm' and not intermediate \
+                and params[:1] not in (u'<', u'=', u'>', u'?'):
+            attr = self.__pending_attr
+            if attr is None:
+                attr = self.__attr
+            key = (attr, params)
+            cache = self.__apply_cache
+            if key in cache:
+                attr = cache[key]
+            else:
+                attr = _apply_sgr(attr, params)
+                if len(cache) >= _SGR_CACHE_SIZE:
+                    cache.clear()
+                cache[key] = attr
+            if attr is not None:
+                self.__pending_attr = attr
+                return
+            self.__flush(out)
+            out.append(source)
+            self.__attr = None
+            return
+        if intermediate or params[:1] in (u'<', u'=', u'>') \
+                or not all(p.isdigit() or not p
+                           for p in params.lstrip(u'?').split(u';')):
+            self.__flush(out)
+            out.append(source)
+            self.invalidate()
+            return
+        private = params[:1] == u'?'
+        values = [int(p or 0) for p in params.lstrip(u'?').split(u';')]
+        if private or final in u'hl':
+            self.__flush(out)
+            out.append(source)
+            if final in u'hl':
+                self.__mode(private, values, final == u'h')
+            else:
+                self.invalidate()
+            return
+        n = max(values[0], 1)
+        y, x = self.__position()
+        if x is not None and x >= self.__col:
+            x = None  # the next character wraps
+        row, col = self.__row, self.__col
+        if final in u'HfGd`':
+            if row is None:
+                y = x = None
+            elif final in u'Hf':
+                y = min(n, row) - 1
+                x = min(max(values[1:2] + [1]), col) - 1
+            elif final == u'd':
+                y = min(n, row) - 1
+            else:
+                x = min(n, col) - 1
+            self.__move(out, source, y, x)
+        elif final in u'ABEF':
+            if y is not None:
+                if final in u'AF':
+                    y = max(y - n, self.__top if y >= self.__top else 0)
+                else:
+                    y = min(y + n,
+                            self.__bottom if y <= self.__bottom else row - 1)
+            if final in u'EF':
+                x = 0
+            self.__move(out, source, y, x)
+        elif final in u'CD':
+            if x is not None:
+                if final == u'C':
+                    x = min(x + n, col - 1)
+                else:
+                    x = max(x - n, 0)
+            self.__move(out, source, y, x)
+        else:
+            self.__flush(out)
+            out.append(source)
+            if final == u'r':  # DECSTBM
+                if row is not None:
+                    top = max(values[0], 1) - 1
+                    bottom = min(max(values[1:2] + [0]) or row, row) - 1
+                    if top < bottom:
+                        self.__top, self.__bottom = top, bottom
+                        if self.__tracking():
+                            self.__y = self.__x = 0
+            elif final in u'LM':  # IL, DL
+                if self.__y is None or self.__top is None:
+                    self.__x = None
+                elif self.__top <= self.__y <= self.__bottom:
+                    self.__x = 0
+            elif final not in u'JKX@PSTcns':
+                self.invalidate()
+
+    def __mode(self, private, values, enable):
+        for value in values:
+            if private and value in _HARMLESS_MODES or not private \
+                    and value in (4, 12):
+                continue
+            breaks = _TRACKING_MODES.get((private, value))
+            if breaks is None:
+                self.invalidate()
+                continue
+            if breaks == enable:
+                self.__modes.add((private, value))
+            else:
+                self.__modes.discard((private, value))
+            if private and value == 6:  # DECOM homes the cursor
+                self.__y = self.__x = None
+                if self.__tracking():
+                    self.__y = self.__x = 0
+            elif not self.__tracking():
+                self.__y = self.__x = None
+
+    def __esc(self, out, source, intermediate, final):
+        self.__flush(out)
+        out.append(source)
+        if intermediate:
+            if intermediate not in u'()*+-./':
+                self.invalidate()
+        elif final == u'D' or final == u'M':  # IND, RI
+            self.__index(final == u'D')
+        elif final == u'E':  # NEL
+            self.__linefeed()
+            self.__x = 0 if self.__tracking() else None
+        elif final == u'c':  # RIS
+            self.__modes.clear()
+            self.__attr = _SGR_DEFAULT
+            if self.__row is not None:
+                self.resize(self.__row, self.__col)
+                self.__y = self.__x = 0
+        elif final not in u'7=>H\\':
+            self.invalidate()
+
+    def __control(self, out, c):
+        if c == u'\r' or c == u'\x08':
+            y, x = self.__position()
+            if c == u'\r':
+                x = 0
+            elif x is not None and x < self.__col:
+                x = max(x - 1, 0)
+            else:
+                x = None
+            self.__move(out, c, y, x)
+            return
+        self.__flush(out)
+        out.append(c)
+        if u'\n' <= c <= u'\x0c':  # LF, VT, FF
+            self.__index(True)
+        elif c == u'\t':
+            self.__x = None
+        elif c == u'\x1b' or c >= u'\x80':
+            self.invalidate()
+
+
+###############################################################################
+#
+# Output buffer implementation
+#
+class WriteQueue:
+
+    ''' non-blocking writer for a file descriptor. The data which the fd
+        does not accept at once is kept in the queue until flush() is
+        called again (when the fd becomes writable). It is shared by the
+        OutputBuffers which write to the same fd, so that the order of the
+        bytes is kept.
+
+    >>> r, w = os.pipe()
+    >>> queue = WriteQueue(w)
+    >>> queue.write("x" * 100000)
+    >>> 0 < queue.pending() < 100000
+    True
+    >>> len(os.read(r, 100000)) + queue.pending()
+    100000
+    >>> queue.flush()
+    True
+    >>> queue.pending()
+    0
+    >>> queue.close()
+    >>> os.close(r); os.close(w)
+    '''
+
+    def __init__(self, fd, onqueued=None, closefd=False):
+        self.__fd = fd
+        self.__onqueued = onqueued
+        self.__closefd = closefd
+        self.__flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, self.__flags | os.O_NONBLOCK)
+        self.__chunks = []
+        self.__size = 0
+
+    def fileno(self):
+        return self.__fd
+
+    def pending(self):
+        ''' returns the number of the bytes waiting in the queue '''
+        return self.__size
+
+    def write(self, data):
+        if not self.__chunks:
+            n = self.__write(data)
+            if n == len(data):
+                return
+            data = data[n:]
+        self.__chunks.append(data)
+        self.__size += len(data)
+        if self.__onqueued is not None:
+            self.__onqueued(self)
+
+    def flush(self):
+        ''' write the queued data as much as the fd accepts, returns True
+            when the queue becomes empty '''
+        chunks = self.__chunks
+        while chunks:
+            data = chunks[0]
+            n = self.__write(data)
+            self.__size -= n
+            if n < len(data):
+                chunks[0] = data[n:]
+                return False
+            del chunks[0]
+        return True
+
+    def __write(self, data):
+        while True:
+            try:
+                return os.write(self.__fd, data)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return 0
+                elif e.errno != errno.EINTR:
+                    raise
+
+    def close(self):
+        ''' restore the blocking mode of the fd, and write the rest of the
+            queue (and close the fd if closefd is set) '''
+        try:
+            fcntl.fcntl(self.__fd, fcntl.F_SETFL, self.__flags)
+        except IOError:
+            return  # already closed
+        try:
+            self.flush()
+        finally:
+            if self.__closefd:
+                os.close(self.__fd)
+
+
+def _open_writer(fd):
+    ''' open the terminal at fd again for writing, so that a WriteQueue can
+        make the new file description non-blocking without affecting the
+        others which share the one of fd (e.g. stdin, or sys.stdout of the
+        other code). Returns fd itself if it is not a terminal.
+
+    >>> master, slave = pty.openpty()
+    >>> fd = _open_writer(slave)
+    >>> queue = WriteQueue(fd, closefd=True)
+    >>> fd != slave, fcntl.fcntl(slave, fcntl.F_GETFL) & os.O_NONBLOCK
+    (True, 0)
+    >>> queue.close()
+    >>> os.close(master); os.close(slave)
+    '''
+    try:
+        if os.isatty(fd):
+            return os.open(os.ttyname(fd), os.O_WRONLY | os.O_NOCTTY)
+    except OSError:
+        pass
+    return fd
+
+
+class OutputBuffer:
+
+    ''' accumulate output text and bytes, encode the text at once and write
+        them to the target with a single os.write (or write() call, if the
+        target has no file descriptor) per flush. It flushes early when the
+        buffered size reaches the high-water mark. With a WriteQueue, the
+        data goes to the queue instead, and flush() never blocks. With an
+        OutputOptimizer, the text is rewritten by it when it is flushed.
+
+    >>> from StringIO import StringIO
+    >>> output = StringIO()
+    >>> buf = OutputBuffer(output, "UTF-8", highwater=8)
+    >>> buf.write(u"\\u3042")
+    >>> buf.writebytes("\\x1b[m")
+    >>> output.getvalue()
+    ''
+    >>> buf.flush()
+    >>> output.getvalue()
+    '\\xe3\\x81\\x82\\x1b[m'
+    >>> buf.write(u"0123456789")
+    >>> output.getvalue()
+    '\\xe3\\x81\\x82\\x1b[m0123456789'
+
+        The buffers writing to one terminal share an optimizer, which
+        rewrites their text in the order they flush it:
+
+    >>> output = StringIO()
+    >>> optimizer = OutputOptimizer(24, 80)
+    >>> a = OutputBuffer(output, optimizer=optimizer)
+    >>> b = OutputBuffer(output, optimizer=optimizer)
+    >>> a.write(u"\\x1b[1;1Hab")
+    >>> b.write(u"\\x1b[1;1Hx")
+    >>> b.flush()
+    >>> a.flush()
+    >>> output.getvalue()
+    '\\x1b[Hx\\rab'
+    '''
+
+    def __init__(self, output, termenc='UTF-8', highwater=_OUTPUT_HIGHWATER,
+                 queue=None, optimizer=None):
+        self.__output = output
+        self.__queue = queue
+        self.__optimizer = optimizer
+        self.__encode = codecs.getencoder(termenc)
+        try:
+            self.__fd = output.fileno()
+        except (AttributeError, IOError, ValueError):
+            self.__fd = None
+        self.__text = []
+        self.__chunks = []
+        self.__size = 0
+        self.__written = 0
+        self.__highwater = highwater
+
+    def write(self, text):
+        ''' buffer unicode (or ASCII str) text '''
+        self.__text.append(text)
+        self.__size += len(text)
+        if self.__size >= self.__highwater:
+            self.flush()
+
+    def writebytes(self, data):
+        ''' buffer encoded bytes '''
+        if self.__text:
+            self.__encodetext()
+        self.__chunks.append(data)
+        self.__size += len(data)
+        if self.__size >= self.__highwater:
+            self.flush()
+
+    def __encodetext(self):
+        text = self.__text
+        data = u''.join(text)
+        del text[:]
+        if self.__optimizer is not None:
+            # rewritten by flush(), the optimizer may be shared
+            self.__chunks.append(data)
+        else:
+            self.__chunks.append(self.__encode(data)[0])
+
+    def written(self):
+        ''' returns the number of the bytes flushed so far '''
+        return self.__written
+
+    def flush(self):
+        ''' write all buffered data to the target '''
+        if self.__text:
+            self.__encodetext()
+        chunks = self.__chunks
+        if not chunks:
+            return
+        optimizer = self.__optimizer
+        if optimizer is not None:
+            for i, chunk in enumerate(chunks):
+                if isinstance(chunk, unicode):
+                    chunks[i] = self.__encode(optimizer.rewrite(chunk))[0]
+                else:
+                    optimizer.invalidate()  # written by writebytes()
+        data = ''.join(chunks)
+        del chunks[:]
+        self.__size = 0
+        self.__written += len(data)
+        fd = self.__fd
+        if fd is None:
+            self.__output.write(data)
+            return
+        try:
+            self.__output.flush()
+        except (AttributeError, IOError):
+            pass
+        if self.__queue is not None:
+            self.__queue.write(data)
+            return
+        while data:
+            try:
+                n = os.write(fd, data)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    # wait until the target becomes writable
+                    select.select([], [fd], [])
+                    continue
+                elif e.errno == errno.EINTR:
+                    continue
+                raise
+            if n == len(data):
+                break
+            # partial write
+            data = buffer(data, n)
+
+
+###############################################################################
+#
+# Dispatcher implementation
+#
+class ParseContext(OutputStream, EventDispatcher):
+
+    def __init__(self,
+                 output,
+                 termenc='UTF-8',
+                 scanner=DefaultScanner(),
+                 handler=DefaultHandler(),
+                 buffering=False,
+                 csiparameter=False,
+                 queue=None,
+                 maxcontrolstring=None,
+                 optimize=False,
+                 optimizer=None):
+        # optimizer: the OutputOptimizer to use with optimize, shared by
+        # the contexts writing to the same terminal
+        self.__termenc = termenc
+        self.__scanner = scanner
+        self.sethandler(handler)
+        self._c1 = 0
+        self.__csiparameter = csiparameter
+        self.__maxcontrolstring = maxcontrolstring
+        self.__string_prefix = None
+        self.__string_chunks = None
+        self.__string_size = 0
+        self.__string_passthrough = False
+
+        if optimize:
+            self.__optimizer = optimizer or OutputOptimizer()
+            buffering = True
+        else:
+            self.__optimizer = None
+        if buffering:
+            self._output = OutputBuffer(output, termenc, queue=queue,
+                                        optimizer=self.__optimizer)
+        else:
+            self._output = codecs.getwriter(termenc)(output)
+        self._target_output = output
+        self._buffering = buffering
+
+    def __iter__(self):
+        return self.__scanner.__iter__()
+
+    def assign(self, data):
+        self.__scanner.assign(data, self.__termenc)
+
+    def has_textrun(self):
+        return isinstance(self.__scanner, (DefaultScanner, EUCScanner))
+
+    def accepts_view(self):
+        ''' whether assign() takes a memoryview as well as str '''
+        return isinstance(self.__scanner, (DefaultScanner, EUCScanner))
+
+    def streams_control_string(self):
+        ''' whether the parser should dispatch the values of control strings
+            in chunks (dispatch_control_string_start/data/end) '''
+        return self.__streaming or self.__maxcontrolstring is not None
+
+    def resize(self, row, col):
+        ''' tell the output optimizer (if any) the size of the screen '''
+        if self.__optimizer is not None:
+            self.__optimizer.resize(row, col)
+
+    def sethandler(self, handler):
+        self.__handler = handler
+        if _accepts_text(handler):
+            self.__handle_text = handler.handle_text
+        else:
+            self.__handle_text = None
+        self.__streaming = _streams_control_string(handler)
+
+    def putu(self, data):
+        self._output.write(data)
 
     def puts(self, data):
-        self._target_output.write(data)
+        if self._buffering:
+            self._output.writebytes(data)
+        else:
+            self._target_output.write(data)
 
     def put(self, c):
         if c < 0x80:
@@ -853,7 +3561,7 @@ class ParseContext(OutputStream, EventDispatcher):
     # obsoluted!!
     def writestring(self, data):
         try:
-            self._target_output.write(data)
+            self.puts(data)
         except Exception:
             self._output.write(data)
 
@@ -864,22 +3572,32 @@ class ParseContext(OutputStream, EventDispatcher):
 
     def flush(self):
         if self._buffering:
-            self._target_output.write(self._output)
+            self._output.flush()
         try:
             self._target_output.flush()
         except IOError:
             pass
 
 # EventDispatcher
-    def dispatch_esc(self, intermediate, final):
-        if not self.__handler.handle_esc(self, intermediate, final):
+    def dispatch_esc(self, intermediate, final, source=None):
+        if self.__handler.handle_esc(self, intermediate, final):
+            pass
+        elif source is not None:
+            self.putu(source)
+        else:
             self.put(0x1b)  # ESC
             for c in intermediate:
                 self.put(c)
             self.put(final)
 
-    def dispatch_csi(self, parameter, intermediate, final):
-        if not self.__handler.handle_csi(self, parameter, intermediate, final):
+    def dispatch_csi(self, parameter, intermediate, final, source=None):
+        if self.__csiparameter:
+            parameter = CSIParameter(parameter)
+        if self.__handler.handle_csi(self, parameter, intermediate, final):
+            pass
+        elif source is not None:
+            self.putu(source)
+        else:
             self.put(0x1b)  # ESC
             self.put(0x5b)  # [
             for c in parameter:
@@ -888,20 +3606,32 @@ class ParseContext(OutputStream, EventDispatcher):
                 self.put(c)
             self.put(final)
 
-    def dispatch_ss2(self, final):
-        if not self.__handler.handle_ss2(self, final):
+    def dispatch_ss2(self, final, source=None):
+        if self.__handler.handle_ss2(self, final):
+            pass
+        elif source is not None:
+            self.putu(source)
+        else:
             self.put(0x1b)  # ESC
             self.put(0x4e)  # N
             self.put(final)
 
-    def dispatch_ss3(self, final):
-        if not self.__handler.handle_ss3(self, final):
+    def dispatch_ss3(self, final, source=None):
+        if self.__handler.handle_ss3(self, final):
+            pass
+        elif source is not None:
+            self.putu(source)
+        else:
             self.put(0x1b)  # ESC
             self.put(0x4f)  # O
             self.put(final)
 
-    def dispatch_control_string(self, prefix, value):
-        if not self.__handler.handle_control_string(self, prefix, value):
+    def dispatch_control_string(self, prefix, value, source=None):
+        if self.__handler.handle_control_string(self, prefix, value):
+            pass
+        elif source is not None:
+            self.putu(source)
+        else:
             self.put(0x1b)  # ESC
             self.put(prefix)
             for c in value:
@@ -909,10 +3639,106 @@ class ParseContext(OutputStream, EventDispatcher):
             self.put(0x1b)  # ESC
             self.put(0x5c)  # \
 
+    def dispatch_control_string_start(self, prefix):
+        """ start a control string whose value follows in chunks.
+
+            A streaming handler consumes the string if its
+            handle_control_string_start returns True, otherwise the string
+            is passed through as it comes. For other handlers, the value is
+            buffered and given to handle_control_string as a whole, unless
+            it grows beyond maxcontrolstring code points; such a string is
+            passed through without the handler.
+
+        >>> from StringIO import StringIO
+        >>> output = StringIO()
+        >>> context = ParseContext(output, handler=_MockHandler(),
+        ...                        maxcontrolstring=4)
+        >>> context.dispatch_control_string_start(0x5d)
+        >>> context.dispatch_control_string_data(u"0;")
+        >>> context.dispatch_control_string_data(u"ab")
+        >>> context.dispatch_control_string_end()
+        (93, [48, 59, 97, 98])
+        >>> output.truncate(0)
+        >>> context.dispatch_control_string_start(0x50)
+        >>> context.dispatch_control_string_data(u"q#0;")
+        >>> context.dispatch_control_string_data(u"2;0")
+        >>> context.dispatch_control_string_end()
+        >>> output.getvalue()
+        '\\x1bPq#0;2;0\\x1b\\\\'
+        """
+        self.__string_prefix = prefix
+        self.__string_size = 0
+        if self.__streaming:
+            self.__string_chunks = None
+            handler = self.__handler
+            if handler.handle_control_string_start(self, prefix):
+                self.__string_passthrough = False
+                return
+        else:
+            self.__string_chunks = []
+            self.__string_passthrough = False
+            return
+        self.__string_passthrough = True
+        self.put(0x1b)  # ESC
+        self.put(prefix)
+
+    def dispatch_control_string_data(self, chunk):
+        if self.__streaming:
+            self.__handler.handle_control_string_data(self, chunk)
+        elif self.__string_chunks is not None:
+            chunks = self.__string_chunks
+            chunks.append(chunk)
+            self.__string_size += len(chunk)
+            if self.__string_size <= self.__maxcontrolstring:
+                return
+            # too long to buffer, pass it through
+            self.__string_chunks = None
+            self.__string_passthrough = True
+            self.put(0x1b)  # ESC
+            self.put(self.__string_prefix)
+            for chunk in chunks:
+                self.putu(chunk)
+            return
+        if self.__string_passthrough:
+            self.putu(chunk)
+
+    def dispatch_control_string_end(self, abort=None):
+        """ end the control string. abort is None if it is terminated by
+            ST (or BEL), otherwise the code points which cut it off. """
+        if self.__streaming:
+            self.__handler.handle_control_string_end(self, abort is None)
+        elif self.__string_chunks is not None:
+            value = _codepoints(u''.join(self.__string_chunks))
+            self.__string_chunks = None
+            if abort is None:
+                self.dispatch_control_string(self.__string_prefix, value)
+            else:
+                seq = [0x1b, self.__string_prefix] + value + abort
+                self.dispatch_invalid(seq)
+            return
+        if self.__string_passthrough:
+            self.__string_passthrough = False
+            if abort is None:
+                self.put(0x1b)  # ESC
+                self.put(0x5c)  # \
+            else:
+                for c in abort:
+                    self.put(c)
+
     def dispatch_char(self, c):
         if not self.__handler.handle_char(self, c):
             self.put(c)
 
+    def dispatch_text(self, text):
+        handle_text = self.__handle_text
+        if handle_text is None:
+            handle_char = self.__handler.handle_char
+            for c in _iter_codepoints(text):
+                if not handle_char(self, c):
+                    self.put(c)
+        elif not handle_text(self, text):
+            self.putu(text)
+
     def dispatch_invalid(self, seq):
         if not self.__handler.handle_invalid(self, seq):
             for c in seq:
@@ -923,8 +3749,17 @@ class ParseContext(OutputStream, EventDispatcher):
 #
 # DefaultPTY
 #
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
 class DefaultPTY(PTY):
 
+    # the masters of the open PTYs, which the worker processes (see
+    # WorkerProcess) must not keep open
+    _masters = set()
+
     def __init__(self, term, lang, command, stdin, row=None, col=None):
         self._stdin_fileno = stdin.fileno()
         backup = termios.tcgetattr(self._stdin_fileno)
@@ -938,12 +3773,21 @@ class DefaultPTY(PTY):
         self.__setupterm(self._stdin_fileno)
         self.pid = pid
         self._master = master
+        _set_cloexec(master)  # the commands of the other PTYs
+        DefaultPTY._masters.add(master)
+
+        # read() drains the master into a reusable buffer
+        flags = fcntl.fcntl(master, fcntl.F_GETFL)
+        fcntl.fcntl(master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.__reader = io.FileIO(master, 'rb', closefd=False)
+        self.__buffer = bytearray(_BUFFER_SIZE)
 
         if row and col:
             self.resize(row, col)
 
     def close(self):
         #self.restore_term()
+        DefaultPTY._masters.discard(self._master)
         try:
             os.close(self._master)
         except OSError, e:
@@ -1029,10 +3873,60 @@ class DefaultPTY(PTY):
         return self._stdin_fileno
 
     def read(self):
-        return os.read(self._master, _BUFFER_SIZE)
+        return self.read_view().tobytes()
+
+    def read_view(self):
+        ''' read all available data (at most _READ_LIMIT bytes) as one
+            batch, and return it as a memoryview of the reusable buffer,
+            which is valid until the next read. The buffer grows while the
+            reads fill it up, and shrinks again when the output slows
+            down. '''
+        buf = self.__buffer
+        view = memoryview(buf)
+        size = len(buf)
+        length = 0
+        try:
+            while True:
+                try:
+                    n = self.__reader.readinto(view[length:])
+                except IOError, e:
+                    if length:
+                        break  # raise it on the next read
+                    raise OSError(e.errno, e.strerror)
+                if not n:  # EAGAIN or EOF
+                    break
+                length += n
+                if length < size:
+                    continue
+                if size >= _READ_LIMIT:
+                    break
+                # sustained throughput, double the buffer
+                buf = bytearray(size * 2)
+                buf[:length] = view
+                view = memoryview(buf)
+                size = len(buf)
+        finally:
+            del view
+        data = memoryview(buf)[:length]
+        if length < size // 4 and size > _BUFFER_SIZE:
+            # the returned view keeps the old buffer alive
+            buf = bytearray(size // 2)
+        self.__buffer = buf
+        return data
 
     def write(self, data):
-        os.write(self._master, data)
+        # the master is non-blocking
+        while data:
+            try:
+                n = os.write(self._master, data)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    select.select([], [self._master], [])
+                    continue
+                elif e.errno == errno.EINTR:
+                    continue
+                raise
+            data = buffer(data, n)
 
     def flush(self):
         pass
@@ -1055,39 +3949,679 @@ class MockParseContext(ParseContext):
         ParseContext.__init__(self, output)
 
 
+###############################################################################
+#
+# Poller implementation
+#
+# poll() waits until some of the registered fds become ready (or the timeout
+# in seconds expires, None means forever) and returns the triple of the
+# lists of the readable fds, the writable fds and the fds with exceptional
+# conditions, in the same way as select.select does. register() watches
+# fds for reading, register_writer() for writing. Errors are raised as
+# select.error.
+#
+class SelectPoller(Poller):
+
+    ''' portable poller based on select(2)
+
+    >>> r, w = os.pipe()
+    >>> poller = SelectPoller()
+    >>> poller.register(r)
+    >>> poller.poll(0)
+    ([], [], [])
+    >>> os.write(w, "x")
+    1
+    >>> poller.poll(0) == ([r], [], [])
+    True
+    >>> poller.register_writer(w)
+    >>> poller.poll(0) == ([r], [w], [])
+    True
+    >>> poller.unregister_writer(w)
+    >>> poller.unregister(r)
+    >>> os.close(r); os.close(w)
+    '''
+
+    def __init__(self):
+        self.__readers = set()
+        self.__writers = set()
+
+    def register(self, fd):
+        self.__readers.add(fd)
+
+    def unregister(self, fd):
+        self.__readers.discard(fd)
+
+    def register_writer(self, fd):
+        self.__writers.add(fd)
+
+    def unregister_writer(self, fd):
+        self.__writers.discard(fd)
+
+    def poll(self, timeout=None):
+        readers = list(self.__readers)
+        return select.select(readers, list(self.__writers), readers, timeout)
+
+    def close(self):
+        self.__readers.clear()
+        self.__writers.clear()
+
+
+class PollPoller(Poller):
+
+    ''' poller based on poll(2), its cost does not depend on the fd numbers
+
+    >>> r, w = os.pipe()
+    >>> poller = PollPoller()
+    >>> poller.register(r)
+    >>> poller.poll(0)
+    ([], [], [])
+    >>> os.write(w, "x")
+    1
+    >>> poller.poll(0) == ([r], [], [])
+    True
+    >>> poller.register_writer(w)
+    >>> poller.poll(0) == ([r], [w], [])
+    True
+    >>> poller.unregister_writer(w)
+    >>> poller.unregister(r)
+    >>> os.close(r); os.close(w)
+    '''
+
+    def __init__(self):
+        self.__poll = select.poll()
+        self.__readers = set()
+        self.__writers = set()
+        self.__masks = {}
+
+    def __update(self, fd):
+        mask = 0
+        if fd in self.__readers:
+            mask |= select.POLLIN | select.POLLPRI
+        if fd in self.__writers:
+            mask |= select.POLLOUT
+        if mask == self.__masks.get(fd, 0):
+            return
+        if mask:
+            self.__poll.register(fd, mask)  # or modify
+            self.__masks[fd] = mask
+        else:
+            self.__poll.unregister(fd)
+            del self.__masks[fd]
+
+    def register(self, fd):
+        self.__readers.add(fd)
+        self.__update(fd)
+
+    def unregister(self, fd):
+        self.__readers.discard(fd)
+        self.__update(fd)
+
+    def register_writer(self, fd):
+        self.__writers.add(fd)
+        self.__update(fd)
+
+    def unregister_writer(self, fd):
+        self.__writers.discard(fd)
+        self.__update(fd)
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        events = self.__poll.poll(timeout)
+        # select(2) reports hang-ups and errors as readable (and writable)
+        failed = select.POLLHUP | select.POLLERR
+        readers = self.__readers
+        writers = self.__writers
+        rfd = [fd for fd, event in events
+               if event & (select.POLLIN | failed) and fd in readers]
+        wfd = [fd for fd, event in events
+               if event & (select.POLLOUT | failed) and fd in writers]
+        xfd = [fd for fd, event in events if event & select.POLLPRI]
+        return rfd, wfd, xfd
+
+    def close(self):
+        for fd in list(self.__masks):
+            self.__poll.unregister(fd)
+        self.__masks.clear()
+        self.__readers.clear()
+        self.__writers.clear()
+
+
+class EpollPoller(Poller):
+
+    ''' poller based on epoll(7) (Linux), O(1) for each wakeup
+
+    >>> r, w = os.pipe()
+    >>> poller = EpollPoller()
+    >>> poller.register(r)
+    >>> poller.poll(0)
+    ([], [], [])
+    >>> os.write(w, "x")
+    1
+    >>> poller.poll(0) == ([r], [], [])
+    True
+    >>> poller.register_writer(w)
+    >>> poller.poll(0) == ([r], [w], [])
+    True
+    >>> poller.unregister_writer(w)
+    >>> poller.unregister(r)
+    >>> os.close(r); os.close(w)
+    '''
+
+    def __init__(self):
+        self.__epoll = select.epoll()
+        self.__readers = set()
+        self.__writers = set()
+        self.__masks = {}
+
+    def __update(self, fd):
+        mask = 0
+        if fd in self.__readers:
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if fd in self.__writers:
+            mask |= select.EPOLLOUT
+        current = self.__masks.get(fd, 0)
+        if mask == current:
+            return
+        try:
+            if not mask:
+                del self.__masks[fd]
+                self.__epoll.unregister(fd)
+            elif current:
+                self.__masks[fd] = mask
+                self.__epoll.modify(fd, mask)
+            else:
+                self.__masks[fd] = mask
+                self.__epoll.register(fd, mask)
+        except IOError:
+            pass  # already closed
+
+    def register(self, fd):
+        self.__readers.add(fd)
+        self.__update(fd)
+
+    def unregister(self, fd):
+        self.__readers.discard(fd)
+        self.__update(fd)
+
+    def register_writer(self, fd):
+        self.__writers.add(fd)
+        self.__update(fd)
+
+    def unregister_writer(self, fd):
+        self.__writers.discard(fd)
+        self.__update(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self.__epoll.poll(timeout)
+        except IOError, e:
+            raise select.error(e.errno, e.strerror)
+        failed = select.EPOLLHUP | select.EPOLLERR
+        readers = self.__readers
+        writers = self.__writers
+        rfd = [fd for fd, event in events
+               if event & (select.EPOLLIN | failed) and fd in readers]
+        wfd = [fd for fd, event in events
+               if event & (select.EPOLLOUT | failed) and fd in writers]
+        xfd = [fd for fd, event in events if event & select.EPOLLPRI]
+        return rfd, wfd, xfd
+
+    def close(self):
+        self.__epoll.close()
+
+
+if hasattr(select, 'epoll'):
+    DefaultPoller = EpollPoller
+elif hasattr(select, 'poll'):
+    DefaultPoller = PollPoller
+else:
+    DefaultPoller = SelectPoller
+
+
+###############################################################################
+#
+# Timer implementation
+#
+class _TimerHandle:
+
+    def __init__(self, entry):
+        self.__entry = entry
+
+    def cancel(self):
+        self.__entry[2] = None
+
+
+class TimerQueue:
+
+    ''' heap of the deadlines of the callbacks which the Session loop runs,
+        timeout() gives the poll timeout until the next deadline. clock
+        returns the current time in seconds (Replayer gives a virtual one).
+
+    >>> timers = TimerQueue()
+    >>> timers.timeout() is None
+    True
+    >>> result = []
+    >>> t1 = timers.call_later(0, lambda: result.append(1))
+    >>> t2 = timers.call_later(0, lambda: result.append(2))
+    >>> t3 = timers.call_later(60, lambda: result.append(3))
+    >>> timers.timeout() == 0
+    True
+    >>> t2.cancel()
+    >>> timers.run()
+    >>> result
+    [1]
+    >>> 59 < timers.timeout() <= 60
+    True
+    >>> t3.cancel()
+    >>> timers.timeout() is None
+    True
+    '''
+
+    def __init__(self, clock=time.time):
+        self.__heap = []
+        self.__sequence = 0
+        self.__clock = clock
+
+    def call_later(self, delay, callback):
+        ''' run the callback after delay seconds, returns an object which
+            has cancel() '''
+        self.__sequence += 1
+        entry = [self.__clock() + delay, self.__sequence, callback]
+        heapq.heappush(self.__heap, entry)
+        return _TimerHandle(entry)
+
+    def timeout(self):
+        ''' returns the seconds until the next deadline, or None '''
+        heap = self.__heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return max(0, heap[0][0] - self.__clock())
+
+    def run(self):
+        ''' run the callbacks whose deadlines have passed '''
+        heap = self.__heap
+        now = self.__clock()
+        expired = []
+        while heap and heap[0][0] <= now:
+            expired.append(heapq.heappop(heap))
+        for entry in expired:
+            callback = entry[2]
+            if callback is not None:
+                entry[2] = None
+                callback()
+
+
+###############################################################################
+#
+# Render scheduler
+#
+class RenderScheduler:
+
+    ''' coalesces the draws (handle_draw and flush) requested by the output
+        of the processes, and runs them at most framerate times a second.
+
+        The first draw after a quiet period runs at once, and so does the
+        first one after an input (e.g. the echo of a keystroke); the rest
+        wait for the next frame.
+
+    >>> timers = TimerQueue()
+    >>> scheduler = RenderScheduler(timers.call_later, framerate=10)
+    >>> drawn = []
+    >>> draw = lambda: drawn.append(1)
+    >>> scheduler.request(draw)
+    >>> scheduler.request(draw)
+    >>> scheduler.request(draw)
+    >>> drawn
+    [1]
+    >>> 0 < timers.timeout() <= 0.1
+    True
+    >>> scheduler.interact()
+    >>> scheduler.request(draw)
+    >>> drawn
+    [1, 1]
+    >>> timers.timeout() is None
+    True
+    '''
+
+    def __init__(self, call_later, framerate=60):
+        self.__call_later = call_later
+        self.__interval = 1.0 / framerate
+        self.__last = 0
+        self.__pending = []
+        self.__timer = None
+        self.__urgent = False
+
+    def request(self, draw):
+        ''' run draw() in the current or the next frame '''
+        if draw not in self.__pending:
+            self.__pending.append(draw)
+        delay = self.__last + self.__interval - time.time()
+        if self.__urgent or delay <= 0:
+            self.__urgent = False
+            self.flush()
+        elif self.__timer is None:
+            self.__timer = self.__call_later(delay, self.__ontimer)
+
+    def interact(self):
+        ''' let the next draw run at once '''
+        self.__urgent = True
+
+    def cancel(self, draw):
+        if draw in self.__pending:
+            self.__pending.remove(draw)
+
+    def flush(self):
+        ''' run the pending draws now '''
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        pending = self.__pending
+        self.__pending = []
+        self.__last = time.time()
+        for draw in pending:
+            draw()
+
+    def __ontimer(self):
+        self.__timer = None
+        self.flush()
+
+
+###############################################################################
+#
+# Statistics
+#
+_HANDLER_METHODS = ('handle_start', 'handle_end', 'handle_csi', 'handle_esc',
+                    'handle_ss2', 'handle_ss3', 'handle_control_string',
+                    'handle_control_string_start',
+                    'handle_control_string_data',
+                    'handle_control_string_end',
+                    'handle_char', 'handle_text', 'handle_invalid',
+                    'handle_draw', 'handle_resize')
+
+
+class Statistics:
+
+    ''' counters and timers of the parse/dispatch pipeline of the processes.
+
+        Nothing is measured unless a Statistics is given to the Session;
+        then the parsers, the contexts and the handlers of each process are
+        timed when the process starts (see instrument_handler):
+
+          input.parse/output.parse      parser.parse (decode and dispatch)
+          input.decode/output.decode    decoding in the scanner
+          input.handle_*/output.handle_*
+                                        the events by type (root handler)
+          handler.<class>.handle_*      each filter, also inside of
+                                        FilterMultiplexer and FilterChain
+          input.flush/output.flush      flushes of the contexts
+
+        and the counters "input.bytes_read", "output.bytes_read",
+        "input.bytes_written", "output.bytes_written" (buffered contexts
+        only), "draws" and "esc_timeouts".
+
+    >>> statistics = Statistics()
+    >>> class Filter(DefaultHandler):
+    ...     def handle_char(self, context, c):
+    ...         return False
+    >>> handler = FilterMultiplexer(Filter(), DefaultHandler())
+    >>> output = statistics.instrument_handler(handler, "output")
+    >>> output.handle_char(None, 0x41)
+    False
+    >>> stats = statistics.stats()
+    >>> stats["timers"]["output.handle_char"]["calls"]
+    1
+    >>> stats["timers"]["handler.Filter.handle_char"]["calls"]
+    1
+
+        A handler shared by the processes, or used as both the input and
+        the output handler, is wrapped once:
+
+    >>> input = statistics.instrument_handler(handler, "input")
+    >>> output = statistics.instrument_handler(handler, "output")
+    >>> input.handle_char(None, 0x41) or output.handle_char(None, 0x41)
+    False
+    >>> stats = statistics.stats()
+    >>> stats["timers"]["input.handle_char"]["calls"]
+    1
+    >>> stats["timers"]["output.handle_char"]["calls"]
+    2
+    >>> stats["timers"]["handler.Filter.handle_char"]["calls"]
+    3
+    >>> from StringIO import StringIO
+    >>> class Sixel(DefaultHandler):
+    ...     def handle_control_string_start(self, context, prefix):
+    ...         return True
+    ...     def handle_control_string_data(self, context, chunk):
+    ...         pass
+    >>> handler = statistics.instrument_handler(Sixel(), "sixel")
+    >>> parser = DefaultParser()
+    >>> parser.init(ParseContext(StringIO(), handler=handler))
+    >>> parser.parse("\\x1bPq#0;2;0\\x1b\\\\")
+    >>> timers = statistics.stats()["timers"]
+    >>> [timers["sixel.handle_control_string_" + name]["calls"]
+    ...  for name in ("start", "data", "end")]
+    [1, 1, 1]
+    >>> timers["handler.Sixel.handle_control_string_data"]["calls"]
+    1
+    >>> statistics.count("draws")
+    >>> statistics.stats()["counters"]["draws"]
+    1
+    '''
+
+    def __init__(self):
+        self.__counters = {}
+        self.__timers = {}
+        self.__sources = []
+        self.__instrumented = {}  # id -> the filters wrapped in place
+
+    def count(self, name, n=1):
+        counters = self.__counters
+        counters[name] = counters.get(name, 0) + n
+
+    def timed(self, name, function, counter=None):
+        ''' returns function wrapped with the timer "name". With counter,
+            also counts the length of the first argument. '''
+        record = self.__timers.setdefault(name, [0, 0.0])
+        counters = self.__counters
+        clock = time.time
+
+        def wrapper(*args):
+            if counter is not None:
+                counters[counter] = counters.get(counter, 0) + len(args[0])
+            start = clock()
+            try:
+                return function(*args)
+            finally:
+                record[0] += 1
+                record[1] += clock() - start
+        return wrapper
+
+    def instrument_handler(self, handler, prefix):
+        ''' returns the handler with the events dispatched to it timed as
+            prefix.handle_*, and the methods of each filter in it timed as
+            handler.<class>.* '''
+        self.__instrument_filters(handler)
+        # the root handler is timed through a proxy per process and role,
+        # so that a handler used as both the input and the output handler
+        # is not timed twice
+        methods = {}
+        for name in _HANDLER_METHODS:
+            method = getattr(handler, name, None)
+            if method is not None:
+                methods[name] = self.timed(prefix + "." + name, method)
+        return _Instrumented(handler, methods)
+
+    def __instrument_filters(self, handler):
+        # the filters are wrapped in place, once: they may be shared by the
+        # processes (the default arguments of Session.create_process)
+        if id(handler) in self.__instrumented:
+            return
+        self.__instrumented[id(handler)] = handler
+        if isinstance(handler, FilterMultiplexer):
+            self.__instrument_filters(handler.get_lhs())
+            self.__instrument_filters(handler.get_rhs())
+        elif isinstance(handler, FilterChain):
+            for f in handler.get_filters():
+                self.__instrument_filters(f)
+            # the chain takes the bound methods of the filters when it is
+            # constructed, let it take the wrapped ones
+            FilterChain.__init__(handler, handler.get_filters())
+        else:
+            prefix = "handler." + handler.__class__.__name__
+            for name in _HANDLER_METHODS:
+                method = getattr(handler, name, None)
+                if method is not None:
+                    setattr(handler, name,
+                            self.timed(prefix + "." + name, method))
+
+    def instrument_context(self, context, parser, prefix):
+        ''' time the decoding and the flushes of the context, returns the
+            parser with parse() timed '''
+        context.assign = self.timed(prefix + ".decode", context.assign)
+        context.flush = self.timed(prefix + ".flush", context.flush)
+        output = context._output
+        if isinstance(output, OutputBuffer):
+            self.__sources.append((prefix + ".bytes_written", output.written))
+        parse = self.timed(prefix + ".parse", parser.parse,
+                           prefix + ".bytes_read")
+        return _Instrumented(parser, {'parse': parse})
+
+    def stats(self):
+        ''' returns a snapshot of the counters and the timers '''
+        counters = dict(self.__counters)
+        for name, source in self.__sources:
+            counters[name] = counters.get(name, 0) + source()
+        timers = {}
+        for name, (calls, seconds) in self.__timers.items():
+            timers[name] = {'calls': calls, 'seconds': seconds}
+        return {'counters': counters, 'timers': timers}
+
+    def dump(self, path):
+        ''' write stats() as JSON to the file at path, or send it to the
+            UNIX domain socket at path (as one line) '''
+        data = json.dumps(self.stats(), sort_keys=True)
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                sock.sendall(data + '\n')
+            finally:
+                sock.close()
+        else:
+            temp = path + '.tmp'
+            f = open(temp, 'w')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(temp, path)
+
+
+class _Instrumented:
+
+    ''' a handler or a parser, with some of its methods replaced by the
+        timed ones; the others are those of the target '''
+
+    def __init__(self, target, methods):
+        self.__target = target
+        self.__dict__.update(methods)
+
+    def get_target(self):
+        return self.__target
+
+    def __getattr__(self, name):
+        return getattr(self.__target, name)
+
+
 ###############################################################################
 #
 # Process
 #
+def _winsize(f):
+    ''' the size of the terminal f, (row, col), or None if it is not a
+        terminal '''
+    try:
+        winsize = fcntl.ioctl(f.fileno(), termios.TIOCGWINSZ, 'hhhh')
+    except (AttributeError, IOError, ValueError):
+        return None
+    row, col = struct.unpack('hh', winsize[:4])
+    if row > 0 and col > 0:
+        return row, col
+    return None
+
+
 class Process:
 
     _tty = None
     _esc_timer = None
+    _timers = None
+    _scheduler = None
+    _statistics = None
 
-    def __init__(self, tty):
+    def __init__(self, tty, timers=None, scheduler=None, statistics=None):
         self._tty = tty
+        self._timers = timers
+        self._scheduler = scheduler
+        self._statistics = statistics
 
     def start(self, termenc,
               inputhandler, outputhandler,
               inputparser, outputparser,
               inputscanner, outputscanner,
               buffering=False,
-              stdout=sys.stdout):
+              stdout=sys.stdout,
+              csiparameter=False,
+              inputqueue=None,
+              outputqueue=None,
+              maxcontrolstring=None,
+              optimize=False,
+              optimizer=None):
+
+        statistics = self._statistics
+        if statistics is not None:
+            inputhandler = statistics.instrument_handler(inputhandler,
+                                                         "input")
+            outputhandler = statistics.instrument_handler(outputhandler,
+                                                          "output")
 
         inputcontext = ParseContext(output=self._tty,
                                     termenc=termenc,
                                     scanner=inputscanner,
                                     handler=inputhandler,
-                                    buffering=buffering)
+                                    buffering=buffering,
+                                    csiparameter=csiparameter,
+                                    queue=inputqueue,
+                                    maxcontrolstring=maxcontrolstring)
         outputcontext = ParseContext(output=stdout,
                                      termenc=termenc,
                                      scanner=outputscanner,
                                      handler=outputhandler,
-                                     buffering=buffering)
+                                     buffering=buffering,
+                                     csiparameter=csiparameter,
+                                     queue=outputqueue,
+                                     maxcontrolstring=maxcontrolstring,
+                                     optimize=optimize,
+                                     optimizer=optimizer)
+        if optimize:
+            size = _winsize(stdout)
+            if size is not None:
+                outputcontext.resize(*size)
 
         inputparser.init(inputcontext)
         outputparser.init(outputcontext)
 
+        if statistics is not None:
+            inputparser = statistics.instrument_context(inputcontext,
+                                                        inputparser, "input")
+            outputparser = statistics.instrument_context(outputcontext,
+                                                         outputparser,
+                                                         "output")
+
         self._inputhandler = inputhandler
         self._outputhandler = outputhandler
         self._inputparser = inputparser
@@ -1106,16 +4640,30 @@ class Process:
     def fileno(self):
         return self._tty.fileno()
 
+    def input_fileno(self):
+        ''' the fd which the input is written to '''
+        return self._tty.fileno()
+
     def stdin_fileno(self):
         return self._tty.stdin_fileno()
 
     def read(self):
         return self._tty.read()
 
+    def read_view(self):
+        ''' same as read(), but DefaultPTY answers a memoryview of its
+            buffer without copying, valid until the next read '''
+        tty = self._tty
+        if isinstance(tty, DefaultPTY) and self._outputcontext.accepts_view():
+            return tty.read_view()
+        return tty.read()
+
     def write(self, data):
         self._tty.write(data)
 
     def close(self):
+        if self._scheduler is not None:
+            self._scheduler.cancel(self._draw)
         tty = self._tty
         if tty is not None:
             tty.close()
@@ -1137,16 +4685,14 @@ class Process:
     def process_start(self):
         self._inputhandler.handle_start(self._inputcontext)
         self._outputhandler.handle_start(self._outputcontext)
-        self._inputhandler.handle_draw(self._outputcontext)
-        self._outputhandler.handle_draw(self._outputcontext)
-        #self._inputcontext.flush()
-        self._outputcontext.flush()
+        self._draw()
 
     def process_end(self):
         self._inputhandler.handle_end(self._inputcontext)
         self._outputhandler.handle_end(self._outputcontext)
 
     def process_resize(self, row, col):
+        self._outputcontext.resize(row, col)
         try:
             self._inputhandler.handle_resize(self._inputcontext, row, col)
             self._outputhandler.handle_resize(self._outputcontext, row, col)
@@ -1160,30 +4706,48 @@ class Process:
 
         self._inputparser.parse(data)
 
+        if self._scheduler is not None:
+            # draw the echo without waiting for the next frame
+            self._scheduler.interact()
+
         # set ESC timer
         if not self._inputparser.state_is_esc():
-            self._inputhandler.handle_draw(self._outputcontext)
-            self._outputhandler.handle_draw(self._outputcontext)
-            #self._inputcontext.flush()
-            self._outputcontext.flush()
+            self._draw()
         else:
             def dispatch_esc():
+                self._esc_timer = None
+                if self._statistics is not None:
+                    self._statistics.count("esc_timeouts")
                 self._inputparser.flush()
                 self._inputparser.reset()
-                self._inputhandler.handle_draw(self._outputcontext)
-                self._outputhandler.handle_draw(self._outputcontext)
-                #self._inputcontext.flush()
-                self._outputcontext.flush()
-            self._esc_timer = threading.Timer(_ESC_TIMEOUT, dispatch_esc)
-            self._esc_timer.start()
+                self._draw()
+            self._esc_timer = self._call_later(_ESC_TIMEOUT, dispatch_esc)
 
     def process_output(self, data):
         self._outputparser.parse(data)
         if not self._outputparser.state_is_esc():
-            self._inputhandler.handle_draw(self._outputcontext)
-            self._outputhandler.handle_draw(self._outputcontext)
-            #self._inputcontext.flush()
-            self._outputcontext.flush()
+            if self._scheduler is None:
+                self._draw()
+            else:
+                self._scheduler.request(self._draw)
+
+    def _draw(self):
+        if self._statistics is not None:
+            self._statistics.count("draws")
+        self._inputhandler.handle_draw(self._outputcontext)
+        self._outputhandler.handle_draw(self._outputcontext)
+        self._inputcontext.flush()
+        self._outputcontext.flush()
+
+    def _call_later(self, delay, callback):
+        ''' run the callback after delay seconds, returns an object which
+            has cancel() '''
+        if self._timers is not None:
+            # on the thread of the Session loop
+            return self._timers.call_later(delay, callback)
+        timer = threading.Timer(delay, callback)
+        timer.start()
+        return timer
 
     def on_read(self, data):
         self._outputparser.parse(data)
@@ -1193,22 +4757,362 @@ class Process:
         self._inputcontext.assign('')
 
 
+###############################################################################
+#
+# Worker process
+#
+# WorkerProcess runs the scanners, parsers and handlers of a Process in a
+# forked worker process, so that the panes of a Session are filtered on
+# several cores. The worker reads the PTY itself, and sends what the output
+# context writes (the rendered output) back through a pipe, which Session
+# watches instead of the PTY; so as with Process, only the output of the
+# focused process is read (and written to stdout), and the others wait.
+#
+# The main loop sends the events of the Process to the worker as records of
+# kind (char), length (uint32) in network byte order and length bytes of
+# data, through a WriteQueue so that it does not wait for a busy worker.
+# The kinds are
+#   "i": input from stdin, "w": input to parse without drawing (on_write)
+#   "r": resize, the data is row and col (uint16 each)
+#   "s": process_start, "e": process_end, "x": end
+#   "d": drain (the focus moved to another process)
+# The worker exits when the pipe is closed (by close()), or when the command
+# has exited and the rest of its output is written to the result pipe; then
+# Session destructs the WorkerProcess (see Session._handle_close).
+#
+_WORKER_HEADER = struct.Struct('!cI')
+
+
+class WorkerProcess(Process):
+
+    ''' a Process whose pipeline runs in a worker process. The handlers are
+        copied to the worker by fork(), so their state is not shared with
+        the main process: they see the events of their Process only '''
+
+    _pid = None
+    _command = None
+    _queue = None
+    _result = None
+    _output = None
+
+    # the main process' ends of the pipes of the live workers, which the
+    # workers forked later must not keep open
+    _fds = set()
+
+    def __init__(self, tty, timers=None, scheduler=None, statistics=None):
+        Process.__init__(self, tty, timers, scheduler, statistics)
+        command_r, command_w = os.pipe()
+        result_r, result_w = os.pipe()
+        for fd in (command_r, command_w, result_r, result_w):
+            _set_cloexec(fd)  # the commands exec()ed by DefaultPTY
+        flags = fcntl.fcntl(result_r, fcntl.F_GETFL)
+        fcntl.fcntl(result_r, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._command = command_w
+        self._result = result_r
+        self._worker_fds = (command_r, result_w)
+        WorkerProcess._fds.update((command_w, result_r))
+
+    def start(self, termenc,
+              inputhandler, outputhandler,
+              inputparser, outputparser,
+              inputscanner, outputscanner,
+              buffering=False,
+              stdout=sys.stdout,
+              csiparameter=False,
+              inputqueue=None,
+              outputqueue=None,
+              maxcontrolstring=None,
+              optimize=False,
+              optimizer=None):
+
+        # inputqueue: the WriteQueue of the command pipe, flushed by the
+        # Session when the pipe is writable (see Session._init_process)
+        if inputqueue is None:
+            inputqueue = WriteQueue(self._command)
+        self._queue = inputqueue
+        command_r, result_w = self._worker_fds
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.__run(command_r, result_w, stdout,
+                           termenc,
+                           inputhandler, outputhandler,
+                           inputparser, outputparser,
+                           inputscanner, outputscanner,
+                           csiparameter, maxcontrolstring, optimize)
+                status = 0
+            except OSError, e:
+                if e.errno == errno.EPIPE:
+                    status = 0  # closed by the main process
+                else:
+                    logging.exception(e)
+            except Exception, e:
+                logging.exception(e)
+            finally:
+                os._exit(status)
+        os.close(command_r)
+        os.close(result_w)
+        self._pid = pid
+        # the rendered output bypasses the optimizer shared with the other
+        # processes, which forgets what it knows when it is written
+        self._output = OutputBuffer(stdout, termenc, queue=outputqueue,
+                                    optimizer=optimizer)
+
+    def __run(self, command_fd, result_fd, stdout,
+              termenc,
+              inputhandler, outputhandler,
+              inputparser, outputparser,
+              inputscanner, outputscanner,
+              csiparameter, maxcontrolstring, optimize):
+        ''' the main loop of the worker '''
+        for fd in WorkerProcess._fds:
+            os.close(fd)
+        # the other panes must hang up when the main process closes them
+        for fd in DefaultPTY._masters:
+            if fd != self._tty.fileno():
+                os.close(fd)
+        for signum in (signal.SIGCHLD, signal.SIGWINCH):
+            signal.signal(signum, signal.SIG_DFL)
+        try:
+            signal.set_wakeup_fd(-1)
+        except (ValueError, AttributeError):
+            pass
+
+        timers = TimerQueue()
+        process = Process(self._tty, timers)
+        if optimize:
+            optimizer = OutputOptimizer()
+        else:
+            optimizer = None
+        # the pipe is not read while the process is not focused (or the
+        # Session is throttled), the worker must not block on it
+        output = WriteQueue(result_fd)
+        process.start(termenc,
+                      inputhandler, outputhandler,
+                      inputparser, outputparser,
+                      inputscanner, outputscanner,
+                      buffering=True,  # a write to the pipe per draw
+                      stdout=os.fdopen(result_fd, 'wb'),
+                      csiparameter=csiparameter,
+                      outputqueue=output,
+                      maxcontrolstring=maxcontrolstring,
+                      optimize=optimize,
+                      optimizer=optimizer)
+        if optimize:
+            size = _winsize(stdout)
+            if size is not None:
+                process._outputcontext.resize(*size)
+
+        master = process.fileno()
+        running = True
+        pending = ''
+        while running or output.pending():
+            rfds = [command_fd]
+            # while the pipe is full, leave the output in the PTY, the
+            # command blocks
+            if running and output.pending() <= _OUTPUT_HIGHWATER:
+                rfds.append(master)
+            if output.pending():
+                wfds = [result_fd]
+            else:
+                wfds = []
+            try:
+                rfd, wfd, xfd = select.select(rfds, wfds, [], timers.timeout())
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if optimizer is not None:
+                # the main process writes the others' output between what
+                # it reads from the pipe, so nothing is known of the
+                # terminal from one wakeup to the next
+                optimizer.invalidate()
+            if wfd:
+                output.flush()
+            if master in rfd:
+                try:
+                    data = process.read_view()
+                except OSError:
+                    # EIO, the command has exited: exit when the rest of
+                    # the output is written to the pipe
+                    running = False
+                    process._outputcontext.flush()
+                else:
+                    if data:
+                        process.process_output(data)
+            if command_fd in rfd:
+                data = os.read(command_fd, _BUFFER_SIZE)
+                if not data:
+                    return  # closed by the main process
+                pending = self.__dispatch(process, pending + data)
+            timers.run()
+
+    def __dispatch(self, process, data):
+        ''' run the complete records, returns the rest of the data '''
+        size = _WORKER_HEADER.size
+        pos = 0
+        while len(data) - pos >= size:
+            kind, length = _WORKER_HEADER.unpack_from(data, pos)
+            end = pos + size + length
+            if end > len(data):
+                break
+            value = data[pos + size:end]
+            pos = end
+            if kind == 'i':
+                process.process_input(value)
+            elif kind == 'w':
+                process.on_write(value)
+            elif kind == 'r':
+                process.process_resize(*_RECORD_RESIZE.unpack(value))
+            elif kind == 's':
+                process.process_start()
+            elif kind == 'e':
+                process.process_end()
+            elif kind == 'x':
+                process.end()
+            elif kind == 'd':
+                process.drain()
+        return data[pos:]
+
+    def __send(self, kind, data=''):
+        queue = self._queue
+        if queue is None:
+            return
+        try:
+            queue.flush()  # nothing to do unless the pipe has been full
+            queue.write(_WORKER_HEADER.pack(kind, len(data)) + data)
+        except OSError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            # the worker has exited, Session destructs the process
+
+    def input_fileno(self):
+        return self._command
+
+    def getworkerpid(self):
+        return self._pid
+
+    def fileno(self):
+        return self._result
+
+    def read(self):
+        try:
+            return os.read(self._result, _READ_LIMIT)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return ''
+            raise
+
+    def read_view(self):
+        return self.read()
+
+    def on_read(self, data):
+        ''' write the output rendered by the worker '''
+        if data:
+            self._output.writebytes(data)
+            self._output.flush()
+
+    def on_write(self, data):
+        self.__send('w', data)
+
+    def process_input(self, data):
+        self.__send('i', data)
+
+    def process_start(self):
+        self.__send('s')
+
+    def process_end(self):
+        self.__send('e')
+
+    def process_resize(self, row, col):
+        self.__send('r', _RECORD_RESIZE.pack(row, col))
+
+    def end(self):
+        self.__send('x')
+
+    def drain(self):
+        self.__send('d')
+
+    def close(self):
+        for fd in (self._command, self._result):
+            if fd is not None:
+                WorkerProcess._fds.discard(fd)
+                os.close(fd)
+        self._command = None
+        self._queue = None
+        self._result = None
+        Process.close(self)
+
+
 ###############################################################################
 #
 # Session
 #
 class Session:
 
-    def __init__(self, tty):
-
+    def __init__(self, tty, poller=None, framerate=None, nonblocking=False,
+                 statistics=None, recorder=None):
+
+        # framerate: coalesce the draws of the output, at most framerate
+        # times a second (None draws after every read)
+        # nonblocking: let the contexts write through WriteQueues (it
+        # implies buffering), and stop reading the processes while stdout
+        # is behind. When stdout is a terminal, it is opened again for the
+        # queue, otherwise its file description is non-blocking until the
+        # session ends
+        # statistics: a Statistics which measures the processes
+        # recorder: a Recorder which records the input, the output of the
+        # active process and the resizes
         self._alive = True
-        self._mainprocess = Process(tty)
+        self._statistics = statistics
+        self._recorder = recorder
+        self._timers = TimerQueue()
+        if framerate is None:
+            self._scheduler = None
+        else:
+            self._scheduler = RenderScheduler(self.call_later, framerate)
+        self._mainprocess = self._new_process(tty)
         self._input_target = self._mainprocess
         stdin_fileno = self._mainprocess.stdin_fileno()
-        self._rfds = [stdin_fileno]
-        self._xfds = [stdin_fileno]
+        if poller is None:
+            poller = DefaultPoller()
+        poller.register(stdin_fileno)
+        self._poller = poller
         self._resized = False
         self._process_map = {}
+        self._nonblocking = nonblocking
+        self._writequeues = {}
+        self._stdout_queue = None
+        self._optimizer = None  # shared by the processes, see _init_process
+        self._throttled = False
+        self._exited = []  # the pids _handle_close has waited for
+
+    def _new_process(self, tty):
+        return Process(tty, self._timers, self._scheduler, self._statistics)
+
+    def call_later(self, delay, callback):
+        ''' run the callback on the Session loop after delay seconds
+            (e.g. for timed redraws of the handlers), returns an object
+            which has cancel() '''
+        return self._timers.call_later(delay, callback)
+
+    def stats(self):
+        ''' returns the snapshot of the Statistics, or None '''
+        if self._statistics is None:
+            return None
+        return self._statistics.stats()
+
+    def dump_stats(self, path, interval):
+        ''' dump the Statistics to the file (or UNIX domain socket) at path
+            every interval seconds '''
+        def dump():
+            try:
+                self._statistics.dump(path)
+            except (IOError, OSError, socket.error), e:
+                logging.warning("dump_stats: %s" % e)
+            self.call_later(interval, dump)
+        self.call_later(interval, dump)
 
     # deprecated
     def add_subtty(self, term, lang,
@@ -1228,17 +5132,30 @@ class Session:
                        outputparser=DefaultParser(),
                        inputscanner=DefaultScanner(),
                        outputscanner=DefaultScanner(),
-                       buffering=False):
-
+                       buffering=False,
+                       csiparameter=False,
+                       maxcontrolstring=None,
+                       optimize=False,
+                       worker=False):
+
+        # worker: run the scanners, parsers and handlers of the process in
+        # a worker process (see WorkerProcess)
         tty = DefaultPTY(term, lang, command, sys.stdin, row, col)
-        process = Process(tty)
+        if worker:
+            process = WorkerProcess(tty, self._timers, self._scheduler,
+                                    self._statistics)
+        else:
+            process = self._new_process(tty)
 
         self._init_process(process,
                            termenc,
                            inputhandler, outputhandler,
                            inputparser, outputparser,
                            inputscanner, outputscanner,
-                           buffering=buffering)
+                           buffering=buffering,
+                           csiparameter=csiparameter,
+                           maxcontrolstring=maxcontrolstring,
+                           optimize=optimize)
         return process
 
     def getactiveprocess(self):
@@ -1263,11 +5180,12 @@ class Session:
 
     def destruct_process(self, process):
         fd = process.fileno()
-        if fd in self._rfds:
-            self._rfds.remove(fd)
-        if fd in self._xfds:
-            self._xfds.remove(fd)
+        self._poller.unregister(fd)
         process.end()
+        for writer in (fd, process.input_fileno()):
+            if writer in self._writequeues:
+                self._poller.unregister_writer(writer)
+                del self._writequeues[writer]
         process.close()
         del self._process_map[fd]
 
@@ -1286,40 +5204,42 @@ class Session:
             pass
 
         stdin_fileno = self._mainprocess.stdin_fileno()
+        poller = self._poller
+        wakeup_fd = self._open_wakeup_fd()
+        if wakeup_fd is None:
+            interval = 0.6  # poll the flags set by the signal handlers
+        else:
+            interval = None  # signals wake the poller up
+        timers = self._timers
         try:
             while self._alive:
                 try:
-                    rfd, wfd, xfd = select.select(self._rfds, [], self._xfds, 0.6)
+                    timeout = timers.timeout()
+                    if timeout is None:
+                        timeout = interval
+                    elif interval is not None:
+                        timeout = min(timeout, interval)
+                    rfd, wfd, xfd = poller.poll(timeout)
+                    for fd in wfd:
+                        self._handle_write(fd)
                     if xfd:
                         for fd in xfd:
-                            if fd in self._process_map:
-                                process = self._process_map[fd]
-                                self.destruct_process(process)
-                                continue
+                            self._handle_exception(fd)
                     if self._resized:
-                        self._resized = False
-                        row, col = self._mainprocess.fitsize()
-                        self._mainprocess.process_resize(row, col)
+                        self._handle_resize()
+                    if self._exited:
+                        self._handle_exited()
                     if rfd:
                         for fd in rfd:
-                            if fd == stdin_fileno:
-                                data = os.read(stdin_fileno, _BUFFER_SIZE)
-                                if self._input_target.is_alive():
-                                    target_fd = self._input_target.fileno()
-                                    process = self._process_map[target_fd]
-                                    process.process_input(data)
-                                    self._mainprocess.process_input("")
-                            elif self._process_map:
-                                process_map = self._process_map
-                                if fd in process_map:
-                                    process = process_map[fd]
-                                    if self._input_target.is_alive():
-                                        if fd == self._input_target.fileno():
-                                            data = process.read()
-                                            process.on_read(data)
-                                            self._mainprocess.process_output("")
+                            if fd == wakeup_fd:
+                                self._drain_wakeup_fd(wakeup_fd)
+                            elif fd == stdin_fileno:
+                                self._handle_stdin()
+                            else:
+                                self._handle_read(fd)
                     else:
                         pass
+                    timers.run()
                 except select.error, e:
                     no, msg = e
                     if no == errno.EINTR:
@@ -1348,12 +5268,158 @@ class Session:
                 raise e
         finally:
             try:
-                self._mainprocess.process_end()
+                self._close_wakeup_fd(wakeup_fd)
             finally:
+                self._end_processes()
+
+    def _handle_exception(self, fd):
+        if fd in self._process_map:
+            process = self._process_map[fd]
+            self.destruct_process(process)
+
+    def _handle_resize(self):
+        self._resized = False
+        row, col = self._mainprocess.fitsize()
+        if self._recorder is not None:
+            self._recorder.record_resize(row, col)
+        self._mainprocess.process_resize(row, col)
+
+    def _handle_stdin(self):
+        stdin_fileno = self._mainprocess.stdin_fileno()
+        try:
+            data = os.read(stdin_fileno, _BUFFER_SIZE)
+        except OSError, e:
+            # stdin may share the non-blocking file description of stdout
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        if self._recorder is not None:
+            self._recorder.record_input(data)
+        if self._input_target.is_alive():
+            target_fd = self._input_target.fileno()
+            process = self._process_map[target_fd]
+            process.process_input(data)
+            self._mainprocess.process_input("")
+
+    def _handle_read(self, fd):
+        process_map = self._process_map
+        if fd in process_map:
+            process = process_map[fd]
+            if self._input_target.is_alive():
+                if fd == self._input_target.fileno():
+                    data = process.read_view()
+                    if self._recorder is not None:
+                        self._recorder.record_output(data)
+                    process.on_read(data)
+                    self._mainprocess.process_output("")
+
+    def _handle_write(self, fd):
+        queue = self._writequeues.get(fd)
+        try:
+            done = queue is None or queue.flush()
+        except OSError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            done = True  # a worker has exited, destructed by the loop
+        if done:
+            self._poller.unregister_writer(fd)
+        if (self._throttled and queue is self._stdout_queue
+                and queue.pending() <= _OUTPUT_HIGHWATER // 2):
+            self._throttle(False)
+
+    def _onqueued(self, queue):
+        ''' called by the WriteQueues when their fds are behind '''
+        self._poller.register_writer(queue.fileno())
+        if (not self._throttled and queue is self._stdout_queue
+                and queue.pending() > _OUTPUT_HIGHWATER):
+            self._throttle(True)
+
+    def _throttle(self, throttled):
+        ''' stop (or restart) reading the output of the processes. The
+            commands block when the PTY buffers fill up '''
+        self._throttled = throttled
+        for fd in self._process_map:
+            if throttled:
+                self._poller.unregister(fd)
+            else:
+                self._poller.register(fd)
+
+    def _handle_close(self):
+        # a pane and its worker may exit at once, with a single SIGCHLD
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return  # no more children
+            if not pid:
+                return
+            mainprocess = self._mainprocess
+            if not mainprocess.is_alive():
+                self._alive = False
+            elif pid == mainprocess.getpid():
+                self._alive = False
+            else:
+                # a worker exits after its command, destructed by the loop
+                self._exited.append(pid)
+                self.focus_process(mainprocess)
+
+    def _handle_exited(self):
+        pids = self._exited
+        self._exited = []
+        for process in self._process_map.values():
+            if (isinstance(process, WorkerProcess)
+                    and process.getworkerpid() in pids):
+                self.destruct_process(process)
+
+    def _end_processes(self):
+        try:
+            if self._scheduler is not None:
+                self._scheduler.flush()
+            self._mainprocess.process_end()
+        finally:
+            try:
                 for fd in self._process_map:
                     process = self._process_map[fd]
                     process.end()
                     process.close()
+            finally:
+                if self._stdout_queue is not None:
+                    self._stdout_queue.close()
+
+    def _open_wakeup_fd(self):
+        ''' make signals write to a pipe which the poller watches, returns
+            the read end (or None if it is not possible) '''
+        try:
+            rfd, wfd = os.pipe()
+        except OSError:
+            return None
+        try:
+            for fd in (rfd, wfd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            signal.set_wakeup_fd(wfd)
+        except (ValueError, AttributeError):
+            # not in the main thread
+            os.close(rfd)
+            os.close(wfd)
+            return None
+        self._wakeup_wfd = wfd
+        self._poller.register(rfd)
+        return rfd
+
+    def _drain_wakeup_fd(self, fd):
+        try:
+            while os.read(fd, _BUFFER_SIZE):
+                pass
+        except OSError:
+            pass
+
+    def _close_wakeup_fd(self, fd):
+        if fd is not None:
+            signal.set_wakeup_fd(-1)
+            self._poller.unregister(fd)
+            os.close(fd)
+            os.close(self._wakeup_wfd)
 
     def start(self,
               termenc,
@@ -1365,7 +5431,10 @@ class Session:
               outputscanner=DefaultScanner(),
               outputparser=DefaultParser(),
               outputhandler=DefaultHandler(),
-              buffering=False):
+              buffering=False,
+              csiparameter=False,
+              maxcontrolstring=None,
+              optimize=False):
 
         mainprocess = self._mainprocess
 
@@ -1374,22 +5443,19 @@ class Session:
                            inputhandler, outputhandler,
                            inputparser, outputparser,
                            inputscanner, outputscanner,
-                           buffering)
+                           buffering,
+                           csiparameter=csiparameter,
+                           maxcontrolstring=maxcontrolstring,
+                           optimize=optimize)
 
         self._resized = False
 
         def onclose(no, frame):
-            pid, status = os.wait()
-            if not mainprocess.is_alive():
-                self._alive = False
-            elif pid == mainprocess.getpid():
-                self._alive = False
-            else:
-                self.focus_process(mainprocess)
+            self._handle_close()
 
         signal.signal(signal.SIGCHLD, onclose)
 
-        self.drive()
+        return self.drive()
 
     def _init_process(self,
                       process,
@@ -1397,13 +5463,42 @@ class Session:
                       inputhandler, outputhandler,
                       inputparser, outputparser,
                       inputscanner, outputscanner,
-                      buffering):
+                      buffering,
+                      csiparameter=False,
+                      maxcontrolstring=None,
+                      optimize=False):
 
         fd = process.fileno()
-        self._rfds.append(fd)
-        self._xfds.append(fd)
+        if not self._throttled:
+            self._poller.register(fd)
         self._process_map[fd] = process
 
+        inputfd = process.input_fileno()
+        if self._nonblocking or inputfd != fd:
+            # the command pipe of a worker is always written through a
+            # queue, the loop must not wait for a busy worker
+            inputqueue = WriteQueue(inputfd, self._onqueued)
+            self._writequeues[inputfd] = inputqueue
+        else:
+            inputqueue = None
+
+        if self._nonblocking:
+            buffering = True  # the queues are written by OutputBuffers
+            outputqueue = self._stdout_queue
+            if outputqueue is None:
+                stdout_fileno = sys.stdout.fileno()
+                writer = _open_writer(stdout_fileno)
+                outputqueue = WriteQueue(writer, self._onqueued,
+                                         closefd=writer != stdout_fileno)
+                self._writequeues[writer] = outputqueue
+                self._stdout_queue = outputqueue
+        else:
+            outputqueue = None
+
+        # the processes write to one terminal, so they share one optimizer
+        if optimize and self._optimizer is None:
+            self._optimizer = OutputOptimizer()
+
         process.start(termenc,
                       inputhandler,
                       outputhandler,
@@ -1411,10 +5506,608 @@ class Session:
                       outputparser,
                       inputscanner,
                       outputscanner,
-                      buffering)
+                      buffering,
+                      csiparameter=csiparameter,
+                      inputqueue=inputqueue,
+                      outputqueue=outputqueue,
+                      maxcontrolstring=maxcontrolstring,
+                      optimize=optimize,
+                      optimizer=self._optimizer)
         self.focus_process(process)
 
 
+###############################################################################
+#
+# Record and replay
+#
+# A recording is the header _RECORD_MAGIC followed by records of
+#   timestamp (double, seconds from the start), kind (char), length (uint32)
+# in network byte order and length bytes of data. The kinds are
+#   "i": input from stdin
+#   "o": output read from the PTY
+#   "r": resize, the data is row and col (uint16 each)
+#
+_RECORD_MAGIC = 'TFFREC1\n'
+_RECORD_HEADER = struct.Struct('!dcI')
+_RECORD_RESIZE = struct.Struct('!HH')
+
+
+class Recorder:
+
+    ''' write the timestamped streams which cross Session.drive to a file
+
+    >>> from StringIO import StringIO
+    >>> f = StringIO()
+    >>> recorder = Recorder(f)
+    >>> recorder.record_input("ls\\r")
+    >>> recorder.record_resize(24, 80)
+    >>> recorder.record_output("\\x1b[1mtff.py\\x1b[m\\r\\n")
+    >>> [(kind, data) for t, kind, data in Replayer(StringIO(f.getvalue()))]
+    [('i', 'ls\\r'), ('r', (24, 80)), ('o', '\\x1b[1mtff.py\\x1b[m\\r\\n')]
+    '''
+
+    def __init__(self, output, clock=time.time):
+        self.__output = output
+        self.__clock = clock
+        self.__start = clock()
+        output.write(_RECORD_MAGIC)
+
+    def __record(self, kind, data):
+        timestamp = self.__clock() - self.__start
+        self.__output.write(_RECORD_HEADER.pack(timestamp, kind, len(data)))
+        self.__output.write(data)
+
+    def record_input(self, data):
+        self.__record('i', data)
+
+    def record_output(self, data):
+        self.__record('o', data)
+
+    def record_resize(self, row, col):
+        self.__record('r', _RECORD_RESIZE.pack(row, col))
+
+    def close(self):
+        self.__output.close()
+
+
+class FakePTY(PTY):
+
+    ''' PTY without a child process, for replaying the recordings. What is
+        written to it (the input filtered by the handlers) is collected in
+        "written" if collect is true. '''
+
+    pid = None
+
+    def __init__(self, row=24, col=80, collect=False):
+        self.__size = (row, col)
+        self.__collect = collect
+        self.written = []
+
+    def fitsize(self):
+        return self.__size
+
+    def resize(self, height, width):
+        self.__size = (height, width)
+        return height, width
+
+    def read(self):
+        return ''
+
+    def write(self, data):
+        if self.__collect:
+            self.written.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def xon(self):
+        pass
+
+    def xoff(self):
+        pass
+
+
+class Replayer:
+
+    ''' read a recording, iterates the records (timestamp, kind, data) and
+        feeds them to a Process
+
+    >>> from StringIO import StringIO
+    >>> f = StringIO()
+    >>> recorder = Recorder(f)
+    >>> recorder.record_output("\\x1b[1mA")
+    >>> recorder.record_output("\\x1b[mB")
+    >>> output = StringIO()
+    >>> replayer = Replayer(StringIO(f.getvalue()))
+    >>> process = replayer.create_process(stdout=output)
+    >>> replayer.replay(process)
+    >>> output.getvalue()
+    '\\x1b[1mA\\x1b[mB'
+    '''
+
+    def __init__(self, f):
+        if f.read(len(_RECORD_MAGIC)) != _RECORD_MAGIC:
+            raise ValueError("not a recording of tff")
+        self.__records = []
+        while True:
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                break  # the end, or cut by a crash
+            timestamp, kind, length = _RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if kind == 'r':
+                data = _RECORD_RESIZE.unpack(data)
+            self.__records.append((timestamp, kind, data))
+        self.__now = 0.0
+        self.__timers = TimerQueue(clock=self.__clock)
+
+    def __clock(self):
+        return self.__now
+
+    def __iter__(self):
+        return iter(self.__records)
+
+    def create_process(self,
+                       termenc='UTF-8',
+                       stdout=sys.stdout,
+                       inputhandler=DefaultHandler(),
+                       outputhandler=DefaultHandler(),
+                       inputparser=None,
+                       outputparser=None,
+                       inputscanner=None,
+                       outputscanner=None,
+                       buffering=False,
+                       statistics=None):
+        ''' returns a started Process on a FakePTY, whose ESC timeouts
+            run on the clock of the recording '''
+        process = Process(FakePTY(), self.__timers, statistics=statistics)
+        process.start(termenc,
+                      inputhandler, outputhandler,
+                      inputparser or DefaultParser(),
+                      outputparser or DefaultParser(),
+                      inputscanner or DefaultScanner(),
+                      outputscanner or DefaultScanner(),
+                      buffering=buffering,
+                      stdout=stdout)
+        return process
+
+    def replay(self, process, realtime=False):
+        ''' feed the records to the process at full speed, or with the
+            original timing if realtime is true '''
+        timers = self.__timers
+        start = time.time()
+        for timestamp, kind, data in self.__records:
+            if realtime:
+                delay = timestamp - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.__now = timestamp
+            timers.run()
+            if kind == 'i':
+                process.process_input(data)
+            elif kind == 'o':
+                process.process_output(data)
+            elif kind == 'r':
+                row, col = data
+                process.resize(row, col)
+                process.process_resize(row, col)
+        # let the pending ESC time out
+        self.__now += _ESC_TIMEOUT
+        timers.run()
+
+
+###############################################################################
+#
+# Bulk parsing
+#
+# BulkParser parses a large recorded stream (e.g. a typescript of script(1))
+# on several processes. The stream is cut into chunks, each worker parses
+# one chunk from the ground state and notes at the end of every piece (a
+# run of lines) whether its parser is back in the ground state there
+# ("synced"). As the pieces end with ASCII bytes, nothing is left in the
+# decoder at those points, so from a synced point on, a parser which has
+# read the stream from the beginning generates the same events.
+#
+# The results are merged in order. A chunk which starts at a synced point is
+# taken as it is up to its last synced point. The rest, the seam to the next
+# chunk, is parsed again by the main process until its parser and the
+# speculative one of the next chunk are synced at the same point.
+#
+# Handlers are created per worker and per seam by the handler factory, so
+# they should not carry state from one sequence to another.
+#
+_BULK_CHUNK_SIZE = 1 << 22
+_BULK_PIECE_SIZE = 1 << 16
+
+_ASCII_PATTERN = re.compile('[\x00-\x7f]')
+
+
+def _piece_end(data, start, size):
+    ''' returns the end of the piece of data beginning at start, cut after
+        a line feed (or another ASCII byte) as near as possible to start +
+        size, or None if there is no ASCII byte after start + size
+
+    >>> _piece_end("abc\\ndef\\nghi", 0, 6)
+    4
+    >>> _piece_end("abcdefghi", 0, 6)
+    7
+    >>> _piece_end("abc", 0, 6)
+    3
+    '''
+    if len(data) - start <= size:
+        return len(data)
+    end = data.rfind('\n', start, start + size)
+    if end >= start:
+        return end + 1
+    match = _ASCII_PATTERN.search(data, start + size)
+    if match is None:
+        return None
+    return match.end()
+
+
+def _read_range(path, start, end):
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        return f.read(end - start)
+    finally:
+        f.close()
+
+
+def _bulk_parse(task):
+    ''' parse a chunk in a worker, returns the output and the marks
+        (end of the piece, length of the output, whether synced) '''
+    (path, start, end, data, handler_factory,
+     termenc, parser_class, scanner_class, piecesize) = task
+    from StringIO import StringIO
+    if data is None:
+        data = _read_range(path, start, end)
+    output = StringIO()
+    parser = parser_class()
+    parser.init(ParseContext(output,
+                             termenc=termenc,
+                             scanner=scanner_class(),
+                             handler=handler_factory()))
+    marks = []
+    pos = 0
+    while pos < len(data):
+        piece_end = _piece_end(data, pos, piecesize) or len(data)
+        parser.parse(data[pos:piece_end])
+        pos = piece_end
+        marks.append((pos, output.tell(), not parser.state_is_esc()))
+    return output.getvalue(), marks
+
+
+class BulkParser:
+
+    ''' parse a large stream on several processes, the output is the same
+        as the one of a parser which reads the whole stream by itself
+
+    >>> from StringIO import StringIO
+    >>> data = "\\x1b[1mA\\x1b]0;title\\nB\\x07\\x1b[mC\\n" * 50
+    >>> sequential = StringIO()
+    >>> parser = DefaultParser()
+    >>> parser.init(ParseContext(sequential))
+    >>> parser.parse(data)
+    >>> bulk = BulkParser(processes=1, chunksize=100, piecesize=10)
+    >>> bulk.parse(data) == sequential.getvalue()
+    True
+    >>> bulk.reparsed > 0
+    True
+    '''
+
+    def __init__(self,
+                 handler_factory=DefaultHandler,
+                 termenc='UTF-8',
+                 parser_class=DefaultParser,
+                 scanner_class=DefaultScanner,
+                 processes=None,
+                 chunksize=_BULK_CHUNK_SIZE,
+                 piecesize=_BULK_PIECE_SIZE):
+        self.__handler_factory = handler_factory
+        self.__termenc = termenc
+        self.__parser_class = parser_class
+        self.__scanner_class = scanner_class
+        self.__processes = processes
+        self.__chunksize = chunksize
+        self.__piecesize = min(piecesize, chunksize)
+        self.reparsed = 0  # bytes parsed again by the main process
+
+    def parse(self, data):
+        ''' parse data and returns the output '''
+        from StringIO import StringIO
+        output = StringIO()
+
+        def read(start, end):
+            return data[start:end]
+
+        self.__run(len(data), read, None, output)
+        return output.getvalue()
+
+    def parse_file(self, path, output):
+        ''' parse the file at path and write the output to output '''
+        f = open(path, 'rb')
+        try:
+            def read(start, end):
+                f.seek(start)
+                return f.read(end - start)
+
+            self.__run(os.fstat(f.fileno()).st_size, read, path, output)
+        finally:
+            f.close()
+
+    def __create_parser(self, output):
+        parser = self.__parser_class()
+        parser.init(ParseContext(output,
+                                 termenc=self.__termenc,
+                                 scanner=self.__scanner_class(),
+                                 handler=self.__handler_factory()))
+        return parser
+
+    def __split(self, size, read):
+        ''' returns the list of (start, end) of the chunks '''
+        bounds = []
+        start = 0
+        while size - start > self.__chunksize:
+            window = read(start + self.__chunksize - self.__piecesize,
+                          start + self.__chunksize + self.__piecesize)
+            offset = _piece_end(window, 0, self.__piecesize)
+            if offset is None or offset == len(window):
+                break  # no place to cut, leave the rest in one chunk
+            end = start + self.__chunksize - self.__piecesize + offset
+            bounds.append((start, end))
+            start = end
+        bounds.append((start, size))
+        return bounds
+
+    def __tasks(self, bounds, read, path):
+        for start, end in bounds:
+            if path is None:
+                data = read(start, end)
+            else:
+                data = None
+            yield (path, start, end, data, self.__handler_factory,
+                   self.__termenc, self.__parser_class, self.__scanner_class,
+                   self.__piecesize)
+
+    def __run(self, size, read, path, output):
+        if not _is_ascii_transparent(self.__termenc):
+            # chunks can not be cut without knowing the decoder state
+            parser = self.__create_parser(output)
+            parser.parse(read(0, size))
+            parser.flush()
+            return
+
+        bounds = self.__split(size, read)
+        tasks = self.__tasks(bounds, read, path)
+        if self.__processes == 1 or len(bounds) == 1:
+            pool = None
+            results = (_bulk_parse(task) for task in tasks)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.__processes)
+            results = pool.imap(_bulk_parse, tasks)
+        try:
+            self.__merge(bounds, results, read, output)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def __merge(self, bounds, results, read, output):
+        live = None  # the parser of the main process, while in a seam
+        resume = 0   # the output of the stream before here is written
+        for (start, end), (result, marks) in zip(bounds, results):
+            if live is None and resume < start:
+                # the previous chunk did not end synced, parse its rest
+                live = self.__create_parser(output)
+                live.parse(read(resume, start))
+                self.reparsed += start - resume
+            first = 0    # the marks from here on are taken
+            written = 0  # the length of the result which is written
+            if live is not None:
+                pos = start
+                for offset, length, synced in marks:
+                    live.parse(read(pos, start + offset))
+                    self.reparsed += start + offset - pos
+                    pos = start + offset
+                    first += 1
+                    if synced and not live.state_is_esc():
+                        break
+                else:
+                    continue  # the seam goes on to the next chunk
+                # both are synced here, the rest of the result is valid
+                live = None
+                resume = pos
+                written = marks[first - 1][1]
+            for offset, length, synced in reversed(marks[first:]):
+                if synced:
+                    # take the result up to its last synced point
+                    output.write(result[written:length])
+                    resume = start + offset
+                    break
+        if live is None:
+            live = self.__create_parser(output)
+            live.parse(read(resume, bounds[-1][1]))
+            self.reparsed += bounds[-1][1] - resume
+        live.flush()
+
+
+###############################################################################
+#
+# Asynchronous Session
+#
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio  # Python 2 backport
+    except ImportError:
+        asyncio = None
+
+
+class _LoopPoller(Poller):
+
+    ''' turns the registrations of Session into reader and writer
+        callbacks of an event loop, the loop itself does the polling '''
+
+    def __init__(self, loop, onreadable, onwritable):
+        self._loop = loop
+        self._onreadable = onreadable
+        self._onwritable = onwritable
+
+    def register(self, fd):
+        self._loop.add_reader(fd, self._onreadable, fd)
+
+    def unregister(self, fd):
+        self._loop.remove_reader(fd)
+
+    def register_writer(self, fd):
+        self._loop.add_writer(fd, self._onwritable, fd)
+
+    def unregister_writer(self, fd):
+        self._loop.remove_writer(fd)
+
+    def close(self):
+        pass
+
+
+class AsyncProcess(Process):
+
+    ''' Process on an event loop: the ESC timer is scheduled with
+        loop.call_later, and handle_draw of the handlers may return a
+        coroutine or a future, in which case the contexts are flushed
+        when all of them are done '''
+
+    def __init__(self, tty, loop, scheduler=None, statistics=None):
+        Process.__init__(self, tty, scheduler=scheduler,
+                         statistics=statistics)
+        self._loop = loop
+
+    def _call_later(self, delay, callback):
+        return self._loop.call_later(delay, callback)
+
+    def _draw(self):
+        if self._statistics is not None:
+            self._statistics.count("draws")
+        pending = []
+        for handler in (self._inputhandler, self._outputhandler):
+            result = handler.handle_draw(self._outputcontext)
+            if asyncio.iscoroutine(result) or isinstance(result,
+                                                         asyncio.Future):
+                pending.append(result)
+        if pending:
+            future = asyncio.gather(*pending, loop=self._loop)
+            future.add_done_callback(self._ondrawn)
+        else:
+            self._flush()
+
+    def _ondrawn(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("handle_draw failed: %s" % future.exception())
+        self._flush()
+
+    def _flush(self):
+        self._inputcontext.flush()
+        self._outputcontext.flush()
+
+
+class AsyncSession(Session):
+
+    ''' Session driven by an asyncio (trollius on Python 2) event loop
+        instead of the blocking loop of Session.drive
+
+        stdin and the master fds of the processes are registered to the
+        loop with add_reader, and start() returns a future which is done
+        when the main process ends:
+
+            session = AsyncSession(tty, loop)
+            loop.run_until_complete(session.start(termenc, ...))
+    '''
+
+    def __init__(self, tty, loop=None, framerate=None, statistics=None,
+                 recorder=None):
+        if asyncio is None:
+            raise ImportError("AsyncSession requires asyncio or trollius")
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._closed = asyncio.Future(loop=loop)
+        Session.__init__(self, tty,
+                         poller=_LoopPoller(loop,
+                                            self._onready,
+                                            self._handle_write),
+                         framerate=framerate,
+                         statistics=statistics,
+                         recorder=recorder)
+        self._stdin_fileno = self._mainprocess.stdin_fileno()
+
+    def _new_process(self, tty):
+        return AsyncProcess(tty, self._loop, self._scheduler,
+                            self._statistics)
+
+    def call_later(self, delay, callback):
+        return self._loop.call_later(delay, callback)
+
+    def drive(self):
+        self._loop.add_signal_handler(signal.SIGWINCH, self._handle_resize)
+        self._loop.add_signal_handler(signal.SIGCHLD, self._onclose)
+        return self._closed
+
+    def _onready(self, fd):
+        try:
+            if fd == self._stdin_fileno:
+                self._handle_stdin()
+            else:
+                self._handle_read(fd)
+        except OSError, e:
+            no, msg = e
+            if no == errno.EINTR:
+                return
+            elif no == errno.EIO or no == errno.EBADF:
+                self._alive = False
+            else:
+                self._finish(e)
+                return
+        except Exception, e:
+            self._finish(e)
+            return
+        if not self._alive:
+            self._finish()
+
+    def _onclose(self):
+        self._handle_close()
+        if not self._alive:
+            self._finish()
+        elif self._exited:
+            self._handle_exited()
+
+    def _finish(self, exception=None):
+        if self._closed.done():
+            return
+        self._alive = False
+        loop = self._loop
+        loop.remove_signal_handler(signal.SIGWINCH)
+        loop.remove_signal_handler(signal.SIGCHLD)
+        loop.remove_reader(self._stdin_fileno)
+        for fd in self._process_map:
+            loop.remove_reader(fd)
+        for fd in self._writequeues:
+            loop.remove_writer(fd)
+        try:
+            self._end_processes()
+        except Exception, e:
+            if exception is None:
+                exception = e
+        if exception is None:
+            self._closed.set_result(None)
+        else:
+            self._closed.set_exception(exception)
+
+
 def _test():
     import doctest
     doctest.testmod()
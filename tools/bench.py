@@ -0,0 +1,222 @@
+#!/usr/bin/python
+#
+# throughput benchmark: replays a corpus of terminal output streams
+# (see tools/corpus.py) through DefaultScanner + DefaultParser + ParseContext
+# with DefaultHandler, and reports MB/s, events/s and allocations per MB of
+# each backend as JSON:
+#
+#   tff      pure Python tff.py
+#   _tff     tff.py with the C scanner/parser (if _tff is built)
+#
+# "allocations" counts the objects which the parser creates for the event
+# arguments (lists, ints out of the small int cache, strings); Python 2 has
+# no way to count every allocation of the interpreter itself.
+#
+# With -p, compares the parser implementations alone (events are dropped)
+# and prints the cost per input byte as a table instead.
+#
+# usage: python tools/bench.py [-r repeat] [-s size] [-c corpus_dir]
+#                              [-o output.json] [-p]
+#
+
+import os
+import sys
+import time
+import json
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tff
+import corpus
+from difftest import load_pure_tff
+
+_CHUNK_SIZE = 8192
+
+
+class _NullOutput:
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def _null_context(module):
+
+    class NullContext(module.ParseContext):
+
+        ''' drops all events, so that only the parser itself is measured '''
+
+        def _drop(self, *args):
+            pass
+
+        dispatch_esc = dispatch_csi = dispatch_ss2 = dispatch_ss3 = _drop
+        dispatch_control_string = dispatch_char = dispatch_text = _drop
+        dispatch_invalid = _drop
+
+    return NullContext
+
+
+def _allocations(args):
+    ''' count the objects created for the event arguments '''
+    count = 0
+    for arg in args:
+        if isinstance(arg, list):
+            count += 1
+            for c in arg:
+                if not -5 <= c <= 256:
+                    count += 1
+        elif isinstance(arg, basestring):
+            count += 1
+        elif isinstance(arg, int) and not -5 <= arg <= 256:
+            count += 1
+    return count
+
+
+def _counting_context(module):
+
+    class CountingContext(module.ParseContext):
+
+        ''' counts the events and their arguments '''
+
+        events = 0
+        allocations = 0
+
+        def _count(self, *args):
+            self.events += 1
+            self.allocations += _allocations(args)
+
+        dispatch_esc = dispatch_csi = dispatch_ss2 = dispatch_ss3 = _count
+        dispatch_control_string = dispatch_char = dispatch_text = _count
+        dispatch_invalid = _count
+
+    return CountingContext
+
+
+def _feed(parser, data):
+    for pos in xrange(0, len(data), _CHUNK_SIZE):
+        parser.parse(data[pos:pos + _CHUNK_SIZE])
+    parser.flush()
+
+
+def measure(module, parser_class, scanner_class, data, repeat,
+            context_class=None):
+    ''' returns the best time in seconds to parse the data '''
+    if context_class is None:
+        context_class = module.ParseContext
+    best = None
+    for i in xrange(repeat):
+        context = context_class(_NullOutput(),
+                                scanner=scanner_class(),
+                                handler=module.DefaultHandler())
+        parser = parser_class()
+        parser.init(context)
+        start = time.time()
+        _feed(parser, data)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def count(module, data):
+    ''' returns the number of the events and their allocations '''
+    context = _counting_context(module)(_NullOutput(),
+                                        scanner=module.DefaultScanner(),
+                                        handler=module.DefaultHandler())
+    parser = module.DefaultParser()
+    parser.init(context)
+    _feed(parser, data)
+    return context.events, context.allocations
+
+
+def backends():
+    ''' returns the list of the available backends, (name, module) '''
+    result = [('tff', load_pure_tff())]
+    if hasattr(tff, '_tff'):
+        result.append(('_tff', tff))
+    return result
+
+
+def run(streams, repeat):
+    results = []
+    for label, module in backends():
+        for name, data in streams:
+            seconds = measure(module, module.DefaultParser,
+                              module.DefaultScanner, data, repeat)
+            events, allocations = count(module, data)
+            megabytes = len(data) / float(1 << 20)
+            results.append({'backend': label,
+                            'stream': name,
+                            'bytes': len(data),
+                            'seconds': seconds,
+                            'mb_per_sec': megabytes / seconds,
+                            'events': events,
+                            'events_per_sec': events / seconds,
+                            'allocations': allocations,
+                            'allocations_per_mb': allocations / megabytes})
+    return {'version': tff.__version__,
+            'python': sys.version.split()[0],
+            'repeat': repeat,
+            'results': results}
+
+
+def compare_parsers(streams, repeat):
+    pure = load_pure_tff()
+    parsers = [('DefaultParser', pure, pure.DefaultParser,
+                pure.DefaultScanner),
+               ('TableParser', pure, pure.TableParser, pure.DefaultScanner),
+               ('Table/EUC', pure, pure.TableParser, pure.EUCScanner)]
+    if hasattr(tff, '_tff'):
+        parsers.append(('_tff', tff, tff.DefaultParser, tff.DefaultScanner))
+        parsers.append(('_tff/EUC', tff, tff.DefaultParser,
+                        tff.EUCScanner))
+    print "%-8s" % "stream" + "".join("%16s" % p[0] for p in parsers)
+    for name, data in streams:
+        costs = [measure(module, parser_class, scanner_class, data, repeat,
+                         _null_context(module)) * 1e9 / len(data)
+                 for label, module, parser_class, scanner_class in parsers]
+        print "%-8s" % name + "".join("%11.1f ns/B" % c for c in costs)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='take the best of REPEAT runs')
+    parser.add_option('-s', '--size', type='int', default=1 << 20,
+                      help='size of each generated stream in bytes')
+    parser.add_option('-c', '--corpus', default=None,
+                      help='replay the captured streams in this directory')
+    parser.add_option('-o', '--output', default=None,
+                      help='write the JSON report to this file')
+    parser.add_option('-p', '--parsers', action='store_true', default=False,
+                      help='compare the parser implementations alone')
+    options, args = parser.parse_args()
+
+    if options.corpus:
+        streams = corpus.load(options.corpus)
+    else:
+        streams = corpus.generate(options.size)
+
+    if options.parsers:
+        compare_parsers(streams, options.repeat)
+        return 0
+
+    report = run(streams, options.repeat)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 0
+
+
+''' main '''
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+#
+# parse a large recorded stream (e.g. a typescript of script(1)) on all
+# cores with tff.BulkParser, and write the output (what tff would write to
+# the terminal) or with -d, a dump of the events, one line per sequence or
+# control character with the text in between.
+#
+# With -c, the stream is parsed once more by a single parser reading it in
+# pieces, and the MD5 digests of both results are compared.
+#
+# usage: python tools/bulkparse.py [-j processes] [-s chunk_size]
+#                                  [-e termenc] [-d] [-c] input [output]
+#
+
+import os
+import sys
+import time
+import hashlib
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tff
+
+_READ_SIZE = 65536
+
+
+class EventDumper(tff.DefaultHandler):
+
+    ''' writes the events instead of the sequences. Text is written as it
+        is (escaped), so that the dump does not depend on how the text is
+        cut into runs. '''
+
+    def __write(self, context, *event):
+        context.puts('\n%s\n' % ' '.join(map(repr, event)))
+        return True
+
+    def handle_esc(self, context, intermediate, final):
+        return self.__write(context, 'esc', list(intermediate), final)
+
+    def handle_csi(self, context, parameter, intermediate, final):
+        return self.__write(context, 'csi', list(parameter),
+                            list(intermediate), final)
+
+    def handle_ss2(self, context, final):
+        return self.__write(context, 'ss2', final)
+
+    def handle_ss3(self, context, final):
+        return self.__write(context, 'ss3', final)
+
+    def handle_control_string(self, context, prefix, value):
+        return self.__write(context, 'str', prefix, list(value))
+
+    def handle_char(self, context, c):
+        if 0x1f < c < 0x7f or c > 0x9f:
+            context.puts(unichr(c).encode('unicode_escape'))
+            return True
+        return self.__write(context, 'char', c)
+
+    def handle_text(self, context, text):
+        context.puts(text.encode('unicode_escape'))
+        return True
+
+    def handle_invalid(self, context, seq):
+        return self.__write(context, 'invalid', list(seq))
+
+
+class _DigestOutput:
+
+    def __init__(self):
+        self.__md5 = hashlib.md5()
+
+    def write(self, data):
+        self.__md5.update(data)
+
+    def flush(self):
+        pass
+
+    def hexdigest(self):
+        return self.__md5.hexdigest()
+
+
+def sequential(path, output, handler_factory, termenc):
+    ''' parse the file with one parser, the way Session reads a PTY '''
+    parser = tff.DefaultParser()
+    parser.init(tff.ParseContext(output,
+                                 termenc=termenc,
+                                 scanner=tff.DefaultScanner(),
+                                 handler=handler_factory()))
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(_READ_SIZE)
+            if not data:
+                break
+            parser.parse(data)
+    finally:
+        f.close()
+    parser.flush()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] input [output]')
+    parser.add_option('-j', '--processes', type='int', default=None,
+                      help='number of worker processes (default: cores)')
+    parser.add_option('-s', '--chunk-size', type='int',
+                      default=tff._BULK_CHUNK_SIZE,
+                      help='size of the chunk given to a worker')
+    parser.add_option('-e', '--termenc', default='UTF-8',
+                      help='encoding of the stream')
+    parser.add_option('-d', '--dump', action='store_true', default=False,
+                      help='write the events instead of the output')
+    parser.add_option('-c', '--check', action='store_true', default=False,
+                      help='compare with a sequential run')
+    options, args = parser.parse_args()
+    if not 1 <= len(args) <= 2:
+        parser.error('give an input file')
+
+    if options.dump:
+        handler_factory = EventDumper
+    else:
+        handler_factory = tff.DefaultHandler
+    bulk = tff.BulkParser(handler_factory=handler_factory,
+                          termenc=options.termenc,
+                          processes=options.processes,
+                          chunksize=options.chunk_size)
+
+    start = time.time()
+    if options.check:
+        output = _DigestOutput()
+    elif len(args) == 2:
+        output = open(args[1], 'wb')
+    else:
+        output = sys.stdout
+    bulk.parse_file(args[0], output)
+    elapsed = time.time() - start
+    size = os.path.getsize(args[0])
+    print >>sys.stderr, ("%d bytes in %.2f sec (%.1f MB/s), %d bytes "
+                         "parsed again at the seams"
+                         % (size, elapsed, size / elapsed / (1 << 20),
+                            bulk.reparsed))
+    if len(args) == 2 and not options.check:
+        output.close()
+
+    if options.check:
+        expected = _DigestOutput()
+        start = time.time()
+        sequential(args[0], expected, handler_factory, options.termenc)
+        print >>sys.stderr, ("sequential: %.2f sec"
+                             % (time.time() - start))
+        if expected.hexdigest() != output.hexdigest():
+            print >>sys.stderr, "MISMATCH"
+            return 1
+        print >>sys.stderr, "OK (%s)" % output.hexdigest()
+    return 0
+
+
+''' main '''
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# corpus of terminal output streams for tools/bench.py
+#
+# The built-in streams are generated deterministically so that the benchmark
+# runs offline and gives comparable numbers between releases. They imitate
+# what real programs write to the terminal. Captured streams (e.g. recorded
+# with script(1)) can be used instead by giving a directory; every file in it
+# becomes one stream named after the file.
+#
+
+import os
+import random
+import base64
+
+_WORDS = ('request', 'worker', 'connection', 'timeout', 'cache', 'session',
+          'handler', 'queue', 'commit', 'upstream', 'retry', 'payload')
+
+_CODE = ('def parse(self, data):', 'context = self.__context',
+         'for c in scanner:', 'if state == _STATE_GROUND:',
+         'elif c == 0x1b:  # ESC', 'pbytes.append(c)', 'return handled',
+         '', '# vim: set expandtab ts=4 sw=4:', 'import sys')
+
+_CJK = (u'日本語の文章を表示する',
+        u'端末エミュレータ',
+        u'中文字符测试',
+        u'한국어 텍스트',
+        u'全角ＡＢＣ　半角ABC')
+
+
+def logcat(rand, size):
+    ''' plain log lines, almost no escape sequences '''
+    lines = []
+    length = 0
+    while length < size:
+        line = ('2014-02-01 12:%02d:%02d.%03d INFO [worker-%d] %s %s '
+                'id=%08x took %dms\r\n'
+                % (rand.randint(0, 59), rand.randint(0, 59),
+                   rand.randint(0, 999), rand.randint(0, 15),
+                   rand.choice(_WORDS), rand.choice(_WORDS),
+                   rand.getrandbits(32), rand.randint(0, 5000)))
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+
+def vim(rand, size):
+    ''' scrolling in vim: scroll region, cursor motion, syntax colors '''
+    chunks = []
+    length = 0
+    while length < size:
+        chunk = ['\x1b[?25l\x1b[1;23r\x1b[23;1H\n\x1b[1;24r\x1b[23;1H']
+        for row in xrange(rand.randint(1, 3)):
+            line = rand.choice(_CODE)
+            chunk.append('\x1b[33m%4d \x1b[m' % rand.randint(1, 2000))
+            for word in line.split(' '):
+                color = rand.choice(('\x1b[38;5;%dm' % rand.randint(0, 255),
+                                     '\x1b[1m', '\x1b[m', ''))
+                chunk.append(color + word + ' ')
+            chunk.append('\x1b[m\x1b[K\r\n')
+        chunk.append('\x1b[24;1H\x1b[K-- INSERT --\x1b[24;63H%d,%d'
+                      % (rand.randint(1, 2000), rand.randint(1, 80)))
+        chunk.append('\x1b[%d;%dH\x1b[?12l\x1b[?25h'
+                     % (rand.randint(1, 23), rand.randint(1, 80)))
+        chunk = ''.join(chunk)
+        chunks.append(chunk)
+        length += len(chunk)
+    return ''.join(chunks)
+
+
+def htop(rand, size):
+    ''' full screen refresh of a process monitor '''
+    chunks = []
+    length = 0
+    while length < size:
+        chunk = ['\x1b[H']
+        for cpu in xrange(4):
+            usage = rand.randint(0, 40)
+            chunk.append('\x1b[%d;3H\x1b[36m%d\x1b[1;30m[\x1b[32m%s'
+                         '\x1b[31m%s\x1b[30m%s%5.1f%%]\x1b[m'
+                         % (cpu + 1, cpu + 1, '|' * (usage // 2),
+                            '|' * (usage // 2), ' ' * (40 - usage),
+                            usage * 2.5))
+        for row in xrange(6, 24):
+            chunk.append('\x1b[%d;1H\x1b[30;46m%6d\x1b[m root      20   0 '
+                         '\x1b[36m%6dM\x1b[m %5.1f %4.1f \x1b[1m%s\x1b[m'
+                         '\x1b[K' % (row, rand.randint(1, 32768),
+                                     rand.randint(1, 4096),
+                                     rand.random() * 100,
+                                     rand.random() * 10,
+                                     rand.choice(_WORDS)))
+        chunk = ''.join(chunk)
+        chunks.append(chunk)
+        length += len(chunk)
+    return ''.join(chunks)
+
+
+def sixel(rand, size):
+    ''' sixel images, long DCS strings '''
+    chunks = []
+    length = 0
+    while length < size:
+        chunk = ['\x1bPq"1;1;320;240']
+        for color in xrange(16):
+            chunk.append('#%d;2;%d;%d;%d' % (color, rand.randint(0, 100),
+                                              rand.randint(0, 100),
+                                              rand.randint(0, 100)))
+        for band in xrange(40):
+            for color in xrange(4):
+                chunk.append('#%d' % rand.randint(0, 15))
+                for i in xrange(20):
+                    if rand.random() < 0.3:
+                        chunk.append('!%d' % rand.randint(3, 30))
+                    chunk.append(chr(rand.randint(0x3f, 0x7e)))
+                chunk.append('$')
+            chunk.append('-')
+        chunk.append('\x1b\\')
+        chunk = ''.join(chunk)
+        chunks.append(chunk)
+        length += len(chunk)
+    return ''.join(chunks)
+
+
+def osc52(rand, size):
+    ''' clipboard transfers with OSC 52, long base64 payloads '''
+    chunks = []
+    length = 0
+    while length < size:
+        payload = ''.join(chr(rand.getrandbits(8))
+                          for i in xrange(rand.randint(1024, 65536)))
+        chunk = '\x1b]52;c;%s\x07' % base64.b64encode(payload)
+        chunks.append(chunk)
+        length += len(chunk)
+    return ''.join(chunks)
+
+
+def cjk(rand, size):
+    ''' UTF-8 encoded CJK text with a few attributes '''
+    chunks = []
+    length = 0
+    while length < size:
+        line = u' '.join(rand.choice(_CJK) for i in xrange(4))
+        chunk = ('\x1b[1m%s\x1b[m %s\r\n'
+                 % (rand.choice(_CJK).encode('utf-8'),
+                    line.encode('utf-8')))
+        chunks.append(chunk)
+        length += len(chunk)
+    return ''.join(chunks)
+
+
+GENERATORS = [('logcat', logcat),
+              ('vim', vim),
+              ('htop', htop),
+              ('sixel', sixel),
+              ('osc52', osc52),
+              ('cjk', cjk)]
+
+
+def generate(size=1 << 20, seed=0):
+    ''' returns the list of the built-in streams, (name, data) '''
+    return [(name, generator(random.Random(seed), size))
+            for name, generator in GENERATORS]
+
+
+def load(directory):
+    ''' returns the list of the captured streams in the directory '''
+    streams = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            f = open(path, 'rb')
+            try:
+                streams.append((name, f.read()))
+            finally:
+                f.close()
+    return streams
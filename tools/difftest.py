@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# differential test: feed random byte streams to the pure Python
+# DefaultParser, TableParser and the C DefaultParser (if _tff is built)
+# with DefaultScanner and EUCScanner, and compare the events they dispatch.
+# Some of the candidates get the chunks as memoryviews, the way Session
+# passes the buffer of DefaultPTY, and some stream the values of control
+# strings (ParseContext with maxcontrolstring puts them together again).
+#
+# usage: python tools/difftest.py [iterations] [seed]
+#
+
+import os
+import sys
+import imp
+import random
+
+_TFF_PATH = os.path.join(os.path.dirname(__file__), '..', 'tff.py')
+
+sys.path.insert(0, os.path.dirname(_TFF_PATH))
+
+import tff
+
+# large enough to buffer every control string of the generated streams
+_MAX_CONTROL_STRING = 1 << 20
+
+# fragments which tend to hit every state and transition of the parser
+_ALPHABET = ['\x1b', '[', ']', 'P', 'X', '^', '_', 'N', 'O', '\\', '\x07',
+             '\x18', '\x1a', '\x00', '\x08', '\x0d', '\x0a', '\x0e', '\x7f',
+             '0', '1', ';', ':', '?', '>', ' ', '!', '#', '(', 'm', 'H', 'B',
+             'a', '~', '@', '\xc2\x9b', '\xc2\xa0', '\xe3\x81\x82',
+             '\xf0\x9f\x8d\xa3', '\xff']
+
+
+def load_pure_tff():
+    ''' load another copy of tff.py which does not use _tff '''
+    saved = sys.modules.get('_tff')
+    sys.modules['_tff'] = None  # makes "import _tff" fail
+    try:
+        return imp.load_source('_pure_tff', _TFF_PATH)
+    finally:
+        if saved is None:
+            del sys.modules['_tff']
+        else:
+            sys.modules['_tff'] = saved
+
+
+def make_handlers(module):
+
+    class RecordingHandler(module.DefaultHandler):
+
+        def __init__(self):
+            self.events = []
+
+        def handle_csi(self, context, parameter, intermediate, final):
+            self.events.append(('csi', list(parameter),
+                                list(intermediate), final))
+            return False
+
+        def handle_esc(self, context, intermediate, final):
+            self.events.append(('esc', list(intermediate), final))
+            return False
+
+        def handle_ss2(self, context, final):
+            self.events.append(('ss2', final))
+            return False
+
+        def handle_ss3(self, context, final):
+            self.events.append(('ss3', final))
+            return False
+
+        def handle_control_string(self, context, prefix, value):
+            self.events.append(('str', prefix, list(value)))
+            return False
+
+        def handle_char(self, context, c):
+            self.events.append(('char', c))
+            return False
+
+        def handle_text(self, context, text):
+            self.events.append(('text', text))
+            return False
+
+        def handle_invalid(self, context, seq):
+            self.events.append(('invalid', list(seq)))
+            return False
+
+    class CharRecordingHandler(RecordingHandler):
+
+        ''' a handler which knows nothing about handle_text '''
+
+        handle_text = module.DefaultHandler.handle_text.im_func
+
+    return RecordingHandler, CharRecordingHandler
+
+
+def run(module, parser, scanner, handler, chunks, view=False,
+        maxcontrolstring=None):
+    from StringIO import StringIO
+    output = StringIO()
+    context = module.ParseContext(output,
+                                  scanner=scanner,
+                                  handler=handler,
+                                  maxcontrolstring=maxcontrolstring)
+    parser.init(context)
+    for chunk in chunks:
+        if view:
+            chunk = memoryview(bytearray(chunk))
+        parser.parse(chunk)
+    parser.flush()
+    return handler.events, output.getvalue()
+
+
+def generate(rand):
+    data = ''.join(rand.choice(_ALPHABET)
+                   for i in xrange(rand.randint(0, 80)))
+    cuts = sorted(rand.randint(0, len(data)) for i in xrange(3))
+    return [data[a:b] for a, b in zip([0] + cuts, cuts + [len(data)])]
+
+
+def main(iterations=20000, seed=0):
+    pure = load_pure_tff()
+    streaming = _MAX_CONTROL_STRING
+    candidates = [(pure, pure.TableParser, pure.DefaultScanner, False, None),
+                  (pure, pure.DefaultParser, pure.EUCScanner, False, None),
+                  (pure, pure.TableParser, pure.EUCScanner, True, None),
+                  (pure, pure.DefaultParser, pure.DefaultScanner, False,
+                   streaming),
+                  (pure, pure.TableParser, pure.DefaultScanner, False,
+                   streaming)]
+    if tff.DefaultParser is not pure.DefaultParser and hasattr(tff, '_tff'):
+        candidates.append((tff, tff.DefaultParser, tff.DefaultScanner, False,
+                           None))
+        candidates.append((tff, tff.DefaultParser, tff.DefaultScanner, True,
+                           None))
+        candidates.append((tff, tff.DefaultParser, tff.EUCScanner, False,
+                           None))
+        candidates.append((tff, tff.DefaultParser, tff.DefaultScanner, True,
+                           streaming))
+    handlers = dict((module, make_handlers(module))
+                    for module in (pure, tff))
+    rand = random.Random(seed)
+    for i in xrange(iterations):
+        chunks = generate(rand)
+        for kind in (0, 1):
+            expected = run(pure, pure.DefaultParser(), pure.DefaultScanner(),
+                           handlers[pure][kind](), chunks)
+            for (module, parser_class, scanner_class,
+                 view, maxcontrolstring) in candidates:
+                actual = run(module, parser_class(), scanner_class(),
+                             handlers[module][kind](), chunks, view,
+                             maxcontrolstring)
+                if expected != actual:
+                    name = handlers[module][kind].__name__
+                    print "mismatch: %r (%s.%s, %s, %s)" % (
+                        chunks, module.__name__, parser_class.__name__,
+                        scanner_class.__name__, name)
+                    print "  expected: %r" % (expected,)
+                    print "  actual:   %r" % (actual,)
+                    return 1
+    names = ", ".join("%s.%s/%s%s%s" % (module.__name__,
+                                        parser_class.__name__,
+                                        scanner_class.__name__,
+                                        view and "(view)" or "",
+                                        maxcontrolstring and "(stream)" or "")
+                      for (module, parser_class, scanner_class,
+                           view, maxcontrolstring) in candidates)
+    print "%d streams OK (%s)" % (iterations, names)
+    return 0
+
+
+''' main '''
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+#
+# record a session: runs the command (default: $SHELL) in a tff Session and
+# writes the input, the output and the resizes with their timestamps to the
+# recording file, which tools/replay.py plays back.
+#
+# usage: python tools/record.py recording [command]
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tff
+
+
+def main():
+    if len(sys.argv) < 2:
+        print "usage: python tools/record.py recording [command]"
+        return 2
+    path = sys.argv[1]
+    command = " ".join(sys.argv[2:]) or os.environ.get('SHELL', '/bin/sh')
+    lang = os.environ.get('LANG', 'en_US.UTF-8')
+    term = os.environ.get('TERM', 'xterm')
+    recorder = tff.Recorder(open(path, 'wb'))
+    tty = tff.DefaultPTY(term, lang, command, sys.stdin)
+    tty.fitsize()
+    try:
+        session = tff.Session(tty, recorder=recorder)
+        session.start(termenc='UTF-8')
+    finally:
+        tty.restore_term()
+        recorder.close()
+    return 0
+
+
+''' main '''
+if __name__ == '__main__':
+    sys.exit(main())
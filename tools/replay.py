@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# replay a recording of tools/record.py through a Process on a fake PTY
+# (the input through the input handler, the output through the output
+# handler, both DefaultHandler) and report the time it took. With -t, the
+# records are fed with the original timing; with -s, the Statistics of the
+# process are printed as JSON.
+#
+# usage: python tools/replay.py [-r repeat] [-b] [-t] [-s] recording
+#
+
+import os
+import sys
+import time
+import json
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tff
+
+
+class _NullOutput:
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def replay(path, buffering, realtime, statistics=None):
+    ''' returns the seconds and the size of the output of a replay '''
+    f = open(path, 'rb')
+    try:
+        replayer = tff.Replayer(f)
+    finally:
+        f.close()
+    size = sum(len(data) for timestamp, kind, data in replayer
+               if kind == 'o')
+    process = replayer.create_process(stdout=_NullOutput(),
+                                      buffering=buffering,
+                                      statistics=statistics)
+    start = time.time()
+    replayer.replay(process, realtime)
+    return time.time() - start, size
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] recording")
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='take the best of REPEAT runs')
+    parser.add_option('-b', '--buffering', action='store_true',
+                      default=False, help='use buffered contexts')
+    parser.add_option('-t', '--realtime', action='store_true',
+                      default=False, help='keep the original timing')
+    parser.add_option('-s', '--stats', action='store_true', default=False,
+                      help='print the statistics of the last run')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("give a recording")
+
+    best = None
+    for i in xrange(options.repeat):
+        statistics = options.stats and tff.Statistics() or None
+        seconds, size = replay(args[0], options.buffering, options.realtime,
+                               statistics)
+        if best is None or seconds < best:
+            best = seconds
+    print "%s: %d bytes of output, %.3f sec, %.2f MB/s" % (
+        args[0], size, best, size / float(1 << 20) / max(best, 1e-9))
+    if statistics is not None:
+        json.dump(statistics.stats(), sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 0
+
+
+''' main '''
+if __name__ == '__main__':
+    sys.exit(main())